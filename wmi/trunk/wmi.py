@@ -55,9 +55,11 @@ some getattr / setattr magic to ease the way. In particular:
     process.Create (CommandLine="notepad.exe")
 
 * To make it easier to use in embedded systems and py2exe-style
-  executable wrappers, the module will not force early Dispatch.
-  To do this, it uses a handy hack by Thomas Heller for easy access
-  to constants.
+  executable wrappers, the module will not force early Dispatch,
+  nor will it connect to WMI when it is imported. The common
+  WbemScripting constants are held in a precomputed table and
+  anything else is looked up lazily, using a handy hack by
+  Thomas Heller for easy access to constants.
 
 Typical usage will be::
 
@@ -80,13 +82,30 @@ __VERSION__ = __version__ = "1.4.9"
 _DEBUG = False
 
 import sys
+import array
+import collections
 import csv
 import datetime
+import hashlib
+import json
+import numbers
+import operator
+import os
+try:
+  import Queue as queue
+except ImportError:
+  import queue
 import re
 import struct
+import tempfile
+import threading
+import time
 import warnings
+import weakref
+import xml.parsers.expat
 
 from win32com.client import GetObject, Dispatch
+import pythoncom
 import pywintypes
 
 def signed_to_unsigned (signed):
@@ -155,13 +174,121 @@ class ProvideConstants (object):
      raise AttributeError (name)
     return result[1].value
 
-obj = GetObject ("winmgmts:")
-ProvideConstants (obj)
+def unsigned_to_signed (unsigned):
+  """Convert an unsigned 32-bit value to the signed long which
+  COM uses for HRESULTs and typelib constants. The inverse of
+  :func:`signed_to_unsigned`::
 
-wbemErrInvalidQuery = obj._constants.wbemErrInvalidQuery
-wbemErrTimedout = obj._constants.wbemErrTimedout
-wbemFlagReturnImmediately = obj._constants.wbemFlagReturnImmediately
-wbemFlagForwardOnly = obj._constants.wbemFlagForwardOnly
+    print unsigned_to_signed (0x80041017)
+  """
+  signed, = struct.unpack ("l", struct.pack ("L", unsigned))
+  return signed
+
+class LazyConstants (object):
+  """Provides the WbemScripting constants as attributes without
+  binding to the WMI service when the module is imported. The
+  commonly-used values are held in a precomputed table; anything
+  else is looked up in the WbemScripting typelib on first use
+  (via :class:`ProvideConstants` on an `SWbemLocator`, which does
+  not connect to anything) and then remembered::
+
+    import wmi
+    print wmi.constants.wbemFlagForwardOnly
+    print wmi.constants.wbemCimtypeString
+  """
+
+  def __init__ (self, builtins):
+    #
+    # Names are matched case-insensitively, as they would
+    # be by the typelib's own Bind.
+    #
+    self.__dict__["_table"] = dict ((name.lower (), value) for name, value in builtins.items ())
+    self.__dict__["_typecomp"] = None
+
+  def _lookup (self, name):
+    if self._typecomp is None:
+      locator = Dispatch ("WbemScripting.SWbemLocator")
+      self.__dict__["_typecomp"] = ProvideConstants (locator)
+    return getattr (self._typecomp, name)
+
+  def __getattr__ (self, name):
+    if name.startswith ("__") and name.endswith ("__"):
+      raise AttributeError (name)
+    try:
+      return self._table[name.lower ()]
+    except KeyError:
+      try:
+        value = self._lookup (name)
+      except pywintypes.com_error:
+        raise AttributeError (name)
+      self._table[name.lower ()] = value
+      return value
+
+  def __setattr__ (self, name, value):
+    raise AttributeError ("WMI constants are read-only")
+
+#
+# Values as defined by the WbemScripting typelib (wbemdisp.tlb).
+# HRESULTs are held as signed longs, which is what the typelib
+# itself would return.
+#
+_BUILTIN_CONSTANTS = {
+  "wbemFlagReturnImmediately" : 0x10,
+  "wbemFlagReturnWhenComplete" : 0x0,
+  "wbemFlagBidirectional" : 0x0,
+  "wbemFlagForwardOnly" : 0x20,
+  "wbemFlagNoErrorObject" : 0x40,
+  "wbemFlagReturnErrorObject" : 0x0,
+  "wbemFlagSendStatus" : 0x80,
+  "wbemFlagDontSendStatus" : 0x0,
+  "wbemFlagEnsureLocatable" : 0x100,
+  "wbemFlagDirectRead" : 0x200,
+  "wbemFlagSendOnlySelected" : 0x0,
+  "wbemFlagUseAmendedQualifiers" : 0x20000,
+  "wbemFlagGetDefault" : 0x0,
+  "wbemFlagSpawnInstance" : 0x1,
+  "wbemFlagUseCurrentTime" : 0x1,
+  "wbemConnectFlagUseMaxWait" : 0x80,
+
+  "wbemObjectTextFormatCIMDTD20" : 1,
+  "wbemObjectTextFormatWMIDTD20" : 2,
+
+  "wbemImpersonationLevelAnonymous" : 1,
+  "wbemImpersonationLevelIdentify" : 2,
+  "wbemImpersonationLevelImpersonate" : 3,
+  "wbemImpersonationLevelDelegate" : 4,
+
+  "wbemAuthenticationLevelDefault" : 0,
+  "wbemAuthenticationLevelNone" : 1,
+  "wbemAuthenticationLevelConnect" : 2,
+  "wbemAuthenticationLevelCall" : 3,
+  "wbemAuthenticationLevelPkt" : 4,
+  "wbemAuthenticationLevelPktIntegrity" : 5,
+  "wbemAuthenticationLevelPktPrivacy" : 6,
+
+  "wbemErrFailed" : unsigned_to_signed (0x80041001),
+  "wbemErrNotFound" : unsigned_to_signed (0x80041002),
+  "wbemErrAccessDenied" : unsigned_to_signed (0x80041003),
+  "wbemErrProviderFailure" : unsigned_to_signed (0x80041004),
+  "wbemErrInvalidParameter" : unsigned_to_signed (0x80041008),
+  "wbemErrNotAvailable" : unsigned_to_signed (0x80041009),
+  "wbemErrNotSupported" : unsigned_to_signed (0x8004100C),
+  "wbemErrInvalidNamespace" : unsigned_to_signed (0x8004100E),
+  "wbemErrInvalidClass" : unsigned_to_signed (0x80041010),
+  "wbemErrInvalidQuery" : unsigned_to_signed (0x80041017),
+  "wbemErrCallCancelled" : unsigned_to_signed (0x80041032),
+  "wbemErrShuttingDown" : unsigned_to_signed (0x80041033),
+  "wbemErrServerTooBusy" : unsigned_to_signed (0x80041045),
+  "wbemErrQuotaViolation" : unsigned_to_signed (0x8004106C),
+  "wbemErrTimedout" : unsigned_to_signed (0x80043001),
+}
+
+constants = LazyConstants (_BUILTIN_CONSTANTS)
+
+wbemErrInvalidQuery = constants.wbemErrInvalidQuery
+wbemErrTimedout = constants.wbemErrTimedout
+wbemFlagReturnImmediately = constants.wbemFlagReturnImmediately
+wbemFlagForwardOnly = constants.wbemFlagForwardOnly
 
 #
 # Exceptions
@@ -217,6 +344,20 @@ WMI_EXCEPTIONS = {
   0x800401E4 : x_wmi_uninitialised_thread,
 }
 
+def _error_codes (err):
+  """The HRESULT of a `pywintypes.com_error` and, if there is one,
+  the more specific code from its additional information.
+  """
+  hresult_code, hresult_name, additional_info, parameter_in_error = err.args
+  codes = [signed_to_unsigned (hresult_code)]
+  if additional_info:
+    codes.append (signed_to_unsigned (additional_info[5]))
+  return codes
+
+def _is_timeout (err):
+  """Whether a `pywintypes.com_error` is WMI reporting a timeout"""
+  return signed_to_unsigned (wbemErrTimedout) in _error_codes (err)
+
 def handle_com_error (err=None):
   """Convenience wrapper for displaying all manner of COM errors.
   Raises a :exc:`x_wmi` exception with more useful information attached
@@ -381,66 +522,77 @@ class _wmi_method:
     """
     try:
       if self.in_parameters:
-        parameter_names = {}
-        for name, is_array in self.in_parameter_names:
-          parameter_names[name] = is_array
+        result = self.ole_object.ExecMethod_ (self.method.Name, self._parameters (args, kwargs))
+      else:
+        result = self.ole_object.ExecMethod_ (self.method.Name)
+      return self._results (result)
 
-        parameters = self.in_parameters
+    except pywintypes.com_error:
+      handle_com_error ()
 
-        #
-        # Check positional parameters first
-        #
-        for n_arg in range (len (args)):
-          arg = args[n_arg]
-          parameter = parameters.Properties_[n_arg]
-          if parameter.IsArray:
-            try: list (arg)
-            except TypeError: raise TypeError ("parameter %d must be iterable" % n_arg)
-          parameter.Value = arg
+  def _parameters (self, args, kwargs, parameters=None):
+    """Fill in the method's in-parameters -- or `parameters`, an
+    instance spawned from them -- from positional and keyword
+    arguments, and return them.
+    """
+    if parameters is None:
+      parameters = self.in_parameters
+    parameter_names = {}
+    for name, is_array in self.in_parameter_names:
+      parameter_names[name] = is_array
 
-        #
-        # If any keyword param supersedes a positional one,
-        # it'll simply overwrite it.
-        #
-        for k, v in kwargs.items ():
-          is_array = parameter_names.get (k)
-          if is_array is None:
-            raise AttributeError ("%s is not a valid parameter for %s" % (k, self.__doc__))
-          else:
-            if is_array:
-              try: list (v)
-              except TypeError: raise TypeError ("%s must be iterable" % k)
-          parameters.Properties_ (k).Value = v
+    #
+    # Check positional parameters first
+    #
+    for n_arg in range (len (args)):
+      arg = args[n_arg]
+      parameter = parameters.Properties_[n_arg]
+      if parameter.IsArray:
+        try: list (arg)
+        except TypeError: raise TypeError ("parameter %d must be iterable" % n_arg)
+      parameter.Value = arg
 
-        result = self.ole_object.ExecMethod_ (self.method.Name, self.in_parameters)
+    #
+    # If any keyword param supersedes a positional one,
+    # it'll simply overwrite it.
+    #
+    for k, v in kwargs.items ():
+      is_array = parameter_names.get (k)
+      if is_array is None:
+        raise AttributeError ("%s is not a valid parameter for %s" % (k, self.__doc__))
       else:
-        result = self.ole_object.ExecMethod_ (self.method.Name)
-
-      results = []
-      for name, is_array in self.out_parameter_names:
-        value = result.Properties_ (name).Value
         if is_array:
-          #
-          # Thanks to Jonas Bjering for bug report and patch
-          #
-          results.append (list (value or []))
-        else:
-          results.append (value)
-      return tuple (results)
+          try: list (v)
+          except TypeError: raise TypeError ("%s must be iterable" % k)
+      parameters.Properties_ (k).Value = v
+    return parameters
 
-    except pywintypes.com_error:
-      handle_com_error ()
+  def _results (self, result):
+    """Return the out parameters of a call as a tuple"""
+    results = []
+    for name, is_array in self.out_parameter_names:
+      value = result.Properties_ (name).Value
+      if is_array:
+        #
+        # Thanks to Jonas Bjering for bug report and patch
+        #
+        results.append (list (value or []))
+      else:
+        results.append (value)
+    return tuple (results)
 
   def __repr__ (self):
     return "<function %s>" % self.__doc__
 
 class _wmi_property (object):
 
-  def __init__ (self, property):
+  def __init__ (self, property, qualifiers=None):
     self.property = property
     self.name = property.Name
     self.value = property.Value
-    self.qualifiers = dict ((q.Name, q.Value) for q in property.Qualifiers_)
+    if qualifiers is None:
+      qualifiers = dict ((q.Name, q.Value) for q in property.Qualifiers_)
+    self.qualifiers = qualifiers
     self.type = self.qualifiers.get ("CIMTYPE", None)
     self.provenance = "\n".join (self.qualifiers.get ("MappingStrings", []))
 
@@ -454,763 +606,4602 @@ class _wmi_property (object):
     return getattr (self.property, attr)
 
 #
-# class _wmi_object
+# class _wmi_schema
 #
-class _wmi_object:
-  """The heart of the WMI module: wraps the objects returned by COM
-  ISWbemObject interface and provide readier access to their properties
-  and methods resulting in a more Pythonic interface. Not usually
-  instantiated directly, rather as a result of calling a :class:`_wmi_class`
-  on the parent :class:`_wmi_namespace`.
-
-  If you get hold of a WMI-related COM object from some other
-  source than this module, you can wrap it in one of these objects
-  to get the benefits of the module::
+class _wmi_schema (object):
+  """The shape of a WMI class: its property names, their qualifiers
+  (including CIMTYPE), its method names, its key names and its own
+  qualifiers. Reading these over COM means walking three collections,
+  so a schema is read once per class and shared by every
+  :class:`_wmi_object` which wraps an instance of that class.
+  """
 
-    import win32com.client
-    import wmi
+  def __init__ (self, class_name, properties, property_qualifiers, methods, qualifiers):
+    self.class_name = class_name
+    self.properties = list (properties)
+    self.property_qualifiers = property_qualifiers
+    self.methods = list (methods)
+    self.qualifiers = qualifiers
+    self.types = dict (
+      (name, property_qualifiers[name].get ("CIMTYPE")) for name in self.properties
+    )
+    self.keys = [
+      name for name in self.properties if property_qualifiers[name].get ("key")
+    ]
 
-    wmiobj = win32com.client.GetObject ("winmgmts:Win32_LogicalDisk.DeviceID='C:'")
-    c_drive = wmi._wmi_object (wmiobj)
-    print c_drive
-  """
+  def __repr__ (self):
+    return "<_wmi_schema: %s>" % self.class_name
 
-  def __init__ (self, ole_object, instance_of=None, fields=[], property_map={}):
-    try:
-      _set (self, "ole_object", ole_object)
-      _set (self, "id", ole_object.Path_.DisplayName.lower ())
-      _set (self, "_instance_of", instance_of)
-      _set (self, "properties", {})
-      _set (self, "methods", {})
-      _set (self, "property_map", property_map)
-      _set (self, "_associated_classes", None)
-      _set (self, "_keys", None)
+  def _data (self):
+    """Everything in the schema as plain data, as a :class:`SchemaCache`
+    stores it.
+    """
+    return dict (
+      class_name=self.class_name,
+      properties=self.properties,
+      property_qualifiers=self.property_qualifiers,
+      methods=self.methods,
+      qualifiers=self.qualifiers
+    )
 
-      if fields:
-        for field in fields:
-          self.properties[field] = None
-      else:
-        for p in ole_object.Properties_:
-          self.properties[p.Name] = None
+  def _get_version (self):
+    """A hash of everything in the schema, used to spot when a class
+    has changed underneath a cached copy of its schema. It's taken over
+    the schema's canonical JSON so that one read back from a cache --
+    with lists for tuples and, under Python 2, unicode for str -- hashes
+    the same as the one which was saved.
+    """
+    signature = json.dumps (self._data (), sort_keys=True, default=repr)
+    return hashlib.md5 (signature.encode ("utf8")).hexdigest ()
+  version = property (_get_version)
+
+  @classmethod
+  def from_ole_object (cls, ole_object, class_name=None):
+    """Read the schema of a WMI class from the class itself or from
+    any one of its instances.
+    """
+    properties = []
+    property_qualifiers = {}
+    for p in ole_object.Properties_:
+      properties.append (p.Name)
+      property_qualifiers[p.Name] = dict ((q.Name, q.Value) for q in p.Qualifiers_)
+    methods = [m.Name for m in ole_object.Methods_]
+    qualifiers = dict ((q.Name, q.Value) for q in ole_object.Qualifiers_)
+    if class_name is None:
+      class_name = ole_object.Path_.Class
+    return cls (class_name, properties, property_qualifiers, methods, qualifiers)
 
-      for m in ole_object.Methods_:
-        self.methods[m.Name] = None
+#
+# Schemas of classes seen so far, keyed by (server, namespace, class).
+# Only complete objects -- classes, and instances from unprojected
+# queries -- contribute; a projected query keeps its own, since its
+# objects carry only the selected properties. A namespace may be given
+# a store of its own in place of this one.
+#
+_schemas = {}
 
-      _set (self, "_properties", self.properties.keys ())
-      _set (self, "_methods", self.methods.keys ())
-      _set (self, "qualifiers", dict ((q.Name, q.Value) for q in self.ole_object.Qualifiers_))
+class _schema_overlay (dict):
+  """Schemas for objects which may be incomplete: reads through to
+  the shared schemas -- or `schemas`, if given -- but keeps anything it
+  has to read for itself.
+  """
+  def __init__ (self, schemas=None):
+    dict.__init__ (self)
+    self.schemas = schemas
+
+  def __missing__ (self, key):
+    if self.schemas is None:
+      return _schemas[key]
+    return self.schemas[key]
+
+_unprojected_wql = re.compile (r"\s*(select\s+\*\s+from|associators\s+of|references\s+of)\s", re.I)
+def _schemas_for_query (wql, fields, schemas=None):
+  """Return the schema cache appropriate to the objects a query
+  will return: the shared one -- or `schemas`, if given -- if they're
+  complete, otherwise one private to this query.
+  """
+  if fields:
+    return _schema_overlay (schemas)
+  elif _unprojected_wql.match (wql):
+    return schemas
+  else:
+    return {}
 
-    except pywintypes.com_error:
-      handle_com_error ()
+def _schema_for (ole_object, path, schemas=None):
+  """Return the shared :class:`_wmi_schema` for the class of `ole_object`,
+  reading it from the object if this is the first of its class.
+  """
+  if schemas is None:
+    schemas = _schemas
+  key = (path.Server, path.Namespace, path.Class)
+  try:
+    return schemas[key]
+  except KeyError:
+    schema = schemas[key] = _wmi_schema.from_ole_object (ole_object, key[2])
+    return schema
+
+def _json_tuples (value):
+  """Turn the lists in a value read back from JSON into the tuples
+  which COM gave for arrays in the first place.
+  """
+  if isinstance (value, list):
+    return tuple (_json_tuples (item) for item in value)
+  elif isinstance (value, dict):
+    return dict ((key, _json_tuples (item)) for (key, item) in value.items ())
+  else:
+    return value
+
+class SchemaCache (object):
+  """Keeps the schemas of WMI classes on disk so that a new process
+  can pick up a class from a namespace without going to WMI for it.
+  Pass one, or the name of a directory, to :func:`WMI`::
+
+    c = wmi.WMI ("remote", schema_cache="c:/temp/wmi-schemas")
+    for disk in c.Win32_LogicalDisk ():
+      print disk.Caption
+
+  A class picked up this way only fetches its COM object when it needs
+  it, eg to call a method. At that point the live schema is compared
+  against the cached one and, if the class has changed, both the class
+  and the cache are updated. The instances returned by querying it share
+  the cached schema without checking it, so entries older than
+  `max_age_secs` -- a day by default -- are ignored and fetched afresh;
+  it can't be None.
+
+  Schemas are stored as JSON, which holds only data, so a directory
+  shared with other users can't be used to run code in this process.
+  """
 
-  def __lt__ (self, other):
-    return self.id < other.id
+  FORMAT = 2
 
-  def __str__ (self):
-    """For a call to print [object] return the OLE description
-    of the properties / values of the object
-    """
-    try:
-      return self.ole_object.GetObjectText_ ()
-    except pywintypes.com_error:
-      handle_com_error ()
+  def __init__ (self, directory, max_age_secs=24 * 60 * 60):
+    if max_age_secs is None:
+      raise x_wmi ("A SchemaCache needs a max_age_secs")
+    self.directory = directory
+    self.max_age_secs = max_age_secs
+    if not os.path.isdir (directory):
+      os.makedirs (directory)
 
   def __repr__ (self):
+    return "<SchemaCache: %s>" % self.directory
+
+  def _filepath (self, location, class_name):
+    key = "|".join ([sys.version[:1]] + list (location) + [class_name]).lower ()
+    return os.path.join (self.directory, hashlib.md5 (key.encode ("utf8")).hexdigest () + ".schema")
+
+  def load (self, location, class_name, schemas=None):
+    """Return the :class:`_wmi_schema` cached for `class_name` at
+    `location` -- a (computer, namespace) pair -- or None if there is
+    none or it is out of date. The schema is added to the shared
+    schemas, or to `schemas` if given.
     """
-    Indicate both the fact that this is a wrapped WMI object
-    and the WMI object's own identifying class.
+    try:
+      f = open (self._filepath (location, class_name), "rb")
+      try:
+        record = json.loads (f.read ().decode ("ascii"))
+      finally:
+        f.close ()
+      if record.get ("format") != self.FORMAT:
+        return None
+      if time.time () - record["saved"] > self.max_age_secs:
+        return None
+      fields = record["schema"]
+      schema = _wmi_schema (
+        fields["class_name"],
+        fields["properties"],
+        dict ((name, _json_tuples (qualifiers)) for (name, qualifiers) in fields["property_qualifiers"].items ()),
+        fields["methods"],
+        _json_tuples (fields["qualifiers"])
+      )
+      path_key = tuple (record["path_key"])
+    except (IOError, OSError, ValueError, KeyError, TypeError, AttributeError):
+      return None
+    if schema.version != record.get ("version"):
+      return None
+    #
+    # Objects which come back from queries will look for their
+    # schema under the server & namespace which WMI reports for
+    # them, so make it available there too.
+    #
+    if schemas is None:
+      schemas = _schemas
+    schemas.setdefault (path_key + (schema.class_name,), schema)
+    return schema
+
+  def save (self, location, schema, path_key=("", "")):
+    """Write `schema` to the cache for `location`. `path_key` is the
+    (server, namespace) which WMI reports in the class's `Path\_`.
     """
+    record = dict (
+      format=self.FORMAT,
+      saved=time.time (),
+      version=schema.version,
+      path_key=list (path_key),
+      schema=schema._data ()
+    )
     try:
-      return "<%s: %s>" % (self.__class__.__name__, self.Path_.Path.encode ("ascii", "backslashreplace"))
-    except pywintypes.com_error:
-      handle_com_error ()
+      data = json.dumps (record).encode ("ascii")
+    except (TypeError, ValueError):
+      #
+      # A qualifier whose value JSON can't hold
+      #
+      return
+    filepath = self._filepath (location, schema.class_name)
+    handle, temp_filepath = tempfile.mkstemp (dir=self.directory)
+    try:
+      os.write (handle, data)
+    finally:
+      os.close (handle)
+    replace = getattr (os, "replace", None)
+    if replace is None and os.path.exists (filepath):
+      os.remove (filepath)
+    (replace or os.rename) (temp_filepath, filepath)
+
+  def clear (self):
+    """Remove every schema from the cache"""
+    for filename in os.listdir (self.directory):
+      if filename.endswith (".schema"):
+        os.remove (os.path.join (self.directory, filename))
 
-  def _cached_properties (self, attribute):
-    if self.properties[attribute] is None:
-      self.properties[attribute] = _wmi_property (self.ole_object.Properties_ (attribute))
-    return self.properties[attribute]
+#
+# Reading a whole object in one call
+#
+# Each property read through Properties_ is a COM call of its own --
+# possibly across the network -- so a wide row costs one round trip per
+# column. GetText_ returns the whole object as CIM-XML in a single call,
+# which is then read here into a dictionary of typed values.
+#
+_CIM_INTEGER_TYPES = set (["sint8", "uint8", "sint16", "uint16", "sint32", "uint32", "sint64", "uint64"])
+_CIM_REAL_TYPES = set (["real32", "real64"])
+_xml_declaration = re.compile (r"^\s*<\?xml[^>]*\?>")
+
+def _cim_value (cimtype, text):
+  """Convert the text of a CIM-XML VALUE element according to its CIM type"""
+  if cimtype in _CIM_INTEGER_TYPES:
+    return int (text)
+  elif cimtype in _CIM_REAL_TYPES:
+    return float (text)
+  elif cimtype == "boolean":
+    return text.strip ().lower () == "true"
+  else:
+    return text
 
-  def _cached_methods (self, attribute):
-    if self.methods[attribute] is None:
-      self.methods[attribute] = _wmi_method (self.ole_object, attribute)
-    return self.methods[attribute]
+def _cim_path (path):
+  """Render the parts of a CIM-XML instance path as a WMI object path,
+  the form in which a reference property is returned over COM.
+  """
+  keys = []
+  for name, value, value_type in path["keys"]:
+    if value_type in ("string", "reference"):
+      value = '"%s"' % value.replace ("\\", "\\\\").replace ('"', '\\"')
+    keys.append ("%s=%s" % (name, value))
+  if keys:
+    relpath = "%s.%s" % (path["class"], ",".join (keys))
+  else:
+    relpath = "%s=@" % path["class"]
+  namespace = "\\".join (path["namespace"])
+  if path["host"]:
+    return "\\\\%s\\%s:%s" % (path["host"], namespace, relpath)
+  elif namespace:
+    return "%s:%s" % (namespace, relpath)
+  else:
+    return relpath
 
-  def __getattr__ (self, attribute):
-    """
-    Attempt to pass attribute calls to the proxied COM object.
-    If the attribute is recognised as a property, return its value;
-    if it is recognised as a method, return a method wrapper which
-    can then be called with parameters; otherwise pass the lookup
-    on to the underlying object.
-    """
-    try:
-      if attribute in self.properties:
-        property = self._cached_properties (attribute)
-        factory = self.property_map.get (attribute, self.property_map.get (property.type, lambda x: x))
-        value = factory (property.value)
-        #
-        # If this is an association, certain of its properties
-        # are actually the paths to the aspects of the association,
-        # so translate them automatically into WMI objects.
-        #
-        if property.type.startswith ("ref:"):
-          return WMI (moniker=value)
-        else:
-          return value
-      elif attribute in self.methods:
-        return self._cached_methods (attribute)
-      else:
-        return getattr (self.ole_object, attribute)
-    except pywintypes.com_error:
-      handle_com_error ()
+def _path_parts (path):
+  """Return the host -- lower-cased, or "" if it doesn't name one --
+  and the class of a WMI object path.
+  """
+  host = ""
+  if path.startswith ("\\\\"):
+    host, path = path[2:].split ("\\", 1)
+  relpath = path.split (".", 1)[0].split ("=", 1)[0]
+  return host.lower (), relpath.rsplit (":", 1)[-1]
+
+_path_prefix = re.compile (r"^(?:\\\\[^\\]+\\)?(?:[\w\\]+:)?")
+def _normalised_path (path):
+  """Reduce a WMI object path to its relative path, lower-cased, so that
+  paths to the same object compare equal whether or not they name the
+  host and namespace.
+  """
+  return _path_prefix.sub ("", path, 1).lower ()
+
+class _cim_xml_reader (object):
+  """Streaming reader for the CIM-XML (DTD 2.0) text of a single
+  instance or class, as returned by `GetText_`. Qualifiers are skipped;
+  each property's value is converted according to its TYPE: integers
+  (including the 64-bit ones, which come over COM as strings) to int,
+  reals to float, booleans to bool, arrays to tuples, references to
+  object paths and missing values to None.
+  """
 
-  def __setattr__ (self, attribute, value):
-    """If the attribute to be set is valid for the proxied
-    COM object, set that objects's parameter value; if not,
-    raise an exception.
-    """
-    try:
-      if attribute in self.properties:
-        self._cached_properties (attribute).set (value)
-        if self.ole_object.Path_.Path:
-          self.ole_object.Put_ ()
-      else:
-        raise AttributeError (attribute)
-    except pywintypes.com_error:
-      handle_com_error ()
+  def __init__ (self):
+    self.class_name = None
+    self.row = {}
+    self._qualifier_depth = 0
+    self._property = None
+    self._type = None
+    self._array = None
+    self._text = None
+    self._paths = []
+
+  def read (self, text):
+    parser = xml.parsers.expat.ParserCreate ()
+    parser.buffer_text = True
+    parser.StartElementHandler = self._start
+    parser.EndElementHandler = self._end
+    parser.CharacterDataHandler = self._data
+    parser.Parse (_xml_declaration.sub ("", text), True)
+    return self.class_name, self.row
+
+  def _start (self, name, attributes):
+    if name == "QUALIFIER":
+      self._qualifier_depth += 1
+    elif self._qualifier_depth:
+      pass
+    elif name in ("VALUE", "KEYVALUE", "HOST"):
+      self._text = []
+      if name == "KEYVALUE":
+        self._paths[-1]["value_type"] = attributes.get ("VALUETYPE", "string")
+    elif name in ("PROPERTY", "PROPERTY.ARRAY", "PROPERTY.REFERENCE"):
+      self._property = attributes["NAME"]
+      self._type = attributes.get ("TYPE", "reference")
+      self.row[self._property] = None
+    elif name == "VALUE.ARRAY" or name == "VALUE.REFARRAY":
+      self._array = []
+    elif name == "VALUE.NULL":
+      if self._array is not None:
+        self._array.append (None)
+    elif name == "VALUE.REFERENCE":
+      self._paths.append (dict (host=None, namespace=[], keys=[], key=None, value_type=None))
+    elif name == "NAMESPACE" and self._paths:
+      self._paths[-1]["namespace"].append (attributes["NAME"])
+    elif name in ("INSTANCENAME", "CLASSNAME") and self._paths:
+      self._paths[-1]["class"] = attributes.get ("CLASSNAME", attributes.get ("NAME"))
+    elif name == "KEYBINDING":
+      self._paths[-1]["key"] = attributes["NAME"]
+    elif name in ("INSTANCE", "CLASS") and self.class_name is None:
+      self.class_name = attributes.get ("CLASSNAME", attributes.get ("NAME"))
+
+  def _end (self, name):
+    if name == "QUALIFIER":
+      self._qualifier_depth -= 1
+    elif self._qualifier_depth:
+      pass
+    elif name == "VALUE":
+      value = _cim_value (self._type, "".join (self._text))
+      self._text = None
+      if self._array is not None:
+        self._array.append (value)
+      elif self._property is not None:
+        self.row[self._property] = value
+    elif name == "KEYVALUE":
+      path = self._paths[-1]
+      path["keys"].append ((path["key"], "".join (self._text), path["value_type"]))
+      self._text = None
+    elif name == "HOST":
+      self._paths[-1]["host"] = "".join (self._text)
+      self._text = None
+    elif name == "VALUE.REFERENCE":
+      value = _cim_path (self._paths.pop ())
+      if self._paths:
+        path = self._paths[-1]
+        path["keys"].append ((path["key"], value, "reference"))
+      elif self._array is not None:
+        self._array.append (value)
+      elif self._property is not None:
+        self.row[self._property] = value
+    elif name == "VALUE.ARRAY" or name == "VALUE.REFARRAY":
+      self.row[self._property] = tuple (self._array)
+      self._array = None
+    elif name in ("PROPERTY", "PROPERTY.ARRAY", "PROPERTY.REFERENCE"):
+      self._property = self._type = None
+
+  def _data (self, data):
+    if self._text is not None:
+      self._text.append (data)
+
+def _text_row (ole_object):
+  """Fetch all the property values of a WMI object in one call to
+  `GetText_`, returning a dictionary of property name to value.
+  """
+  return _cim_xml_reader ().read (ole_object.GetText_ (constants.wbemObjectTextFormatCIMDTD20))[1]
 
-  def __eq__ (self, other):
-    return self.id == other.id
+def _row_value (row, name):
+  """Look up a property in a row read by :func:`_text_row`, falling
+  back to a case-insensitive match as WMI itself would.
+  """
+  try:
+    return row[name]
+  except KeyError:
+    lower_name = name.lower ()
+    for key, value in row.items ():
+      if key.lower () == lower_name:
+        return value
+    raise
+
+#
+# WQL predicates
+#
+def _dmtf_time (value):
+  """Render a datetime -- or a date, taken as its midnight -- as a WMI
+  (DMTF) datetime string by way of :func:`from_time`. A datetime with a
+  timezone keeps its offset from UTC; one without is taken to be UTC.
+  """
+  if not isinstance (value, datetime.datetime):
+    value = datetime.datetime (value.year, value.month, value.day)
+  offset = value.utcoffset ()
+  if offset is None:
+    minutes = 0
+  else:
+    minutes = offset.days * 24 * 60 + offset.seconds // 60
+  return from_time (
+    value.year, value.month, value.day,
+    value.hour, value.minute, value.second, value.microsecond,
+    minutes
+  )
+
+def _wql_literal (value):
+  """Render a Python value as a WQL literal, escaping the quotes and
+  backslashes in a string as WMI expects and giving datetimes as DMTF
+  strings. Raise :exc:`x_wmi` for a value which can't be a literal.
+  """
+  if value is None:
+    return "NULL"
+  elif isinstance (value, bool):
+    return value and "TRUE" or "FALSE"
+  elif isinstance (value, numbers.Number):
+    return str (value)
+  elif isinstance (value, datetime.date):
+    return "'%s'" % _dmtf_time (value)
+  elif isinstance (value, _string_types):
+    return "'%s'" % value.replace ("\\", "\\\\").replace ("'", "\\'")
+  else:
+    raise x_wmi ("%r can't be used as a WQL value" % (value,))
+
+_wql_name = re.compile (r"^\w+(\.\w+)*$")
+
+class Field (object):
+  """A property to be tested in a WHERE clause. Comparing a field with
+  a value, or calling one of its methods, makes a condition which can be
+  combined with others using `&`, `|` and `~` and passed as the `where`
+  parameter of :meth:`_wmi_namespace.query`, the `fetch_as_*` methods,
+  :meth:`_wmi_class.query` and the `watch_for` methods::
+
+    import wmi
+    from wmi import Field
+
+    c = wmi.WMI ()
+    big = (Field ("WorkingSetSize") > 1024 ** 3) & ~Field ("Name").like ("svchost%")
+    for process in c.Win32_Process (where=big):
+      print process.Name
+
+  Values are rendered as WQL literals, with quotes and backslashes in
+  strings escaped, so the filtering is done by WMI rather than after the
+  results have been returned. Comparing with None tests for NULL.
+  """
+
+  def __init__ (self, name):
+    if not _wql_name.match (name):
+      raise x_wmi ("%r is not a valid property name" % name)
+    self.name = name
+
+  def __repr__ (self):
+    return "<Field: %s>" % self.name
 
   def __hash__ (self):
-    return hash (self.id)
+    return hash (self.name)
 
-  def _getAttributeNames (self):
-     """Return list of methods/properties for IPython completion"""
-     attribs = [str (x) for x in self.methods.keys ()]
-     attribs.extend ([str (x) for x in self.properties.keys ()])
-     return attribs
+  def __eq__ (self, value):
+    if value is None:
+      return self.is_null ()
+    return _wmi_comparison (self.name, "=", value)
 
-  def _get_keys (self):
-    """A WMI object is uniquely defined by a set of properties
-    which constitute its keys. Lazily retrieves the keys for this
-    instance or class.
+  def __ne__ (self, value):
+    if value is None:
+      return self.is_not_null ()
+    return _wmi_comparison (self.name, "<>", value)
 
-    :returns: list of key property names
-    """
-    # NB You can get the keys of an instance more directly, via
-    # Path\_.Keys but this doesn't apply to classes. The technique
-    # here appears to work for both.
-    if self._keys is None:
-      _set (self, "_keys", [])
-      for property in self.ole_object.Properties_:
-        for qualifier in property.Qualifiers_:
-          if qualifier.Name == "key" and qualifier.Value:
-            self._keys.append (property.Name)
-    return self._keys
-  keys = property (_get_keys)
+  def __lt__ (self, value):
+    return _wmi_comparison (self.name, "<", value)
 
-  def wmi_property (self, property_name):
-    """Return the cached object representing one property
-    of this object
+  def __le__ (self, value):
+    return _wmi_comparison (self.name, "<=", value)
+
+  def __gt__ (self, value):
+    return _wmi_comparison (self.name, ">", value)
+
+  def __ge__ (self, value):
+    return _wmi_comparison (self.name, ">=", value)
+
+  def like (self, pattern):
+    """Match a pattern in which `%` stands for any run of characters
+    and `_` for any one character.
     """
-    return _wmi_property (self.ole_object.Properties_ (property_name))
+    return _wmi_comparison (self.name, "LIKE", pattern)
 
-  def put (self):
-    """Push all outstanding property updates back to the
-    WMI database.
+  def is_null (self):
+    return _wmi_comparison (self.name, "IS", None)
+
+  def is_not_null (self):
+    return _wmi_comparison (self.name, "IS NOT", None)
+
+  def isa (self, class_name):
+    """Test whether an embedded object is of `class_name` or a subclass of it"""
+    return _wmi_comparison (self.name, "ISA", class_name)
+
+  def test (self, function):
+    """Pass the property's value to `function`. This can't be expressed in
+    WQL so is evaluated on each object returned; see :meth:`_wmi_class.filter`.
     """
-    self.ole_object.Put_ ()
+    return _wmi_test (function, self.name)
 
-  def set (self, **kwargs):
-    """Set several properties of the underlying object
-    at one go. This is particularly useful in combination
-    with the new () method below. However, an instance
-    which has been spawned in this way won't have enough
-    information to write pack, so only try if the
-    instance has a path.
+  def matches (self, pattern, flags=re.I):
+    """Search the property's value for a regular expression. Like
+    :meth:`test`, this is evaluated on each object returned. A value
+    which isn't a string, such as a number, is searched as its `str`.
     """
-    if kwargs:
-      try:
-        for attribute, value in kwargs.items ():
-          if attribute in self.properties:
-            self._cached_properties (attribute).set (value)
-          else:
-            raise AttributeError (attribute)
-        #
-        # Only try to write the attributes
-        #  back if the object exists.
-        #
-        if self.ole_object.Path_.Path:
-          self.ole_object.Put_ ()
-      except pywintypes.com_error:
-        handle_com_error ()
+    regex = re.compile (pattern, flags)
+    def matches (value):
+      if value is None:
+        return False
+      if not isinstance (value, _string_types):
+        value = str (value)
+      return bool (regex.search (value))
+    return _wmi_test (matches, self.name, "matches %r" % pattern)
+
+class _wmi_predicate (object):
+  """A condition in a WHERE clause, made from :class:`Field` objects.
+  Conditions which WQL can't express -- those made with :meth:`Field.test`,
+  :meth:`Field.matches` or :class:`Predicate` -- can only be used with
+  the `filter` methods, which work out what can be left to WMI.
+  """
 
-  def path (self):
-    """Return the WMI URI to this object. Can be used to
-    determine the path relative to the parent namespace::
+  def __and__ (self, other):
+    return _wmi_boolean ("AND", [self, other])
 
-      pp0 = wmi.WMI ().Win32_ParallelPort ()[0]
-      print pp0.path ().RelPath
+  def __or__ (self, other):
+    return _wmi_boolean ("OR", [self, other])
 
-    ..  Do more with this
-    """
-    try:
-      return self.ole_object.Path_
-    except pywintypes.com_error:
-      handle_com_error ()
+  def __invert__ (self):
+    return _wmi_not (self)
 
-  def derivation (self):
-    """Return a tuple representing the object derivation for
-    this object, with the most specific object first::
+  def __bool__ (self):
+    raise TypeError ("Conditions are combined with &, | and ~ rather than and, or and not")
+  __nonzero__ = __bool__
 
-      pp0 = wmi.WMI ().Win32_ParallelPort ()[0]
-      print ' <- '.join (pp0.derivation ())
+  def __str__ (self):
+    return self.describe ()
+
+  def __repr__ (self):
+    return "<%s: %s>" % (self.__class__.__name__, self.describe ())
+
+  def wql (self, prefix=""):
+    """Render the condition as WQL, with `prefix` -- eg "TargetInstance." --
+    put in front of each property name.
     """
-    try:
-      return self.ole_object.Derivation_
-    except pywintypes.com_error:
-      handle_com_error ()
+    return self._text (prefix, False)
 
-  def _cached_associated_classes (self):
-    if isinstance (self, _wmi_class):
-      obj = self
+  def describe (self):
+    """Render the condition as WQL so far as possible, describing any
+    part of it which WQL can't express.
+    """
+    return self._text ("", True)
+
+  def is_wql (self):
+    """Whether the whole condition can be expressed in WQL"""
+    return True
+
+  def names (self):
+    """The names of the properties the condition looks at, or None
+    if it may look at any of them.
+    """
+    return set ()
+
+  def evaluate (self, obj):
+    """Whether `obj` meets the condition, judged as WMI would judge it"""
+    raise NotImplementedError
+
+  def _text (self, prefix, describe):
+    raise NotImplementedError
+
+def _property_value (obj, name):
+  for part in name.split ("."):
+    if obj is None:
+      return None
+    obj = getattr (obj, part)
+  return obj
+
+def _like_pattern (pattern):
+  """Translate a WQL LIKE pattern to a regular expression"""
+  regex = []
+  n = 0
+  while n < len (pattern):
+    c = pattern[n]
+    if c == "%":
+      regex.append (".*")
+    elif c == "_":
+      regex.append (".")
+    elif c == "[" and "]" in pattern[n:]:
+      end = pattern.index ("]", n)
+      chars = pattern[n + 1:end]
+      if chars.startswith ("^"):
+        regex.append ("[^%s]" % re.escape (chars[1:]))
+      else:
+        regex.append ("[%s]" % re.escape (chars).replace ("\\-", "-"))
+      n = end
     else:
-      obj = self._instance_of
-    if obj._associated_classes is None:
+      regex.append (re.escape (c))
+    n += 1
+  return re.compile ("".join (regex) + r"\Z", re.I | re.S)
+
+try:
+  _string_types = (str, unicode)
+except NameError:
+  _string_types = (str,)
+
+def _comparable (actual, expected):
+  """Bring a property value and the value it's compared with to the same
+  footing: WMI returns 64-bit integers as strings -- read back as ints,
+  so no precision is lost -- and compares strings regardless of case.
+  """
+  if isinstance (expected, numbers.Number) and not isinstance (expected, bool) and isinstance (actual, _string_types):
+    for number in (int, float):
       try:
-        associated_classes = dict (
-          (assoc.Path_.Class, _wmi_class (self._namespace, assoc)) for
-            assoc in obj.ole_object.Associators_ (bSchemaOnly=True)
-        )
-        _set (obj, "_associated_classes", associated_classes)
-      except pywintypes.com_error:
-        handle_com_error ()
+        return number (actual), expected
+      except ValueError:
+        pass
+  if isinstance (actual, _string_types) and isinstance (expected, _string_types):
+    return actual.lower (), expected.lower ()
+  return actual, expected
+
+_comparisons = {
+  "=" : operator.eq,
+  "<>" : operator.ne,
+  "<" : operator.lt,
+  "<=" : operator.le,
+  ">" : operator.gt,
+  ">=" : operator.ge,
+}
 
-    return obj._associated_classes
-  associated_classes = property (_cached_associated_classes)
+class _wmi_comparison (_wmi_predicate):
 
-  def associators (self, wmi_association_class="", wmi_result_class=""):
-    """Return a list of objects related to this one, optionally limited
-    either by association class (ie the name of the class which relates
-    them) or by result class (ie the name of the class which would be
-    retrieved)::
+  def __init__ (self, name, operator, value):
+    if isinstance (value, (Field, _wmi_predicate)):
+      raise TypeError ("WQL can only compare a property with a value")
+    self.name = name
+    self.operator = operator
+    self.value = value
 
-      c = wmi.WMI ()
-      pp = c.Win32_ParallelPort ()[0]
+  def _text (self, prefix, describe):
+    if not isinstance (self.value, Param):
+      literal = _wql_literal (self.value)
+    elif describe:
+      literal = ":" + self.value.name
+    else:
+      #
+      # A slot to be filled in by a prepared query
+      #
+      literal = "\x00%s\x01%s\x00" % (self.value.name, self.name)
+    return "%s%s %s %s" % (prefix, self.name, self.operator, literal)
+
+  def names (self):
+    return set ([self.name])
+
+  def evaluate (self, obj):
+    actual = _property_value (obj, self.name)
+    if self.operator == "IS":
+      return actual is None
+    elif self.operator == "IS NOT":
+      return actual is not None
+    elif actual is None:
+      return False
+    elif self.operator == "LIKE":
+      return bool (_like_pattern (self.value).match (actual))
+    elif self.operator == "ISA":
+      if isinstance (actual, _wmi_snapshot):
+        class_names = [actual.class_name]
+      else:
+        class_names = [actual._schema.class_name] + list (actual.derivation ())
+      return self.value.lower () in [c.lower () for c in class_names]
+    else:
+      actual, expected = _comparable (actual, self.value)
+      try:
+        return _comparisons[self.operator] (actual, expected)
+      except TypeError:
+        return False
 
-      for i in pp.associators (wmi_association_class="Win32_PortResource"):
-        print i
+class _wmi_not (_wmi_predicate):
 
-      for i in pp.associators (wmi_result_class="Win32_PnPEntity"):
-        print i
+  def __init__ (self, predicate):
+    self.predicate = predicate
+
+  def _text (self, prefix, describe):
+    return "NOT (%s)" % self.predicate._text (prefix, describe)
+
+  def is_wql (self):
+    return self.predicate.is_wql ()
+
+  def names (self):
+    return self.predicate.names ()
+
+  def evaluate (self, obj):
+    return not self.predicate.evaluate (obj)
+
+class _wmi_boolean (_wmi_predicate):
+
+  def __init__ (self, operator, predicates):
+    self.operator = operator
+    self.predicates = []
+    for predicate in predicates:
+      if not isinstance (predicate, _wmi_predicate):
+        raise TypeError ("%r is not a condition" % (predicate,))
+      if isinstance (predicate, _wmi_boolean) and predicate.operator == operator:
+        self.predicates.extend (predicate.predicates)
+      else:
+        self.predicates.append (predicate)
+
+  def _text (self, prefix, describe):
+    parts = []
+    for predicate in self.predicates:
+      if isinstance (predicate, _wmi_boolean):
+        parts.append ("(%s)" % predicate._text (prefix, describe))
+      else:
+        parts.append (predicate._text (prefix, describe))
+    return (" %s " % self.operator).join (parts)
+
+  def is_wql (self):
+    return all (predicate.is_wql () for predicate in self.predicates)
+
+  def names (self):
+    names = set ()
+    for predicate in self.predicates:
+      more = predicate.names ()
+      if more is None:
+        return None
+      names.update (more)
+    return names
+
+  def evaluate (self, obj):
+    if self.operator == "AND":
+      return all (predicate.evaluate (obj) for predicate in self.predicates)
+    else:
+      return any (predicate.evaluate (obj) for predicate in self.predicates)
+
+class _wmi_test (_wmi_predicate):
+  """A condition evaluated in Python on each object WMI returns:
+  `function` is passed the value of property `name` or, if there's no
+  name, the object itself.
+  """
+
+  def __init__ (self, function, name=None, description=None):
+    self.function = function
+    self.name = name
+    self.description = description or getattr (function, "__name__", repr (function))
+
+  def _text (self, prefix, describe):
+    if not describe:
+      raise x_wmi ("%s can't be expressed in WQL: use filter rather than query" % self.describe ())
+    if self.name is None:
+      return "%s (object)" % self.description
+    else:
+      return "%s (%s)" % (self.description, self.name)
+
+  def is_wql (self):
+    return False
+
+  def names (self):
+    if self.name is None:
+      return None
+    return set ([self.name])
+
+  def evaluate (self, obj):
+    if self.name is None:
+      return bool (self.function (obj))
+    else:
+      return bool (self.function (_property_value (obj, self.name)))
+
+def Predicate (function):
+  """A condition which passes each object to `function`, to be used in a
+  filter alongside conditions made from :class:`Field` objects::
+
+    from wmi import Field, Predicate
+    suspicious = c.Win32_Process.filter (
+      (Field ("Name") == "svchost.exe") & Predicate (lambda p: not p.ExecutablePath.lower ().startswith ("c:\\\\windows"))
+    )
+  """
+  return _wmi_test (function)
+
+def _split_predicate (predicate):
+  """Split a condition into the part which can be sent to WMI and the
+  part which has to be evaluated here, either of which may be None.
+  Only the terms of an AND can be separated; anything else goes one
+  way or the other whole.
+  """
+  if predicate is None or predicate.is_wql ():
+    return predicate, None
+  if not (isinstance (predicate, _wmi_boolean) and predicate.operator == "AND"):
+    return None, predicate
+  pushed = [p for p in predicate.predicates if p.is_wql ()]
+  residual = [p for p in predicate.predicates if not p.is_wql ()]
+  def combined (predicates):
+    if not predicates:
+      return None
+    elif len (predicates) == 1:
+      return predicates[0]
+    else:
+      return _wmi_boolean ("AND", predicates)
+  return combined (pushed), combined (residual)
+
+class _wmi_filter (object):
+  """The objects of a class which meet a condition, as returned by
+  :meth:`_wmi_class.filter`. Iterating over the filter runs the query,
+  yielding each matching object as it arrives; :meth:`explain` shows
+  which part of the condition is sent to WMI and which is applied here.
+  """
+
+  def __init__ (self, wmi_class, where, fields=[], timeout_ms=None):
+    self.wmi_class = wmi_class
+    self.where = where
+    self.pushed, self.residual = _split_predicate (where)
+    fields = list (fields)
+    if fields and self.residual is not None:
+      names = self.residual.names ()
+      if names is None:
+        fields = []
+      else:
+        fields.extend (sorted (name.split (".")[0] for name in names if name.split (".")[0] not in fields))
+    self.fields = fields
+    self.timeout_ms = timeout_ms
+    self.n_fetched = self.n_passed = 0
+
+  def __repr__ (self):
+    return "<_wmi_filter: %s>" % self.wql
+
+  def _get_wql (self):
+    wql = self.wmi_class._query_wql (self.fields, {})
+    if self.pushed is not None:
+      wql = _add_where (wql, self.pushed.wql ())
+    return wql
+  wql = property (_get_wql)
+
+  def __iter__ (self):
+    namespace = self.wmi_class._namespace
+    if namespace is None:
+      raise x_wmi_no_namespace ("You cannot query directly from a WMI class")
+    wql = self.wmi_class._query_wql (self.fields, {})
+    self.n_fetched = self.n_passed = 0
+    for obj in namespace.iquery (wql, self.wmi_class, self.fields, self.timeout_ms, self.pushed):
+      self.n_fetched += 1
+      if self.residual is None or self.residual.evaluate (obj):
+        self.n_passed += 1
+        yield obj
+
+  def explain (self):
+    """Return a description of how the filter is run: the WQL sent to
+    WMI, the condition applied to what comes back and, once it has been
+    run, how many objects were fetched and how many passed.
     """
+    lines = [
+      "Query: %s" % self.wql,
+      "Sent to WMI: %s" % (self.pushed is None and "(nothing)" or self.pushed.describe ()),
+      "Applied here: %s" % (self.residual is None and "(nothing)" or self.residual.describe ()),
+    ]
+    if self.n_fetched:
+      lines.append ("Objects: %d fetched, %d passed" % (self.n_fetched, self.n_passed))
+    return "\n".join (lines)
+
+class Param (object):
+  """A placeholder for a value in a condition which is to be prepared
+  with :meth:`_wmi_class.prepare` and given its value each time the
+  prepared query is run::
+
+    from wmi import Field, Param
+    by_name = c.Win32_Service.prepare (["Name", "State"], where=Field ("Name") == Param ("name"))
+    for name in ["Spooler", "W32Time"]:
+      print by_name (name=name)
+  """
+
+  def __init__ (self, name):
+    if not re.match (r"^\w+$", name):
+      raise x_wmi ("%r is not a valid parameter name" % name)
+    self.name = name
+
+  def __repr__ (self):
+    return "<Param: %s>" % self.name
+
+def _bound_literal (name, value, cimtype):
+  """Render the value bound to parameter `name` as a WQL literal of the
+  property's CIM type, raising :exc:`x_wmi` if it can't be one.
+  """
+  try:
+    if value is None:
+      return "NULL"
+    elif cimtype in _CIM_INTEGER_TYPES:
+      if isinstance (value, (bool, float)):
+        raise ValueError
+      value = int (value)
+      if value < 0 and cimtype.startswith ("uint"):
+        raise ValueError
+      return str (value)
+    elif cimtype in _CIM_REAL_TYPES:
+      if isinstance (value, bool):
+        raise ValueError
+      return repr (float (value))
+    elif cimtype == "boolean":
+      if not isinstance (value, (bool, int)):
+        raise ValueError
+      return _wql_literal (bool (value))
+    elif cimtype == "datetime" and isinstance (value, datetime.date):
+      return _wql_literal (_dmtf_time (value))
+    elif cimtype == "datetime" and not isinstance (value, _string_types):
+      raise ValueError
+    elif cimtype and not isinstance (value, _string_types):
+      return _wql_literal (str (value))
+    else:
+      return _wql_literal (value)
+  except ValueError:
+    raise x_wmi ("Parameter %s can't be %r: it must be %s" % (name, value, cimtype))
+
+class _wmi_prepared_query (object):
+  """A query against a class which has been checked against the class's
+  schema and compiled once, so that running it again with different
+  parameter values costs no more than slotting them in. Returned by
+  :meth:`_wmi_class.prepare`.
+  """
+
+  def __init__ (self, wmi_class, fields=[], where=None):
+    self.wmi_class = wmi_class
+    schema = wmi_class._schema
+    self._names = dict ((name.lower (), name) for name in schema.properties)
+    self._types = dict ((name.lower (), cimtype) for (name, cimtype) in schema.types.items ())
+    self.fields = [self._property (field) for field in fields]
+    if where is not None:
+      if not where.is_wql ():
+        raise x_wmi ("%s can't be expressed in WQL so can't be prepared" % where.describe ())
+      for name in where.names ():
+        self._property (name.split (".")[0])
+    self.where = where
+    self._wql = wmi_class._query_wql (self.fields, {})
+    self._templates = {}
+    if where is None:
+      self.parameters = []
+    else:
+      self.parameters = sorted (set (name for (name, cimtype) in self._template ("")[1::2]))
+
+  def __repr__ (self):
+    return "<_wmi_prepared_query: %s>" % (self.where is None and self._wql or _add_where (self._wql, self.where.describe ()))
+
+  def _property (self, name):
     try:
-      return [
-        _wmi_object (i) for i in \
-          self.ole_object.Associators_ (
-           strAssocClass=wmi_association_class,
-           strResultClass=wmi_result_class
-         )
-      ]
-    except pywintypes.com_error:
-      handle_com_error ()
+      return self._names[name.lower ()]
+    except KeyError:
+      raise x_wmi ("%s has no property %s" % (self.wmi_class._class_name, name))
 
-  def references (self, wmi_class=""):
-    """Return a list of associations involving this object, optionally
-    limited by the result class (the name of the association class).
+  def _template (self, prefix):
+    """The condition as alternating runs of WQL and (parameter, CIM type)
+    slots, compiled once for each property prefix.
+    """
+    template = self._templates.get (prefix)
+    if template is None:
+      template = self.where.wql (prefix).split ("\x00")
+      for n in range (1, len (template), 2):
+        name, property_name = template[n].split ("\x01")
+        template[n] = (name, self._types.get (property_name.split (".")[0].lower ()))
+      self._templates[prefix] = template
+    return template
+
+  def _bind (self, params, prefix=""):
+    """Return the condition with `params` slotted in, or None if there's
+    no condition.
+    """
+    missing = [name for name in self.parameters if name not in params]
+    if missing:
+      raise x_wmi ("No value given for %s" % ", ".join (missing))
+    unknown = [name for name in params if name not in self.parameters]
+    if unknown:
+      raise x_wmi ("No parameter %s" % ", ".join (sorted (unknown)))
+    if self.where is None:
+      return None
+    template = self._template (prefix)
+    parts = list (template)
+    for n in range (1, len (parts), 2):
+      name, cimtype = template[n]
+      parts[n] = _bound_literal (name, params[name], cimtype)
+    return "".join (parts)
+
+  def wql (self, **params):
+    """Return the WQL which would be run with these parameter values"""
+    where = self._bind (params)
+    if where is None:
+      return self._wql
+    return _add_where (self._wql, where)
+
+  def query (self, timeout_ms=None, **params):
+    """Run the query with these parameter values and return a list of
+    the matching instances.
+    """
+    namespace = self.wmi_class._namespace
+    if namespace is None:
+      raise x_wmi_no_namespace ("You cannot query directly from a WMI class")
+    return namespace.query (self._wql, self.wmi_class, self.fields, timeout_ms, self._bind (params))
 
-    NB Associations are treated specially; although WMI only returns
-    the string corresponding to the instance of each associated object,
-    this module will automatically convert that to the object itself::
+  __call__ = query
 
-      c =  wmi.WMI ()
-      sp = c.Win32_SerialPort ()[0]
+  def iquery (self, timeout_ms=None, **params):
+    """As :meth:`query`, but yielding each instance as WMI returns it"""
+    namespace = self.wmi_class._namespace
+    if namespace is None:
+      raise x_wmi_no_namespace ("You cannot query directly from a WMI class")
+    return namespace.iquery (self._wql, self.wmi_class, self.fields, timeout_ms, self._bind (params))
 
-      for i in sp.references ():
-        print i
+  def fetch_as_lists (self, timeout_ms=None, **params):
+    """As :meth:`query`, but returning a list of the values of the
+    prepared fields -- or of every property, if none were given -- for
+    each instance; see :meth:`_wmi_namespace.fetch_as_lists`.
+    """
+    namespace = self.wmi_class._namespace
+    if namespace is None:
+      raise x_wmi_no_namespace ("You cannot query directly from a WMI class")
+    fields = self.fields or self.wmi_class._schema.properties
+    return namespace.fetch_as_lists (self.wmi_class._class_name, fields, timeout_ms, self._bind (params))
 
-      for i in sp.references (wmi_class="Win32_SerialPortSetting"):
-        print i
+  def watch_for (self, notification_type="operation", delay_secs=1, **params):
+    """Watch for events on instances of the class which meet the condition
+    with these parameter values; see :meth:`_wmi_namespace.watch_for`.
     """
-    #
-    # FIXME: Allow an actual class to be passed in, using
-    # its .Path_.RelPath property to determine the string
-    #
-    try:
-      return [_wmi_object (i) for i in self.ole_object.References_ (strResultClass=wmi_class)]
-    except pywintypes.com_error:
-      handle_com_error ()
+    if "__ExtrinsicEvent" in self.wmi_class.derivation ():
+      prefix = ""
+    else:
+      prefix = "TargetInstance."
+    return self.wmi_class.watch_for (
+      notification_type, delay_secs, self.fields, where=self._bind (params, prefix)
+    )
 
-#
-# class _wmi_event
-#
-class _wmi_event (_wmi_object):
-  """Slight extension of the _wmi_object class to allow
-  objects which are the result of events firing to return
-  extra information such as the type of event.
+def _where_wql (where, prefix=""):
+  """Render the `where` parameter -- a condition made from :class:`Field`
+  objects or a string of WQL -- ready to be added to a WHERE clause.
   """
-  event_type_re = re.compile ("__Instance(Creation|Modification|Deletion)Event")
-  def __init__ (self, event, event_info, fields=[]):
-    _wmi_object.__init__ (self, event, fields=fields)
-    _set (self, "event_type", None)
-    _set (self, "timestamp", None)
-    _set (self, "previous", None)
+  if isinstance (where, _wmi_predicate):
+    wql = where.wql (prefix)
+    if "\x00" in wql:
+      raise x_wmi ("%s has parameters: use it with _wmi_class.prepare" % where.describe ())
+    return wql
+  else:
+    return where
 
-    if event_info:
-      event_type = self.event_type_re.match (event_info.Path_.Class).group (1).lower ()
-      _set (self, "event_type", event_type)
-      if hasattr (event_info, "TIME_CREATED"):
-        _set (self, "timestamp", from_1601 (event_info.TIME_CREATED))
-      if hasattr (event_info, "PreviousInstance"):
-        _set (self, "previous", event_info.PreviousInstance)
+def _add_where (wql, condition):
+  """Add `condition` to the WHERE clause of `wql`, making one if needed.
+  The query is split into tokens as for the query cache, so the word
+  "where" inside a quoted literal isn't taken for the keyword.
+  """
+  for token in _wql_tokens.finditer (wql):
+    if token.group ().lower () == "where":
+      head, tail = wql[:token.start ()].rstrip (), wql[token.end ():].lstrip ()
+      return "%s WHERE (%s) AND (%s)" % (head, tail, condition)
+  return "%s WHERE %s" % (wql, condition)
+
+def _escaped_wql (wql, where=None):
+  """Double up the backslashes in `wql` as WMI expects and add the
+  condition `where`, whose literals are already escaped, to it.
+  """
+  wql = wql.replace ("\\", "\\\\")
+  if where is not None:
+    wql = _add_where (wql, _where_wql (where))
+  return wql
 
 #
-# class _wmi_class
+# class QueryCache
 #
-class _wmi_class (_wmi_object):
-  """Currying class to assist in issuing queries against
-   a WMI namespace. The idea is that when someone issues
-   an otherwise unknown method against the WMI object, if
-   it matches a known WMI class a query object will be
-   returned which may then be called with one or more params
-   which will form the WHERE clause::
+_wql_tokens = re.compile (r"""'(?:[^'\\]|\\.)*'|"(?:[^"\\]|\\.)*"|[^\s'"]+""")
+_wql_class = re.compile (r"\bfrom\s+(\w+)", re.I)
 
-    c = wmi.WMI ()
-    c_drives = c.Win32_LogicalDisk (Name='C:')
+def _normalised_wql (wql):
+  """Reduce a WQL query to a canonical form so that queries differing
+  only in whitespace or the case of keywords and names are treated as
+  the same. String literals are left alone.
   """
-  def __init__ (self, namespace, wmi_class):
-    _wmi_object.__init__ (self, wmi_class)
-    _set (self, "_class_name", wmi_class.Path_.Class)
-    if namespace:
-      _set (self, "_namespace", namespace)
-    else:
-      class_moniker = wmi_class.Path_.DisplayName
-      winmgmts, namespace_moniker, class_name = class_moniker.split (":")
-      namespace = _wmi_namespace (GetObject (winmgmts + ":" + namespace_moniker), False)
-      _set (self, "_namespace", namespace)
+  return " ".join ([
+    token if token[0] in "'\"" else token.lower () for token in _wql_tokens.findall (wql)
+  ])
 
-  def __getattr__ (self, attribute):
-    try:
-      if attribute in self.properties:
-        return _wmi_property (self.Properties_ (attribute))
-      else:
-        return _wmi_object.__getattr__ (self, attribute)
-    except pywintypes.com_error:
-      handle_com_error ()
+def _approximate_size (results):
+  """A rough guide to the memory held by a list of query results: the
+  list itself plus the dictionaries and cached values of its objects.
+  """
+  size = sys.getsizeof (results)
+  for result in results:
+    size += sys.getsizeof (result.__dict__) + sys.getsizeof (getattr (result, "id", ""))
+    for value in (getattr (result, "_row", None) or {}).values ():
+      size += sys.getsizeof (value)
+  return size
+
+_thread_tokens = threading.local ()
+def _thread_token ():
+  """Return an object unique to the calling thread. Unlike a thread's
+  ident, it's never reused for another thread while anything holds it.
+  """
+  token = getattr (_thread_tokens, "token", None)
+  if token is None:
+    token = _thread_tokens.token = object ()
+  return token
+
+class QueryCache (object):
+  """Holds the results of recent queries so that the same query
+  against the same namespace can be answered without going back to WMI.
+  Pass one to :func:`WMI` and every call to :meth:`_wmi_namespace.query`
+  or :meth:`_wmi_class.query` will look here first::
+
+    cache = wmi.QueryCache (ttl_secs=30, class_ttls={"Win32_Service" : 5})
+    c = wmi.WMI ("remote", query_cache=cache)
+    for disk in c.Win32_LogicalDisk ():
+      print disk.Caption
+    print cache.hits, cache.misses
+
+  Results are kept for `ttl_secs`, or the class's own entry in
+  `class_ttls`. Once more than `max_entries` are held, or their
+  approximate size exceeds `max_bytes`, the least recently used are
+  discarded. A cache hit returns a new list holding the same objects as
+  the original query. Streaming queries (`iquery`) are not cached.
+
+  Those objects hold COM pointers which belong to the thread -- strictly,
+  the apartment -- which ran the query, so each thread has results of
+  its own: the same query from another thread goes to WMI. Connections
+  as different users or with different authorities are kept apart too.
+  """
 
+  def __init__ (self, ttl_secs=60, class_ttls=None, max_entries=1000, max_bytes=None, clock=time.time):
+    self.ttl_secs = ttl_secs
+    self.class_ttls = dict ((k.lower (), v) for (k, v) in (class_ttls or {}).items ())
+    self.max_entries = max_entries
+    self.max_bytes = max_bytes
+    self.clock = clock
+    self.hits = self.misses = self.evictions = 0
+    self.n_bytes = 0
+    self._entries = {}
+    self._tick = 0
+    self._lock = threading.Lock ()
 
-  def to_csv (self, filepath=None):
-    """Generate a csv listing all the instances of this class with the class
-    name as a header.
+  def __repr__ (self):
+    return "<QueryCache: %d entries, %d hits, %d misses>" % (len (self), self.hits, self.misses)
+
+  def __len__ (self):
+    return len (self._entries)
+
+  def key (self, location, wql, fields=()):
+    """Return the key under which the results of `wql` against the
+    namespace at `location` are cached for the calling thread.
     """
-    def _to_utf8 (item):
-      return item.encode ("utf8") if isinstance (item, unicode) else str (item)
-    if filepath is None:
-      filepath = self._class_name + ".csv"
-    fields = list (p.Name for p in self.ole_object.Properties_)
-    with open (filepath, "wb") as f:
-      writer = csv.writer (f)
-      writer.writerow (fields)
-      for instance in self.query ():
-        writer.writerow ([_to_utf8 (getattr (instance, field)) for field in fields])
+    return (location, _thread_token (), _normalised_wql (wql), tuple ([f.lower () for f in fields]))
 
-  def query (self, fields=[], **where_clause):
-    """Make it slightly easier to query against the class,
-     by calling the namespace's query with the class preset.
-     Won't work if the class has been instantiated directly.
+  def get (self, key):
+    """Return a copy of the results held for `key` or None if there
+    are none or they have expired.
     """
-    #
-    # FIXME: Not clear if this can ever happen
-    #
-    if self._namespace is None:
-      raise x_wmi_no_namespace ("You cannot query directly from a WMI class")
+    self._lock.acquire ()
+    try:
+      entry = self._entries.get (key)
+      if entry is not None and entry["expires"] <= self.clock ():
+        self._remove (key)
+        entry = None
+      if entry is None:
+        self.misses += 1
+        return None
+      self.hits += 1
+      self._tick += 1
+      entry["used"] = self._tick
+      return list (entry["results"])
+    finally:
+      self._lock.release ()
+
+  def put (self, key, wql, results):
+    """Hold `results` under `key` for as long as the TTL of the class
+    which `wql` selects from allows.
+    """
+    match = _wql_class.search (wql)
+    class_name = match and match.group (1).lower ()
+    ttl_secs = self.class_ttls.get (class_name, self.ttl_secs)
+    if ttl_secs <= 0:
+      return
+    size = _approximate_size (results)
+    if self.max_bytes is not None and size > self.max_bytes:
+      return
+    self._lock.acquire ()
+    try:
+      if key in self._entries:
+        self._remove (key)
+      self._tick += 1
+      self._entries[key] = dict (
+        class_name=class_name,
+        results=list (results),
+        size=size,
+        expires=self.clock () + ttl_secs,
+        used=self._tick
+      )
+      self.n_bytes += size
+      while len (self._entries) > self.max_entries or \
+        (self.max_bytes is not None and self.n_bytes > self.max_bytes):
+        self._remove (min (self._entries, key=lambda k: self._entries[k]["used"]))
+        self.evictions += 1
+    finally:
+      self._lock.release ()
+
+  def invalidate (self, class_name=None):
+    """Discard the cached results of queries against `class_name` or,
+    if no class is given, everything in the cache.
+    """
+    self._lock.acquire ()
+    try:
+      for key, entry in list (self._entries.items ()):
+        if class_name is None or entry["class_name"] == class_name.lower ():
+          self._remove (key)
+    finally:
+      self._lock.release ()
+
+  def _remove (self, key):
+    self.n_bytes -= self._entries.pop (key)["size"]
 
+#
+# class AdaptiveProjection
+#
+_CIM_WIDTHS = dict (
+  sint8=1, uint8=1, sint16=2, uint16=2, sint32=4, uint32=4, sint64=8, uint64=8,
+  real32=4, real64=8, boolean=2, char16=2, datetime=50
+)
+_NOMINAL_WIDTH = 32
+
+class _wmi_call_site (object):
+  """The properties read from the results of queries made from one line
+  of the caller's code, and what selecting only those has saved.
+  """
+
+  def __init__ (self, projection, class_name, code_position):
+    self.projection = projection
+    self.class_name = class_name
+    self.code_position = code_position
+    self.fields = set ()
+    self.everything = False
+    self.n_runs = self.n_narrowed = self.n_objects = self.n_refetches = 0
+    self.n_skipped = self.n_bytes_skipped = 0
+    self._lock = threading.Lock ()
+
+  def __repr__ (self):
+    return "<_wmi_call_site: %s at %s:%d>" % ((self.class_name,) + self.code_position)
+
+  def projected_fields (self, schema):
+    """Return the fields the next query should select, or an empty list
+    if it should select them all.
+    """
+    if self.everything or self.n_runs < self.projection.learning_runs:
+      return []
+    wanted = set (schema.keys) | self.fields
+    if len (wanted) >= len (schema.properties):
+      return []
+    return [name for name in schema.properties if name in wanted]
+
+  def query (self, wmi_class, timeout_ms, where, where_clause):
+    schema = wmi_class._schema
+    namespace = wmi_class._namespace
+    fields = self.projected_fields (schema)
+    results = namespace.query (wmi_class._query_wql (fields, where_clause), wmi_class, fields, timeout_ms, where)
+    if fields:
+      skipped = [name for name in schema.properties if name not in fields]
+    else:
+      skipped = []
+    width = sum ([_CIM_WIDTHS.get (schema.types.get (name), _NOMINAL_WIDTH) for name in skipped])
+    self._lock.acquire ()
     try:
-      field_list = ", ".join (fields) or "*"
-      wql = "SELECT " + field_list + " FROM " + self._class_name
-      if where_clause:
-        wql += " WHERE " + " AND ". join (["%s = %r" % (k, str (v)) for k, v in where_clause.items ()])
-      return self._namespace.query (wql, self, fields)
-    except pywintypes.com_error:
-      handle_com_error ()
+      self.n_runs += 1
+      self.n_narrowed += bool (fields)
+      self.n_objects += len (results)
+      self.n_skipped += len (skipped) * len (results)
+      self.n_bytes_skipped += width * len (results)
+    finally:
+      self._lock.release ()
+    run = _wmi_projected_run (self, wmi_class, timeout_ms, where, where_clause, results)
+    for result in results:
+      _set (result, "_observer", run)
+    return results
 
-  __call__ = query
+  def read (self, attribute):
+    if attribute not in self.fields:
+      self._lock.acquire ()
+      try:
+        self.fields.add (attribute)
+      finally:
+        self._lock.release ()
 
-  def watch_for (
-    self,
-    notification_type="operation",
-    delay_secs=1,
-    fields=[],
-    **where_clause
-  ):
-    if self._namespace is None:
-      raise x_wmi_no_namespace ("You cannot watch directly from a WMI class")
+  def missed (self, attribute):
+    self._lock.acquire ()
+    try:
+      self.fields.add (attribute)
+    finally:
+      self._lock.release ()
 
-    valid_notification_types = ("operation", "creation", "deletion", "modification")
-    if notification_type.lower () not in valid_notification_types:
-      raise x_wmi ("notification_type must be one of %s" % ", ".join (valid_notification_types))
+  def wants_everything (self):
+    """Select every property from now on: the results have been
+    printed or frozen, which reads them all.
+    """
+    self.everything = True
 
-    return self._namespace.watch_for (
-      notification_type=notification_type,
-      wmi_class=self,
-      delay_secs=delay_secs,
-      fields=fields,
-      **where_clause
+  def refetched (self):
+    self._lock.acquire ()
+    try:
+      self.n_refetches += 1
+    finally:
+      self._lock.release ()
+
+  def stats (self):
+    return dict (
+      code_position="%s:%d" % self.code_position,
+      class_name=self.class_name,
+      fields=sorted (self.fields),
+      runs=self.n_runs,
+      narrowed_runs=self.n_narrowed,
+      objects=self.n_objects,
+      properties_skipped=self.n_skipped,
+      bytes_skipped=self.n_bytes_skipped,
+      refetches=self.n_refetches,
+      everything=self.everything
     )
 
-  def instances (self):
-    """Return a list of instances of the WMI class
+class _wmi_projected_run (object):
+  """The results of one narrowed query from a call site. The first time
+  any of them is found to be missing a property, the query is run again
+  selecting every property and each result takes on its whole object.
+  """
+
+  def __init__ (self, site, wmi_class, timeout_ms, where, where_clause, results):
+    self.site = site
+    self.wmi_class = wmi_class
+    self.timeout_ms = timeout_ms
+    self.where = where
+    self.where_clause = where_clause
+    self.results = results
+    self.completed = False
+    self._lock = threading.Lock ()
+
+  def complete (self):
+    """Fill in every result with all its properties, running the query
+    again once. Any result which the second run doesn't return is
+    fetched on its own by its path.
     """
+    self._lock.acquire ()
     try:
-      return [_wmi_object (instance, self) for instance in self.Instances_ ()]
+      if self.completed:
+        return
+      wmi_class = self.wmi_class
+      namespace = wmi_class._namespace
+      wholes = namespace.query (
+        wmi_class._query_wql ([], self.where_clause), wmi_class, [], self.timeout_ms, self.where
+      )
+      by_path = dict ((_normalised_path (whole.ole_object.Path_.Path), whole) for whole in wholes)
+      self.site.refetched ()
+      for result in self.results:
+        whole = by_path.get (_normalised_path (result.ole_object.Path_.Path))
+        if whole is None:
+          result._refetch (namespace)
+        else:
+          _set (result, "ole_object", whole.ole_object)
+          _set (result, "_row", None)
+          result._set_schema (whole._schema)
+      self.completed = True
+    finally:
+      self._lock.release ()
+
+class AdaptiveProjection (object):
+  """Learns which properties are read from the results of each class
+  query -- :meth:`_wmi_class.query` or calling the class -- telling the
+  queries apart by the line of code they're made from, and selects only
+  those properties next time. Pass one to :func:`WMI`::
+
+    projection = wmi.AdaptiveProjection ()
+    c = wmi.WMI ("remote", projection=projection)
+    for n in range (10):
+      for process in c.Win32_Process ():
+        print process.Name, process.ProcessId
+    print projection.stats ()
+
+  The first `learning_runs` queries from a line select every property
+  and note which are read; later ones select only those and the class's
+  keys. If a property which wasn't selected is read after all, the query
+  is run once more selecting every property, all its results are filled
+  in from that, and the property is selected from then on. Printing or
+  freezing a narrowed result fills it in the same way and has its line
+  select every property from then on. Queries which give their own
+  fields are left alone. Only reading properties through the object is
+  seen: going straight to its `ole_object` finds just the properties
+  which were selected.
+  """
+
+  def __init__ (self, learning_runs=1):
+    self.learning_runs = learning_runs
+    self._sites = {}
+    self._lock = threading.Lock ()
+
+  def __repr__ (self):
+    return "<AdaptiveProjection: %d call sites>" % len (self._sites)
+
+  def site (self, location, class_name, code_position):
+    """Return the :class:`_wmi_call_site` for queries against `class_name`
+    in the namespace at `location` made from `code_position`, a
+    (filename, line number) pair.
+    """
+    key = (location, class_name.lower (), code_position)
+    self._lock.acquire ()
+    try:
+      site = self._sites.get (key)
+      if site is None:
+        site = self._sites[key] = _wmi_call_site (self, class_name, code_position)
+      return site
+    finally:
+      self._lock.release ()
+
+  def stats (self):
+    """Return a dictionary for each call site giving the properties now
+    selected; the number of runs, narrowed runs and objects returned; the
+    number of property values left out and a rough guide to their size
+    in bytes; the number of queries run again because a property which
+    was left out was read; and whether printing or freezing a result has
+    made the site select everything. Property values are read one at a
+    time as they're used whether or not the query selected them, so the
+    saving is in what the provider computes and sends rather than in
+    calls; each refetch costs one more query.
+    """
+    sites = sorted (self._sites.values (), key=lambda site: (site.code_position, site.class_name))
+    return [site.stats () for site in sites]
+
+#
+# class _wmi_object
+#
+class _wmi_object:
+  """The heart of the WMI module: wraps the objects returned by COM
+  ISWbemObject interface and provide readier access to their properties
+  and methods resulting in a more Pythonic interface. Not usually
+  instantiated directly, rather as a result of calling a :class:`_wmi_class`
+  on the parent :class:`_wmi_namespace`.
+
+  If you get hold of a WMI-related COM object from some other
+  source than this module, you can wrap it in one of these objects
+  to get the benefits of the module::
+
+    import win32com.client
+    import wmi
+
+    wmiobj = win32com.client.GetObject ("winmgmts:Win32_LogicalDisk.DeviceID='C:'")
+    c_drive = wmi._wmi_object (wmiobj)
+    print c_drive
+  """
+
+  #
+  # Set to the _wmi_projected_run for the results of queries
+  # narrowed by an AdaptiveProjection.
+  #
+  _observer = None
+
+  #
+  # The _wmi_namespace an object which isn't an instance of a known
+  # class came from, so that its associators use the same connection.
+  #
+  _origin = None
+
+  def __init__ (self, ole_object, instance_of=None, fields=[], property_map={}, schemas=None, xml_rows=False, namespace=None):
+    try:
+      path = ole_object.Path_
+      _set (self, "ole_object", ole_object)
+      _set (self, "id", path.DisplayName.lower ())
+      _set (self, "_instance_of", instance_of)
+      _set (self, "_origin", namespace)
+      _set (self, "property_map", property_map)
+      _set (self, "_associated_classes", None)
+      _set (self, "_xml_rows", xml_rows)
+      _set (self, "_row", None)
+      if schemas is None:
+        source = namespace
+        if source is None and instance_of is not None:
+          source = instance_of._namespace
+        if source is not None:
+          schemas = source._schemas
+      self._set_schema (_schema_for (ole_object, path, schemas), fields)
+
+    except pywintypes.com_error:
+      handle_com_error ()
+
+  def _set_schema (self, schema, fields=[]):
+    _set (self, "_schema", schema)
+    _set (self, "properties", dict.fromkeys (fields or schema.properties))
+    _set (self, "methods", dict.fromkeys (schema.methods))
+    _set (self, "_properties", self.properties.keys ())
+    _set (self, "_methods", self.methods.keys ())
+    _set (self, "qualifiers", schema.qualifiers)
+
+  def __lt__ (self, other):
+    return self.id < other.id
+
+  def __str__ (self):
+    """For a call to print [object] return the OLE description
+    of the properties / values of the object
+    """
+    try:
+      self._complete ()
+      return self.ole_object.GetObjectText_ ()
+    except pywintypes.com_error:
+      handle_com_error ()
+
+  def __repr__ (self):
+    """
+    Indicate both the fact that this is a wrapped WMI object
+    and the WMI object's own identifying class.
+    """
+    try:
+      return "<%s: %s>" % (self.__class__.__name__, self.Path_.Path.encode ("ascii", "backslashreplace"))
+    except pywintypes.com_error:
+      handle_com_error ()
+
+  def _cached_properties (self, attribute):
+    if self.properties[attribute] is None:
+      self.properties[attribute] = _wmi_property (
+        self.ole_object.Properties_ (attribute),
+        self._schema.property_qualifiers.get (attribute)
+      )
+    return self.properties[attribute]
+
+  def _cached_row (self):
+    if self._row is None:
+      _set (self, "_row", _text_row (self.ole_object))
+    return self._row
+
+  def _cached_methods (self, attribute):
+    if self.methods[attribute] is None:
+      self.methods[attribute] = _wmi_method (self.ole_object, attribute)
+    return self.methods[attribute]
+
+  def __getattr__ (self, attribute):
+    """
+    Attempt to pass attribute calls to the proxied COM object.
+    If the attribute is recognised as a property, return its value;
+    if it is recognised as a method, return a method wrapper which
+    can then be called with parameters; otherwise pass the lookup
+    on to the underlying object.
+    """
+    try:
+      if self._observer is not None:
+        run = self._observer
+        if attribute in self.properties:
+          run.site.read (attribute)
+        elif attribute in self._schema.types:
+          #
+          # A property the query didn't select: fill in the whole
+          # run and have the call site select it next time.
+          #
+          run.site.missed (attribute)
+          run.complete ()
+      if attribute in self.properties:
+        #
+        # In xml_rows mode all the object's values are read in
+        # one go the first time any of them is needed.
+        #
+        if self._xml_rows:
+          value = _row_value (self._cached_row (), attribute)
+          type = self._schema.types.get (attribute) or ""
+        else:
+          property = self._cached_properties (attribute)
+          value, type = property.value, property.type
+        factory = self.property_map.get (attribute, self.property_map.get (type, lambda x: x))
+        value = factory (value)
+        #
+        # If this is an association, certain of its properties
+        # are actually the paths to the aspects of the association,
+        # so translate them automatically into WMI objects.
+        #
+        if type.startswith ("ref:"):
+          return WMI (moniker=value)
+        else:
+          return value
+      elif attribute in self.methods:
+        return self._cached_methods (attribute)
+      else:
+        return getattr (self.ole_object, attribute)
+    except pywintypes.com_error:
+      handle_com_error ()
+
+  def __setattr__ (self, attribute, value):
+    """If the attribute to be set is valid for the proxied
+    COM object, set that objects's parameter value; if not,
+    raise an exception.
+    """
+    try:
+      if attribute in self.properties:
+        self._cached_properties (attribute).set (value)
+        _set (self, "_row", None)
+        if self.ole_object.Path_.Path:
+          self.ole_object.Put_ ()
+      else:
+        raise AttributeError (attribute)
+    except pywintypes.com_error:
+      handle_com_error ()
+
+  def __eq__ (self, other):
+    return self.id == other.id
+
+  def __hash__ (self):
+    return hash (self.id)
+
+  def _refetch (self, namespace):
+    """Replace an object fetched with only some of its properties by
+    the whole object, fetched from `namespace` by its path.
+    """
+    ole_object = namespace._namespace.Get (self.ole_object.Path_.Path)
+    _set (self, "ole_object", ole_object)
+    _set (self, "_row", None)
+    self._set_schema (_schema_for (ole_object, ole_object.Path_, namespace._schemas))
+
+  def _complete (self):
+    """Have the call site of an AdaptiveProjection which fetched this
+    object select every property from now on and, if this object was
+    fetched with only some of its properties, fill in the rest.
+    """
+    run = self._observer
+    if run is not None:
+      run.site.wants_everything ()
+      if len (self.properties) < len (self._schema.properties):
+        run.complete ()
+
+  def _getAttributeNames (self):
+     """Return list of methods/properties for IPython completion"""
+     attribs = [str (x) for x in self.methods.keys ()]
+     attribs.extend ([str (x) for x in self.properties.keys ()])
+     return attribs
+
+  def freeze (self):
+    """Return a :class:`_wmi_snapshot` of this object: a data-only copy
+    of its path, class and property values which can be pickled and
+    passed to another process. Only the properties this object was
+    fetched with are copied, read in one pass over the object; an
+    object narrowed by an :class:`AdaptiveProjection` is filled in first.
+    """
+    try:
+      self._complete ()
+      names = list (self.properties)
+      if self._xml_rows:
+        row = self._cached_row ()
+        raw = dict ((name, _row_value (row, name)) for name in names)
+      else:
+        wanted = set (names)
+        raw = dict ((p.Name, p.Value) for p in self.ole_object.Properties_ if p.Name in wanted)
+      cimtypes = [self._schema.types.get (name) for name in names]
+      return _wmi_snapshot (
+        self.id,
+        self.ole_object.Path_.Path,
+        self._schema.class_name,
+        names,
+        cimtypes,
+        [key for key in self._schema.keys if key in raw],
+        [_frozen_value (raw.get (name), cimtype) for (name, cimtype) in zip (names, cimtypes)]
+      )
+    except pywintypes.com_error:
+      handle_com_error ()
+
+  def _get_keys (self):
+    """A WMI object is uniquely defined by a set of properties
+    which constitute its keys. These are held in the schema shared
+    by all objects of this class.
+
+    :returns: list of key property names
+    """
+    # NB You can get the keys of an instance more directly, via
+    # Path\_.Keys but this doesn't apply to classes. The technique
+    # used by the schema appears to work for both.
+    return list (self._schema.keys)
+  keys = property (_get_keys)
+
+  def wmi_property (self, property_name):
+    """Return the cached object representing one property
+    of this object
+    """
+    return _wmi_property (self.ole_object.Properties_ (property_name))
+
+  def put (self):
+    """Push all outstanding property updates back to the
+    WMI database.
+    """
+    self.ole_object.Put_ ()
+
+  def set (self, **kwargs):
+    """Set several properties of the underlying object
+    at one go. This is particularly useful in combination
+    with the new () method below. However, an instance
+    which has been spawned in this way won't have enough
+    information to write pack, so only try if the
+    instance has a path.
+    """
+    if kwargs:
+      try:
+        for attribute, value in kwargs.items ():
+          if attribute in self.properties:
+            self._cached_properties (attribute).set (value)
+          else:
+            raise AttributeError (attribute)
+        #
+        # Only try to write the attributes
+        #  back if the object exists.
+        #
+        if self.ole_object.Path_.Path:
+          self.ole_object.Put_ ()
+      except pywintypes.com_error:
+        handle_com_error ()
+
+  def path (self):
+    """Return the WMI URI to this object. Can be used to
+    determine the path relative to the parent namespace::
+
+      pp0 = wmi.WMI ().Win32_ParallelPort ()[0]
+      print pp0.path ().RelPath
+
+    ..  Do more with this
+    """
+    try:
+      return self.ole_object.Path_
+    except pywintypes.com_error:
+      handle_com_error ()
+
+  def derivation (self):
+    """Return a tuple representing the object derivation for
+    this object, with the most specific object first::
+
+      pp0 = wmi.WMI ().Win32_ParallelPort ()[0]
+      print ' <- '.join (pp0.derivation ())
+    """
+    try:
+      return self.ole_object.Derivation_
+    except pywintypes.com_error:
+      handle_com_error ()
+
+  def _cached_associated_classes (self):
+    if isinstance (self, _wmi_class):
+      obj = self
+    else:
+      obj = self._instance_of
+    if obj._associated_classes is None:
+      try:
+        associated_classes = dict (
+          (assoc.Path_.Class, _wmi_class (self._namespace, assoc)) for
+            assoc in obj.ole_object.Associators_ (bSchemaOnly=True)
+        )
+        _set (obj, "_associated_classes", associated_classes)
+      except pywintypes.com_error:
+        handle_com_error ()
+
+    return obj._associated_classes
+  associated_classes = property (_cached_associated_classes)
+
+  def _source_namespace (self):
+    """The :class:`_wmi_namespace` this object came from, or None if
+    that isn't known.
+    """
+    if isinstance (self, _wmi_class):
+      return self._namespace
+    elif self._instance_of is not None:
+      return self._instance_of._namespace
+    else:
+      return self._origin
+
+  def _services (self):
+    """Return the :class:`_wmi_namespace` this object came from and the
+    SWbemServices for it. Reconnecting from the object's path would drop
+    any credentials the original connection used, so an object which
+    doesn't know its namespace raises :exc:`x_wmi_no_namespace`.
+    """
+    namespace = self._source_namespace ()
+    if namespace is None:
+      raise x_wmi_no_namespace ("%s doesn't know which connection it came from" % self.path ().RelPath)
+    return namespace, namespace._namespace
+
+  def associators (
+    self, wmi_association_class="", wmi_result_class="", role="", result_role="",
+    required_qualifier="", required_assoc_qualifier="", keys_only=False, class_defs_only=False
+  ):
+    """Return a list of objects related to this one, optionally limited
+    either by association class (ie the name of the class which relates
+    them) or by result class (ie the name of the class which would be
+    retrieved)::
+
+      c = wmi.WMI ()
+      pp = c.Win32_ParallelPort ()[0]
+
+      for i in pp.associators (wmi_association_class="Win32_PortResource"):
+        print i
+
+      for i in pp.associators (wmi_result_class="Win32_PnPEntity"):
+        print i
+
+    `role` and `result_role` name the reference property which points to
+    this object and to the result respectively, and `required_qualifier`
+    and `required_assoc_qualifier` a qualifier the result class or the
+    association class must have. If `class_defs_only` is true, the classes
+    of the associated objects are returned rather than the objects.
+
+    If `keys_only` is true, only the path and keys of each associated
+    object are fetched and each is returned as a :class:`_wmi_lazy_object`,
+    which fetches the rest only when it's needed. This is the way to go
+    from an object with many associations such as `Win32_ComputerSystem`,
+    which otherwise can take a very long time.
+    """
+    if keys_only:
+      namespace, services = self._services ()
+      wql = _association_wql ("ASSOCIATORS", self.ole_object.Path_.RelPath, [
+        ("AssocClass", wmi_association_class),
+        ("ResultClass", wmi_result_class),
+        ("Role", role),
+        ("ResultRole", result_role),
+        ("RequiredQualifier", required_qualifier),
+        ("RequiredAssocQualifier", required_assoc_qualifier),
+        ("KeysOnly", True),
+      ])
+      return _association_results (services, namespace, wql, keys_only, class_defs_only)
+    try:
+      results = self.ole_object.Associators_ (
+        strAssocClass=wmi_association_class,
+        strResultClass=wmi_result_class,
+        strResultRole=result_role,
+        strRole=role,
+        bClassesOnly=bool (class_defs_only),
+        strRequiredAssocQualifier=required_assoc_qualifier,
+        strRequiredQualifier=required_qualifier
+      )
+      if class_defs_only:
+        return [_wmi_class (self._source_namespace (), i) for i in results]
+      return [_wmi_object (i, namespace=self._source_namespace ()) for i in results]
+    except pywintypes.com_error:
+      handle_com_error ()
+
+  def references (self, wmi_class="", role="", required_qualifier="", keys_only=False, class_defs_only=False):
+    """Return a list of associations involving this object, optionally
+    limited by the result class (the name of the association class).
+
+    NB Associations are treated specially; although WMI only returns
+    the string corresponding to the instance of each associated object,
+    this module will automatically convert that to the object itself::
+
+      c =  wmi.WMI ()
+      sp = c.Win32_SerialPort ()[0]
+
+      for i in sp.references ():
+        print i
+
+      for i in sp.references (wmi_class="Win32_SerialPortSetting"):
+        print i
+
+    `role`, `required_qualifier`, `class_defs_only` and `keys_only` are as
+    for :meth:`associators`. With `keys_only`, the keys of each association
+    are the paths of the objects it relates, so associations can be
+    followed without fetching anything else.
+    """
+    #
+    # FIXME: Allow an actual class to be passed in, using
+    # its .Path_.RelPath property to determine the string
+    #
+    if keys_only:
+      namespace, services = self._services ()
+      wql = _association_wql ("REFERENCES", self.ole_object.Path_.RelPath, [
+        ("ResultClass", wmi_class),
+        ("Role", role),
+        ("RequiredQualifier", required_qualifier),
+        ("KeysOnly", True),
+      ])
+      return _association_results (services, namespace, wql, keys_only, class_defs_only)
+    try:
+      results = self.ole_object.References_ (
+        strResultClass=wmi_class,
+        strRole=role,
+        bClassesOnly=bool (class_defs_only),
+        strRequiredQualifier=required_qualifier
+      )
+      if class_defs_only:
+        return [_wmi_class (self._source_namespace (), i) for i in results]
+      return [_wmi_object (i, namespace=self._source_namespace ()) for i in results]
+    except pywintypes.com_error:
+      handle_com_error ()
+
+#
+# class _wmi_event
+#
+class _wmi_event (_wmi_object):
+  """Slight extension of the _wmi_object class to allow
+  objects which are the result of events firing to return
+  extra information such as the type of event.
+  """
+  event_type_re = re.compile ("__Instance(Creation|Modification|Deletion)Event")
+  def __init__ (self, event, event_info, fields=[], schemas=None):
+    _wmi_object.__init__ (self, event, fields=fields, schemas=schemas)
+    _set (self, "event_type", None)
+    _set (self, "timestamp", None)
+    _set (self, "previous", None)
+
+    if event_info:
+      event_type = self.event_type_re.match (event_info.Path_.Class).group (1).lower ()
+      _set (self, "event_type", event_type)
+      if hasattr (event_info, "TIME_CREATED"):
+        _set (self, "timestamp", from_1601 (event_info.TIME_CREATED))
+      if hasattr (event_info, "PreviousInstance"):
+        _set (self, "previous", event_info.PreviousInstance)
+
+def _class_query_wql (class_name, fields, where_clause):
+  """Build the query which :meth:`_wmi_class.query` makes of a class"""
+  field_list = ", ".join (fields) or "*"
+  wql = "SELECT " + field_list + " FROM " + class_name
+  if where_clause:
+    wql += " WHERE " + " AND ". join (["%s = %r" % (k, str (v)) for k, v in where_clause.items ()])
+  return wql
+
+#
+# class _wmi_class
+#
+class _wmi_class (_wmi_object):
+  """Currying class to assist in issuing queries against
+   a WMI namespace. The idea is that when someone issues
+   an otherwise unknown method against the WMI object, if
+   it matches a known WMI class a query object will be
+   returned which may then be called with one or more params
+   which will form the WHERE clause::
+
+    c = wmi.WMI ()
+    c_drives = c.Win32_LogicalDisk (Name='C:')
+  """
+  def __init__ (self, namespace, wmi_class, schema=None):
+    if wmi_class is None:
+      #
+      # The schema is already known, typically from a SchemaCache,
+      # so put off fetching the class itself until it's needed.
+      #
+      _set (self, "_instance_of", None)
+      _set (self, "property_map", {})
+      _set (self, "_associated_classes", None)
+      _set (self, "_xml_rows", False)
+      _set (self, "_row", None)
+      self._set_schema (schema)
+      _set (self, "_class_name", schema.class_name)
+      _set (self, "_namespace", namespace)
+      return
+
+    _wmi_object.__init__ (self, wmi_class, namespace=namespace)
+    _set (self, "_class_name", wmi_class.Path_.Class)
+    if namespace is not None:
+      _set (self, "_namespace", namespace)
+    else:
+      class_moniker = wmi_class.Path_.DisplayName
+      winmgmts, namespace_moniker, class_name = class_moniker.split (":")
+      namespace = _wmi_namespace (GetObject (winmgmts + ":" + namespace_moniker), False)
+      _set (self, "_namespace", namespace)
+
+  def _fetch_class (self):
+    """Fetch the COM object for a class created from a cached schema,
+    refreshing the schema -- here and in the cache -- if the class has
+    changed since it was cached.
+    """
+    try:
+      ole_object = self._namespace._namespace.Get (self._class_name)
+      path = ole_object.Path_
+      _set (self, "ole_object", ole_object)
+      _set (self, "id", path.DisplayName.lower ())
+      schema = _wmi_schema.from_ole_object (ole_object, path.Class)
+    except pywintypes.com_error:
+      handle_com_error ()
+    if schema.version != self._schema.version:
+      self._namespace._schemas[(path.Server, path.Namespace, path.Class)] = schema
+      self._set_schema (schema)
+      self._namespace._save_schema (schema, ole_object)
+
+  def __getattr__ (self, attribute):
+    if attribute in ("ole_object", "id"):
+      self._fetch_class ()
+      return self.__dict__[attribute]
+    try:
+      if attribute in self.properties:
+        return _wmi_property (self.Properties_ (attribute), self._schema.property_qualifiers.get (attribute))
+      else:
+        return _wmi_object.__getattr__ (self, attribute)
+    except pywintypes.com_error:
+      handle_com_error ()
+
+
+  def to_csv (self, filepath=None):
+    """Generate a csv listing all the instances of this class with the class
+    name as a header.
+    """
+    def _to_utf8 (item):
+      return item.encode ("utf8") if isinstance (item, unicode) else str (item)
+    if filepath is None:
+      filepath = self._class_name + ".csv"
+    fields = list (p.Name for p in self.ole_object.Properties_)
+    with open (filepath, "wb") as f:
+      writer = csv.writer (f)
+      writer.writerow (fields)
+      for instance in self.query ():
+        writer.writerow ([_to_utf8 (getattr (instance, field)) for field in fields])
+
+  def _query_wql (self, fields, where_clause):
+    return _class_query_wql (self._class_name, fields, where_clause)
+
+  def query (self, fields=[], timeout_ms=None, where=None, **where_clause):
+    """Make it slightly easier to query against the class,
+     by calling the namespace's query with the class preset.
+     Won't work if the class has been instantiated directly.
+     `timeout_ms` and `where` are as for :meth:`_wmi_namespace.query`.
+    """
+    if self._namespace is None:
+      raise x_wmi_no_namespace ("You cannot query directly from a WMI class")
+    projection = self._namespace._projection
+    if projection is not None and not fields:
+      caller = sys._getframe (1)
+      site = projection.site (
+        self._namespace._cache_location,
+        self._class_name,
+        (caller.f_code.co_filename, caller.f_lineno)
+      )
+      return site.query (self, timeout_ms, where, where_clause)
+    return self._namespace.query (self._query_wql (fields, where_clause), self, fields, timeout_ms, where)
+
+  __call__ = query
+
+  def query_async (self, fields=[], max_queued=1000, where=None, **where_clause):
+    """As :meth:`query` but run asynchronously.
+    See :meth:`_wmi_namespace.query_async`.
+    """
+    if self._namespace is None:
+      raise x_wmi_no_namespace ("You cannot query directly from a WMI class")
+    return self._namespace.query_async (self._query_wql (fields, where_clause), max_queued, where)
+
+  def prepare (self, fields=[], where=None, **where_clause):
+    """Prepare a query against this class to be run many times with
+    different values. The fields and the properties in the condition are
+    checked against the class's schema straightaway, and the WQL is built
+    once; each run only slots in the values of the :class:`Param`
+    placeholders in `where`, checked against the CIM types of the
+    properties they're compared with::
+
+      from wmi import Field, Param
+      c = wmi.WMI ()
+      children_of = c.Win32_Process.prepare (
+        ["ProcessId", "Name"],
+        where=Field ("ParentProcessId") == Param ("parent")
+      )
+      for process in children_of (parent=4):
+        print process.Name
+
+    Any `where_clause` keyword arguments are ANDed with `where`, and may
+    be placeholders too. See :class:`_wmi_prepared_query` for how to run
+    the prepared query.
+    """
+    conditions = [Field (name) == value for (name, value) in sorted (where_clause.items ())]
+    if where is not None:
+      conditions.append (where)
+    if not conditions:
+      where = None
+    elif len (conditions) == 1:
+      where = conditions[0]
+    else:
+      where = _wmi_boolean ("AND", conditions)
+    return _wmi_prepared_query (self, fields, where)
+
+  def filter (self, where, fields=[], timeout_ms=None):
+    """Return the instances of this class which meet `where`, a condition
+    made from :class:`Field` objects which may include tests, such as
+    :meth:`Field.test` or :class:`Predicate`, which WQL can't express.
+    The condition is split so that as much of it as possible is sent to
+    WMI, and the rest is applied to each object as it comes back::
+
+      from wmi import Field
+      c = wmi.WMI ()
+      big_java = c.Win32_Process.filter (
+        (Field ("WorkingSetSize") > 1024 ** 3) & Field ("CommandLine").matches (r"\bjava\b")
+      )
+      print big_java.explain ()
+      for process in big_java:
+        print process.ProcessId
+
+    Only the terms of an AND can be separated: an OR, or a NOT, which
+    includes a Python test is applied here as a whole. If `fields` are
+    given, any properties needed by the tests are fetched as well.
+    """
+    return _wmi_filter (self, where, fields, timeout_ms)
+
+  def get_many (self, keys, fields=[], max_wql_length=4096, max_workers=4, timeout_secs=None):
+    """Look up many instances of this class by their keys, returning a
+    dictionary mapping each key to its instance; keys with no instance
+    are left out::
+
+      c = wmi.WMI ()
+      services = c.Win32_Service.get_many (["Spooler", "W32Time", "nonesuch"], ["Name", "State"])
+      print services["Spooler"].State
+
+    Each key is a value for a class with one key property, otherwise a
+    tuple of values in the order of the class's :attr:`keys`. The keys are
+    ORed together into as few queries as will each stay within
+    `max_wql_length` characters -- providers refuse queries much longer
+    than a few thousand -- and the queries are run on up to `max_workers`
+    threads at once. The key properties are always fetched, as they're
+    needed to match instances to keys, and values are rendered as
+    literals of their properties' CIM types so that eg a process id can
+    be given as an int; a key given more than one way, eg as 4 and "4",
+    appears in the result under each.
+
+    Each query holds a slot on the namespace's limiter while it runs, and
+    goes to its query cache first, as :meth:`query` does. A query which
+    hasn't finished within `timeout_secs` raises :exc:`x_wmi_timed_out`.
+    """
+    if self._namespace is None:
+      raise x_wmi_no_namespace ("You cannot query directly from a WMI class")
+    key_names = self.keys
+    if not key_names:
+      raise x_wmi ("%s has no key properties" % self._class_name)
+    cimtypes = [self._schema.types.get (name) for name in key_names]
+    fields = list (fields)
+    if fields:
+      fields.extend ([name for name in key_names if name not in fields])
+
+    def literals (values):
+      return tuple ([_bound_literal (name, value, cimtype) for (name, value, cimtype) in zip (key_names, values, cimtypes)])
+
+    wanted = {}
+    terms = []
+    for key in keys:
+      if isinstance (key, tuple):
+        values = key
+      else:
+        values = (key,)
+      if len (values) != len (key_names):
+        raise x_wmi ("%r doesn't match the keys of %s: %s" % (key, self._class_name, ", ".join (key_names)))
+      key_literals = literals (values)
+      match = tuple ([literal.lower () for literal in key_literals])
+      if match in wanted:
+        wanted[match].append (key)
+        continue
+      wanted[match] = [key]
+      conditions = ["%s = %s" % (name, literal) for (name, literal) in zip (key_names, key_literals)]
+      if len (conditions) == 1:
+        terms.append (conditions[0])
+      else:
+        terms.append ("(%s)" % " AND ".join (conditions))
+
+    select = self._query_wql (fields, {}) + " WHERE "
+    batches = []
+    batch = []
+    length = len (select)
+    for term in terms:
+      if batch and length + len (" OR ") + len (term) > max_wql_length:
+        batches.append (select + " OR ".join (batch))
+        batch = []
+        length = len (select)
+      if batch:
+        length += len (" OR ")
+      length += len (term)
+      batch.append (term)
+    if batch:
+      batches.append (select + " OR ".join (batch))
+
+    namespace = self._namespace
+    cache = namespace._query_cache
+
+    def run (wql, stream):
+      #
+      # Each batch is run on a worker thread, within a slot on the
+      # host if the namespace has a limiter, and its results are
+      # passed back to this one to be wrapped.
+      #
+      def execute ():
+        def fetch ():
+          results = _unmarshal (stream).ExecQuery (
+            strQuery=wql, iFlags=wbemFlagReturnImmediately | wbemFlagForwardOnly
+          )
+          return [_marshal (obj) for obj in results]
+        try:
+          return _limited (namespace._limiter, namespace._host, fetch)
+        except pywintypes.com_error:
+          handle_com_error ()
+      return execute
+
+    def match (obj):
+      return tuple ([
+        literal.lower () for literal in literals ([obj._cached_properties (name).value for name in key_names])
+      ])
+
+    found = {}
+    def collect (objects):
+      for obj in objects:
+        for key in wanted.get (match (obj), []):
+          found[key] = obj
+
+    #
+    # Batches answered by the namespace's query cache aren't run again;
+    # the results of the rest are cached as they'd be by query.
+    #
+    keys = {}
+    pending = []
+    for wql in batches:
+      if cache is not None:
+        keys[wql] = cache.key (namespace._cache_location, wql, fields)
+        results = cache.get (keys[wql])
+        if results is not None:
+          collect (results)
+          continue
+      pending.append (wql)
+
+    tasks = ((wql, run (wql, _marshal (namespace._namespace))) for wql in pending)
+    error = None
+    for wql, results in _run_threaded (tasks, max_workers, timeout_secs):
+      if isinstance (results, Exception):
+        error = error or results
+        continue
+      schemas = _schemas_for_query (wql, fields, namespace._schemas)
+      objects = [
+        _wmi_object (_unmarshal (stream), self, fields, schemas=schemas, xml_rows=namespace._xml_rows)
+          for stream in results
+      ]
+      if cache is not None:
+        cache.put (keys[wql], wql, objects)
+      collect (objects)
+    if error is not None:
+      raise error
+    return found
+
+  def iquery (self, fields=[], timeout_ms=None, where=None, **where_clause):
+    """As :meth:`query` but yields each instance as WMI returns it.
+    See :meth:`_wmi_namespace.iquery`::
+
+      c = wmi.WMI ()
+      for f in c.CIM_DataFile.iquery (["Name"], Drive="c:", Extension="log"):
+        print f.Name
+    """
+    #
+    # FIXME: Not clear if this can ever happen
+    #
+    if self._namespace is None:
+      raise x_wmi_no_namespace ("You cannot query directly from a WMI class")
+
+    wql = self._query_wql (fields, where_clause)
+    return self._namespace.iquery (wql, self, fields, timeout_ms, where)
+
+  def watch_for (
+    self,
+    notification_type="operation",
+    delay_secs=1,
+    fields=[],
+    where=None,
+    **where_clause
+  ):
+    if self._namespace is None:
+      raise x_wmi_no_namespace ("You cannot watch directly from a WMI class")
+
+    valid_notification_types = ("operation", "creation", "deletion", "modification")
+    if notification_type.lower () not in valid_notification_types:
+      raise x_wmi ("notification_type must be one of %s" % ", ".join (valid_notification_types))
+
+    return self._namespace.watch_for (
+      notification_type=notification_type,
+      wmi_class=self,
+      delay_secs=delay_secs,
+      fields=fields,
+      where=where,
+      **where_clause
+    )
+
+  def watch_for_async (
+    self,
+    notification_type="operation",
+    delay_secs=1,
+    fields=[],
+    callback=None,
+    max_queued=0,
+    where=None,
+    **where_clause
+  ):
+    """As :meth:`watch_for` but with events pushed by WMI as they happen.
+    See :meth:`_wmi_namespace.watch_for_async`.
+    """
+    if self._namespace is None:
+      raise x_wmi_no_namespace ("You cannot watch directly from a WMI class")
+
+    valid_notification_types = ("operation", "creation", "deletion", "modification")
+    if notification_type.lower () not in valid_notification_types:
+      raise x_wmi ("notification_type must be one of %s" % ", ".join (valid_notification_types))
+
+    return self._namespace.watch_for_async (
+      notification_type=notification_type,
+      wmi_class=self,
+      delay_secs=delay_secs,
+      fields=fields,
+      callback=callback,
+      max_queued=max_queued,
+      where=where,
+      **where_clause
+    )
+
+  def instances (self):
+    """Return a list of instances of the WMI class
+    """
+    try:
+      return [_wmi_object (instance, self) for instance in self.Instances_ ()]
+    except pywintypes.com_error:
+      handle_com_error ()
+
+  def new (self, **kwargs):
+    """This is the equivalent to the raw-WMI SpawnInstance\_
+    method. Note that there are relatively few uses for
+    this, certainly fewer than you might imagine. Most
+    classes which need to create a new *real* instance
+    of themselves, eg Win32_Process, offer a .Create
+    method. SpawnInstance\_ is generally reserved for
+    instances which are passed as parameters to such
+    `.Create` methods, a common example being the
+    `Win32_SecurityDescriptor`, passed to `Win32_Share.Create`
+    and other instances which need security.
+
+    The example here is `Win32_ProcessStartup`, which
+    controls the shown/hidden state etc. of a new
+    `Win32_Process` instance::
+
+      import win32con
+      import wmi
+      c = wmi.WMI ()
+      startup = c.Win32_ProcessStartup.new (ShowWindow=win32con.SW_SHOWMINIMIZED)
+      pid, retval = c.Win32_Process.Create (
+        CommandLine="notepad.exe",
+        ProcessStartupInformation=startup
+      )
+
+    ..  warning::
+        previous versions of this docstring illustrated using this function
+        to create a new process. This is *not* a good example of its use;
+        it is better handled with something like the example above.
+    """
+    try:
+      obj = _wmi_object (self.SpawnInstance_ (), self)
+      obj.set (**kwargs)
+      return obj
+    except pywintypes.com_error:
+      handle_com_error ()
+
+#
+# array.array typecodes for the numeric CIMTYPEs. WMI returns 64-bit
+# integers as strings; they're converted as they're collected.
+#
+_CIMTYPE_TYPECODES = {
+  "boolean" : "B",
+  "char16" : "H",
+  "sint8" : "b",
+  "uint8" : "B",
+  "sint16" : "h",
+  "uint16" : "H",
+  "sint32" : "i",
+  "uint32" : "I",
+  "sint64" : "q",
+  "uint64" : "Q",
+  "real32" : "f",
+  "real64" : "d",
+}
+
+def _empty_column (cimtype):
+  """Return an empty array.array suited to values of `cimtype`, or
+  an empty list if there isn't one (or, for 64-bit values, if this
+  Python's array module doesn't support them).
+  """
+  typecode = _CIMTYPE_TYPECODES.get (cimtype)
+  if typecode:
+    try:
+      return array.array (typecode)
+    except ValueError:
+      pass
+  return []
+
+#
+# class _wmi_result
+#
+class _wmi_result:
+  """Simple, data only result for targeted WMI queries which request
+  data only result classes via fetch_as_classes.
+  """
+  def __init__(self, obj, attributes, xml_rows=False):
+    if xml_rows:
+      row = _text_row (obj)
+      for attr in attributes or row:
+        self.__dict__[attr] = _row_value (row, attr)
+    elif attributes:
+      for attr in attributes:
+        self.__dict__[attr] = obj.Properties_ (attr).Value
+    else:
+      for p in obj.Properties_:
+        attr = p.Name
+        self.__dict__[attr] = obj.Properties_(attr).Value
+
+#
+# class _wmi_snapshot
+#
+_snapshot_layouts = {}
+
+def _snapshot_layout (class_name, names, cimtypes, keys):
+  """Return the one shared copy of a snapshot layout so that every
+  snapshot of the same class, projected the same way, refers to the
+  same tuples -- in memory and, via pickle's memo, on the wire.
+  """
+  layout = (class_name, tuple (names), tuple (cimtypes), tuple (keys))
+  return _snapshot_layouts.setdefault (layout, layout)
+
+def _frozen_value (value, cimtype):
+  """Return a picklable copy of a property value, freezing any
+  embedded objects along the way.
+  """
+  if value is None or not (cimtype or "").startswith ("object"):
+    return value
+  if isinstance (value, (tuple, list)):
+    return tuple (_wmi_object (v).freeze () for v in value)
+  return _wmi_object (value).freeze ()
+
+class _wmi_snapshot (object):
+  """A frozen, data-only copy of a :class:`_wmi_object` as returned by
+  :meth:`_wmi_object.freeze`. It holds the object's path, its class,
+  the names, values and CIMTYPEs of its properties and which of them
+  are keys, but no COM pointers, so it can be pickled and handed to
+  another process; see :func:`map_snapshots`.
+
+  Properties are read as attributes, just as from the live object::
+
+    disk = c.Win32_LogicalDisk (DeviceID="C:")[0].freeze ()
+    print disk.FreeSpace
+
+  A snapshot compares and hashes by the same `id` as the object it was
+  taken from, so snapshots and live objects can be mixed in a set or
+  used to look one another up in a dict. Reference properties are left
+  as the paths they hold and embedded objects are themselves frozen.
+  """
+
+  __slots__ = ("id", "path", "_layout", "_values")
+
+  def __init__ (self, id, path, class_name, names, cimtypes, keys, values):
+    self.id = id
+    self.path = path
+    self._layout = _snapshot_layout (class_name, names, cimtypes, keys)
+    self._values = tuple (values)
+
+  def __getstate__ (self):
+    return (self.id, self.path, self._layout, self._values)
+
+  def __setstate__ (self, state):
+    id, path, layout, values = state
+    self.id = id
+    self.path = path
+    self._layout = _snapshot_layouts.setdefault (layout, layout)
+    self._values = values
+
+  def __getattr__ (self, attribute):
+    if not attribute.startswith ("_"):
+      names = self._layout[1]
+      if attribute in names:
+        return self._values[names.index (attribute)]
+    raise AttributeError (attribute)
+
+  def __setattr__ (self, attribute, value):
+    if attribute in self.__slots__:
+      object.__setattr__ (self, attribute, value)
+    else:
+      raise AttributeError ("%s is read-only" % self.__class__.__name__)
+
+  def __eq__ (self, other):
+    return self.id == getattr (other, "id", None)
+
+  def __ne__ (self, other):
+    return not self == other
+
+  def __lt__ (self, other):
+    return self.id < other.id
+
+  def __hash__ (self):
+    return hash (self.id)
+
+  def __repr__ (self):
+    return "<%s: %s>" % (self.__class__.__name__, self.path or self.class_name)
+
+  def _get_class_name (self):
+    return self._layout[0]
+  class_name = property (_get_class_name)
+
+  def _get_keys (self):
+    """:returns: list of key property names"""
+    return list (self._layout[3])
+  keys = property (_get_keys)
+
+  def _get_properties (self):
+    """:returns: dict mapping property names to values"""
+    return dict (zip (self._layout[1], self._values))
+  properties = property (_get_properties)
+
+  def _get_cimtypes (self):
+    """:returns: dict mapping property names to their CIMTYPEs"""
+    return dict (zip (self._layout[1], self._layout[2]))
+  cimtypes = property (_get_cimtypes)
+
+  def _getAttributeNames (self):
+    """Return list of properties for IPython completion"""
+    return [str (x) for x in self._layout[1]]
+
+#
+# class _wmi_lazy_object
+#
+def _association_wql (verb, rel_path, conditions):
+  """Build an ASSOCIATORS OF or REFERENCES OF query for the object at
+  `rel_path`. `conditions` is a list of (keyword, value) pairs: a flag
+  such as KeysOnly is included if its value is true and any other
+  keyword if it has a value.
+  """
+  where = []
+  for keyword, value in conditions:
+    if value is True:
+      where.append (keyword)
+    elif value:
+      where.append ("%s = %s" % (keyword, value))
+  wql = "%s OF {%s}" % (verb, rel_path)
+  if where:
+    wql += " WHERE " + " ".join (where)
+  return wql
+
+def _association_results (services, namespace, wql, keys_only, class_defs_only):
+  """Run an ASSOCIATORS OF or REFERENCES OF query, returning lazy
+  handles if it asked for keys only, classes if it asked for class
+  definitions and otherwise objects. The query is passed as it is, since
+  the path in it is already escaped.
+  """
+  if keys_only and class_defs_only:
+    raise x_wmi ("keys_only and class_defs_only can't be used together")
+  try:
+    results = services.ExecQuery (strQuery=wql, iFlags=wbemFlagReturnImmediately | wbemFlagForwardOnly)
+    if keys_only:
+      return [_wmi_lazy_object.from_ole_object (services, namespace, obj) for obj in results]
+    elif class_defs_only:
+      return [_wmi_class (namespace, obj) for obj in results]
+    else:
+      return [_wmi_object (obj, namespace=namespace) for obj in results]
+  except pywintypes.com_error:
+    handle_com_error ()
+
+class _wmi_lazy_object (object):
+  """A handle on a WMI object holding only its path and the values of
+  its keys, as returned by :meth:`_wmi_object.associators` and
+  :meth:`_wmi_object.references` when `keys_only` is true. Reading a key
+  costs nothing; reading any other attribute fetches the whole object --
+  once -- and reads it from that. The handle's own `associators` and
+  `references` go straight from its path, so a graph of objects can be
+  walked without fetching any of them::
+
+    c = wmi.WMI ()
+    for disk in c.Win32_DiskDrive ():
+      for partition in disk.associators ("Win32_DiskDriveToDiskPartition", keys_only=True):
+        for logical_disk in partition.associators ("Win32_LogicalDiskToPartition", keys_only=True):
+          print disk.Caption, partition.DeviceID, logical_disk.DeviceID
+
+  A handle compares and hashes by the same `id` as the object itself, so
+  handles and live objects can be mixed in a set.
+  """
+
+  __slots__ = ("id", "path", "class_name", "key_values", "_services", "_namespace", "_object")
+
+  def __init__ (self, services, namespace, id, path, class_name, key_values):
+    object.__setattr__ (self, "id", id)
+    object.__setattr__ (self, "path", path)
+    object.__setattr__ (self, "class_name", class_name)
+    object.__setattr__ (self, "key_values", key_values)
+    object.__setattr__ (self, "_services", services)
+    object.__setattr__ (self, "_namespace", namespace)
+    object.__setattr__ (self, "_object", None)
+
+  @classmethod
+  def from_ole_object (cls, services, namespace, ole_object):
+    path = ole_object.Path_
+    key_values = dict ((key.Name, key.Value) for key in path.Keys)
+    return cls (services, namespace, path.DisplayName.lower (), path.Path, path.Class, key_values)
+
+  def get (self):
+    """Return the :class:`_wmi_object` this is a handle on, fetching it
+    the first time it's needed.
+    """
+    if self._object is None:
+      try:
+        object.__setattr__ (self, "_object", _wmi_object (self._services.Get (self.path), namespace=self._namespace))
+      except pywintypes.com_error:
+        handle_com_error ()
+    return self._object
+
+  def __getattr__ (self, attribute):
+    if attribute.startswith ("__"):
+      raise AttributeError (attribute)
+    if attribute in self.key_values:
+      return self.key_values[attribute]
+    return getattr (self.get (), attribute)
+
+  def __setattr__ (self, attribute, value):
+    setattr (self.get (), attribute, value)
+
+  def __eq__ (self, other):
+    return self.id == getattr (other, "id", None)
+
+  def __ne__ (self, other):
+    return not self == other
+
+  def __lt__ (self, other):
+    return self.id < other.id
+
+  def __hash__ (self):
+    return hash (self.id)
+
+  def __repr__ (self):
+    return "<%s: %s>" % (self.__class__.__name__, self.path)
+
+  def _get_keys (self):
+    """:returns: list of key property names"""
+    return list (self.key_values)
+  keys = property (_get_keys)
+
+  def _rel_path (self):
+    return self.path.split (":", 1)[-1]
+
+  def associators (
+    self, wmi_association_class="", wmi_result_class="", role="", result_role="",
+    required_qualifier="", required_assoc_qualifier="", keys_only=False, class_defs_only=False
+  ):
+    """As :meth:`_wmi_object.associators`, without fetching this object"""
+    wql = _association_wql ("ASSOCIATORS", self._rel_path (), [
+      ("AssocClass", wmi_association_class),
+      ("ResultClass", wmi_result_class),
+      ("Role", role),
+      ("ResultRole", result_role),
+      ("RequiredQualifier", required_qualifier),
+      ("RequiredAssocQualifier", required_assoc_qualifier),
+      ("KeysOnly", bool (keys_only)),
+      ("ClassDefsOnly", bool (class_defs_only)),
+    ])
+    return _association_results (self._services, self._namespace, wql, keys_only, class_defs_only)
+
+  def references (self, wmi_class="", role="", required_qualifier="", keys_only=False, class_defs_only=False):
+    """As :meth:`_wmi_object.references`, without fetching this object"""
+    wql = _association_wql ("REFERENCES", self._rel_path (), [
+      ("ResultClass", wmi_class),
+      ("Role", role),
+      ("RequiredQualifier", required_qualifier),
+      ("KeysOnly", bool (keys_only)),
+      ("ClassDefsOnly", bool (class_defs_only)),
+    ])
+    return _association_results (self._services, self._namespace, wql, keys_only, class_defs_only)
+
+#
+# class WMI
+#
+class _wmi_namespace:
+  """A WMI root of a computer system. The classes attribute holds a list
+  of the classes on offer. This means you can explore a bit with
+  things like this::
+
+    c = wmi.WMI ()
+    for i in c.classes:
+      if "user" in i.lower ():
+        print i
+  """
+  def __init__ (self, namespace, find_classes, schema_cache=None, location=None, xml_rows=False, query_cache=None, limiter=None, projection=None, principal=None, schemas=None):
+    _set (self, "_namespace", namespace)
+    #
+    # wmi attribute preserved for backwards compatibility
+    #
+    _set (self, "wmi", namespace)
+
+    self._classes = None
+    self._classes_map = {}
+    #
+    # Schemas can only be cached on disk if we know where
+    # the namespace is: a (computer, namespace) pair.
+    #
+    if schema_cache is not None and not isinstance (schema_cache, SchemaCache):
+      schema_cache = SchemaCache (schema_cache)
+    if location is None:
+      schema_cache = None
+    self._schema_cache = schema_cache
+    self._location = location
+    #
+    # The schemas of the classes read so far are shared with every other
+    # namespace unless this one is given a store -- a dictionary -- of its own.
+    #
+    if schemas is None:
+      schemas = _schemas
+    self._schemas = schemas
+    #
+    # Query results are cached under where the namespace is and who's
+    # connected to it -- a (user, authority) pair -- or, if that isn't
+    # known, a token of this namespace's own. The cache keeps the token
+    # alive, so unlike id (namespace) it can't be reused for another.
+    #
+    if location is None:
+      self._cache_location = object ()
+    else:
+      self._cache_location = tuple (location) + tuple (principal or ("", ""))
+    self._xml_rows = xml_rows
+    self._query_cache = query_cache
+    self._limiter = limiter
+    self._projection = projection
+    #
+    # Pick up the list of classes under this namespace
+    #  so that they can be queried, and used as though
+    #  properties of the namespace by means of the __getattr__
+    #  hook below.
+    # If the namespace does not support SubclassesOf, carry on
+    #  regardless
+    #
+    if find_classes:
+      _ = self.classes
+
+  def __repr__ (self):
+    return "<_wmi_namespace: %s>" % self.wmi
+
+  def __str__ (self):
+    return repr (self)
+
+  def _get_classes (self):
+    if self._classes is None:
+      self._classes = self.subclasses_of ()
+    return SelfDeprecatingDict (dict.fromkeys (self._classes))
+  classes = property (_get_classes)
+
+  def get (self, moniker):
+    try:
+      return _wmi_object (self.wmi.Get (moniker), namespace=self)
+    except pywintypes.com_error:
+      handle_com_error ()
+
+  def handle (self):
+    """The raw OLE object representing the WMI namespace"""
+    return self._namespace
+
+  def subclasses_of (self, root="", regex=r".*"):
+    try:
+      SubclassesOf = self._namespace.SubclassesOf
+    except AttributeError:
+      return set ()
+    else:
+      return set (
+        c.Path_.Class
+          for c in SubclassesOf (root)
+          if re.match (regex, c.Path_.Class)
+      )
+
+  def instances (self, class_name):
+    """Return a list of instances of the WMI class. This is
+    (probably) equivalent to querying with no qualifiers::
+
+      wmi.WMI ().instances ("Win32_LogicalDisk")
+      # should be the same as
+      wmi.WMI ().Win32_LogicalDisk ()
+    """
+    try:
+      return [_wmi_object (obj, namespace=self) for obj in self._namespace.InstancesOf (class_name)]
+    except pywintypes.com_error:
+      handle_com_error ()
+
+  def new (self, wmi_class, **kwargs):
+    """This is now implemented by a call to :meth:`_wmi_class.new`"""
+    return getattr (self, wmi_class).new (**kwargs)
+
+  new_instance_of = new
+
+  def invoke_many (self, targets, method_name, args=(), kwargs={}, max_per_host=4, max_workers=16, timeout_secs=None):
+    """Call the same method, with the same arguments, on many instances at
+    once, yielding (target, result) for each as it finishes::
+
+      c = wmi.WMI ()
+      notepads = c.Win32_Process (Name="notepad.exe")
+      for process, result in c.invoke_many (notepads, "Terminate", kwargs=dict (Reason=1)):
+        if isinstance (result, Exception):
+          print process.ProcessId, "failed:", result
+        else:
+          return_value, = result
+
+    `targets` are :class:`_wmi_object` instances or the paths of instances
+    in this namespace, and may be of different classes so long as each
+    has the method. The method's parameters are read once per class and
+    filled in from `args` and `kwargs` once, rather than for every call.
+    The result for each target is the tuple of out parameters which
+    calling the method directly would have returned, or the exception
+    raised by the call -- including a class which can't be fetched or
+    has no such method, which fails only the targets of that class.
+
+    Calls run on worker threads, no more than `max_workers` at once and
+    no more than `max_per_host` against any one host. A call which hasn't
+    finished within `timeout_secs` yields :exc:`x_wmi_timed_out`; it goes
+    on counting against its host until it does finish.
+    """
+    methods = {}
+    hosts = {}
+
+    def method_for (class_name):
+      """Return the method wrapper and filled-in parameters for a class,
+      or the exception raised in finding them.
+      """
+      if class_name not in methods:
+        try:
+          try:
+            wmi_class = getattr (self, class_name)
+            if method_name not in wmi_class.methods:
+              raise AttributeError ("%s has no method %s" % (class_name, method_name))
+            wmi_method = wmi_class._cached_methods (method_name)
+            if wmi_method.in_parameters:
+              parameters = wmi_method._parameters (args, kwargs, wmi_method.in_parameters.SpawnInstance_ ())
+            else:
+              parameters = None
+            methods[class_name] = wmi_method, parameters
+          except pywintypes.com_error:
+            handle_com_error ()
+        except (x_wmi, AttributeError):
+          methods[class_name] = sys.exc_info ()[1]
+      return methods[class_name]
+
+    def failed (error):
+      def fail ():
+        raise error
+      return fail
+
+    def call (wmi_method, parameters, stream, path):
+      #
+      # The target -- or, for a path, the namespace -- and the parameters
+      # are marshalled here and unpacked on the worker's own thread.
+      #
+      if parameters is not None:
+        parameters = _marshal (parameters)
+      def invoke ():
+        try:
+          ole_object = _unmarshal (stream)
+          arguments = [wmi_method.method.Name]
+          if parameters is not None:
+            arguments.append (_unmarshal (parameters))
+          if path is None:
+            result = ole_object.ExecMethod_ (*arguments)
+          else:
+            result = ole_object.ExecMethod (path, *arguments)
+          return wmi_method._results (result)
+        except pywintypes.com_error:
+          handle_com_error ()
+      return invoke
+
+    def tasks ():
+      for target in targets:
+        hosts[id (target)] = ""
+        try:
+          try:
+            if isinstance (target, _wmi_object):
+              hosts[id (target)] = target.ole_object.Path_.Server.lower ()
+              method = method_for (target._schema.class_name)
+              path = None
+            else:
+              hosts[id (target)], class_name = _path_parts (target)
+              method = method_for (class_name)
+              path = target
+            if isinstance (method, Exception):
+              function = failed (method)
+            elif path is None:
+              function = call (method[0], method[1], _marshal (target.ole_object), None)
+            else:
+              function = call (method[0], method[1], _marshal (self._namespace), path)
+          except pywintypes.com_error:
+            handle_com_error ()
+        except x_wmi:
+          function = failed (sys.exc_info ()[1])
+        yield target, function
+
+    return _run_threaded (tasks (), max_workers, timeout_secs, lambda target: hosts[id (target)], max_per_host)
+
+  def associators_many (self, sources, association_class, source_role=None, result_role=None, fields=[]):
+    """Return the objects associated with each of many instances through
+    one association class, as a dictionary mapping each source to a list
+    of the objects associated with it::
+
+      c = wmi.WMI ()
+      disks = c.Win32_LogicalDisk ()
+      partitions = c.associators_many (disks, "Win32_LogicalDiskToPartition")
+      for disk in disks:
+        print disk.Caption, [p.DeviceID for p in partitions[disk]]
+
+    Rather than asking for the associators of each instance in turn, this
+    queries the association class once for all its instances and each class
+    at the other end once for all of its, and joins them to the sources by
+    path. So it costs two queries -- more only if the results are of
+    several classes -- however many sources there are, but
+    reads every instance of those classes: it's the way to go for many
+    sources, not for a few among many thousands.
+
+    `sources` may be :class:`_wmi_object` instances, snapshots, lazy
+    handles or paths. `source_role` and `result_role` are the reference
+    properties of the association which point to the sources and to the
+    results. They're worked out from the association's reference types if
+    not given, but must be given if both ends are of the same class. If
+    `fields` are given, only those properties of the results are fetched.
+    """
+    paths = []
+    for source in sources:
+      if isinstance (source, _wmi_object):
+        path = source.ole_object.Path_.Path
+      elif isinstance (source, (_wmi_snapshot, _wmi_lazy_object)):
+        path = source.path
+      else:
+        path = source
+      paths.append ((source, path))
+
+    association = getattr (self, association_class)
+    references = dict (
+      (name, cimtype[len ("ref:"):]) for (name, cimtype) in association._schema.types.items ()
+        if cimtype and cimtype.lower ().startswith ("ref:")
+    )
+    if source_role is None:
+      ancestry = set ()
+      for class_name in set ([_path_parts (path)[1] for (source, path) in paths]):
+        wmi_class = getattr (self, class_name)
+        ancestry.update ([c.lower () for c in (class_name,) + tuple (wmi_class.derivation () or ())])
+      candidates = [
+        name for (name, ref_class) in references.items ()
+          if name != result_role and ref_class.lower () in ancestry
+      ]
+      if len (candidates) != 1:
+        raise x_wmi ("Can't tell which reference of %s points to the sources: give source_role" % association_class)
+      source_role, = candidates
+    if result_role is None:
+      candidates = [name for name in references if name != source_role]
+      if len (candidates) != 1:
+        raise x_wmi ("Can't tell which reference of %s points to the results: give result_role" % association_class)
+      result_role, = candidates
+    for role in (source_role, result_role):
+      if role not in references:
+        raise x_wmi ("%s has no reference %s" % (association_class, role))
+    #
+    # Hash the sources by path, then run through the association's
+    # instances, and those of each class they lead to, picking out
+    # those which match.
+    #
+    found = {}
+    for source, path in paths:
+      found[_normalised_path (path)] = (source, [])
+    links = []
+    wanted = set ()
+    try:
+      for obj in self._raw_query ("SELECT %s, %s FROM %s" % (source_role, result_role, association_class)):
+        source_path = _normalised_path (obj.Properties_ (source_role).Value)
+        if source_path in found:
+          result_path = _normalised_path (obj.Properties_ (result_role).Value)
+          links.append ((source_path, result_path))
+          wanted.add (result_path)
+    except pywintypes.com_error:
+      handle_com_error ()
+    results = {}
+    for result_class in sorted (set ([_path_parts (path)[1] for path in wanted])):
+      wmi_class = getattr (self, result_class)
+      if fields:
+        class_fields = list (fields) + [key for key in wmi_class.keys if key not in fields]
+      else:
+        class_fields = []
+      for result in wmi_class.query (class_fields):
+        path = _normalised_path (result.ole_object.Path_.Path)
+        if path in wanted:
+          results[path] = result
+    for source_path, result_path in links:
+      if result_path in results:
+        found[source_path][1].append (results[result_path])
+    return dict (found.values ())
+
+  def _raw_query (self, wql, timeout_ms=None, where=None):
+    """Execute a WQL query and return its raw results.  Use the flags
+    recommended by Microsoft to achieve a read-only, semi-synchronous
+    query where the time is taken while looping through.
+    NB Backslashes need to be doubled up.
+
+    If `timeout_ms` is given, the query is run and its results read on
+    a worker thread and :exc:`x_wmi_timed_out` is raised once the caller
+    has spent that long in all waiting for them. If `where` is given, it's added to the WHERE clause
+    without its backslashes being doubled, since it's already escaped.
+    """
+    flags = wbemFlagReturnImmediately | wbemFlagForwardOnly
+    wql = _escaped_wql (wql, where)
+    if timeout_ms is None:
+      execute = self._namespace.ExecQuery
+    else:
+      stream = _marshal (self._namespace)
+      def execute (**kwargs):
+        return _within_deadline (lambda: _unmarshal (stream).ExecQuery (**kwargs), timeout_ms)
+    try:
+      if self._limiter is None:
+        return execute (strQuery=wql, iFlags=flags)
+      else:
+        return self._limiter.iterate (self._host, execute, strQuery=wql, iFlags=flags)
+    except pywintypes.com_error:
+      handle_com_error ()
+
+  def _get_host (self):
+    if self._location is None:
+      return "."
+    return self._location[0]
+  _host = property (_get_host)
+
+  def query (self, wql, instance_of=None, fields=[], timeout_ms=None, where=None):
+    """Perform an arbitrary query against a WMI object, and return
+    a list of _wmi_object representations of the results.
+
+    If the namespace was connected with a :class:`QueryCache`, recent
+    results of the same query are returned from there instead.
+
+    If `timeout_ms` is given and the results aren't all in after waiting
+    that long for them, :exc:`x_wmi_timed_out` is raised, so a hung
+    provider can't hold up the caller indefinitely::
+
+      c = wmi.WMI ("remote")
+      try:
+        services = c.query ("SELECT * FROM Win32_Service", timeout_ms=30000)
+      except wmi.x_wmi_timed_out:
+        services = []
+
+    If `where` -- a condition made from :class:`Field` objects -- is given,
+    it's added to the query's WHERE clause::
+
+      from wmi import Field
+      big = c.query ("SELECT * FROM Win32_Process", where=Field ("WorkingSetSize") > 1024 ** 3)
+    """
+    cache = self._query_cache
+    if cache is None:
+      return list (self.iquery (wql, instance_of, fields, timeout_ms, where))
+
+    if where is None:
+      key = cache.key (self._cache_location, wql, fields)
+    else:
+      key = cache.key (self._cache_location, _add_where (wql, _where_wql (where)), fields)
+    results = cache.get (key)
+    if results is None:
+      results = list (self.iquery (wql, instance_of, fields, timeout_ms, where))
+      cache.put (key, wql, results)
+    return results
+
+  def iquery (self, wql, instance_of=None, fields=[], timeout_ms=None, where=None):
+    """Perform an arbitrary query against a WMI object, yielding a
+    _wmi_object representation of each result as WMI returns it. Only
+    the current result is held, so this is the way to go through very
+    large result sets; stopping early releases the underlying
+    enumerator::
+
+      c = wmi.WMI ()
+      for event in c.iquery ("SELECT * FROM Win32_NTLogEvent WHERE Logfile = 'System'"):
+        if event.EventCode == 6005:
+          print event.TimeGenerated
+          break
+
+    If `timeout_ms` is given, :exc:`x_wmi_timed_out` is raised once the
+    loop has spent that long in all waiting on WMI for results -- the
+    time spent in the body of the loop doesn't count -- and `where` adds
+    a condition to the query, as for :meth:`query`.
+    """
+    schemas = _schemas_for_query (wql, fields, self._schemas)
+    results = self._raw_query (wql, timeout_ms, where)
+    try:
+      try:
+        for obj in results:
+          yield _wmi_object (obj, instance_of, fields, schemas=schemas, xml_rows=self._xml_rows, namespace=self)
+      except pywintypes.com_error:
+        handle_com_error ()
+    finally:
+      results = obj = None
+
+  def _fetch_wql (self, wmi_classname, fields, where_clause):
+    wql = "SELECT %s FROM %s" % (fields and ", ".join (fields) or "*", wmi_classname)
+    if where_clause:
+      wql += " WHERE " + " AND ".join (["%s = '%s'" % (k, v) for k, v in where_clause.items()])
+    return wql
+
+  def fetch_as_classes (self, wmi_classname, fields=(), timeout_ms=None, where=None, **where_clause):
+    """Build and execute a wql query to fetch the specified list of fields from
+    the specified wmi_classname + where_clause, then return the results as
+    a list of simple class instances with attributes matching field_list.
+
+    If fields is left empty, select * and pre-load all class attributes for
+    each class returned. As for all the fetch methods, if `timeout_ms` is
+    given, :exc:`x_wmi_timed_out` is raised if the results aren't all in
+    by then; a `where` condition, made from :class:`Field` objects, is
+    added to any `where_clause`.
+    """
+    wql = self._fetch_wql (wmi_classname, fields, where_clause)
+    return [_wmi_result (obj, fields, self._xml_rows) for obj in self._raw_query(wql, timeout_ms, where)]
+
+  def fetch_as_lists (self, wmi_classname, fields, timeout_ms=None, where=None, **where_clause):
+    """Build and execute a wql query to fetch the specified list of fields from
+    the specified wmi_classname + where_clause, then return the results as
+    a list of lists whose values correspond to field_list.
+    """
+    wql = self._fetch_wql (wmi_classname, fields, where_clause)
+    results = []
+    for obj in self._raw_query(wql, timeout_ms, where):
+      if self._xml_rows:
+        row = _text_row (obj)
+        results.append ([_row_value (row, field) for field in fields])
+      else:
+        results.append ([obj.Properties_ (field).Value for field in fields])
+    return results
+
+  def fetch_as_columns (self, wmi_classname, fields=(), as_numpy=False, timeout_ms=None, where=None, **where_clause):
+    """Build and execute a wql query to fetch the specified list of fields from
+    the specified wmi_classname + where_clause, then return the results as
+    a dictionary mapping each field to a column of its values. Numeric
+    fields, according to their CIMTYPE, are collected into an `array.array`
+    of the appropriate type; anything else, or any column which turns out
+    to hold nulls, is a list::
+
+      c = wmi.WMI ()
+      columns = c.fetch_as_columns ("Win32_Process", ["Name", "WorkingSetSize"])
+      print sum (columns["WorkingSetSize"])
+
+    If `as_numpy` is true, the columns are returned as NumPy arrays, with
+    lists becoming arrays of objects. This needs NumPy to be installed.
+
+    If fields is left empty, all the class's properties are fetched.
+    """
+    if as_numpy:
+      import numpy
+    schema = self._cached_classes (wmi_classname)._schema
+    wql = self._fetch_wql (wmi_classname, fields, where_clause)
+    fields = list (fields or schema.properties)
+    cimtypes = [schema.types.get (field) for field in fields]
+    columns = [_empty_column (cimtype) for cimtype in cimtypes]
+    wide = [cimtype in ("sint64", "uint64") for cimtype in cimtypes]
+
+    for obj in self._raw_query (wql, timeout_ms, where):
+      if self._xml_rows:
+        row = _text_row (obj)
+      for n, field in enumerate (fields):
+        if self._xml_rows:
+          value = _row_value (row, field)
+        else:
+          value = obj.Properties_ (field).Value
+        if wide[n] and value is not None:
+          value = int (value)
+        try:
+          columns[n].append (value)
+        except (TypeError, OverflowError):
+          columns[n] = list (columns[n])
+          columns[n].append (value)
+
+    if as_numpy:
+      columns = [
+        numpy.array (column, dtype=getattr (column, "typecode", object)) for column in columns
+      ]
+    return dict (zip (fields, columns))
+
+  def watch_for (
+    self,
+    raw_wql=None,
+    notification_type="operation",
+    wmi_class=None,
+    delay_secs=1,
+    fields=[],
+    where=None,
+    **where_clause
+  ):
+    """Set up an event tracker on a WMI event. This function
+    returns an wmi_watcher which can be called to get the
+    next event::
+
+      c = wmi.WMI ()
+
+      raw_wql = "SELECT * FROM __InstanceCreationEvent WITHIN 2 WHERE TargetInstance ISA 'Win32_Process'"
+      watcher = c.watch_for (raw_wql=raw_wql)
+      while 1:
+        process_created = watcher ()
+        print process_created.Name
+
+      # or
+
+      watcher = c.watch_for (
+        notification_type="Creation",
+        wmi_class="Win32_Process",
+        delay_secs=2,
+        Name='calc.exe'
+      )
+      calc_created = watcher ()
+
+    Now supports timeout on the call to watcher::
+
+      import pythoncom
+      import wmi
+      c = wmi.WMI (privileges=["Security"])
+      watcher1 = c.watch_for (
+        notification_type="Creation",
+        wmi_class="Win32_NTLogEvent",
+        Type="error"
+      )
+      watcher2 = c.watch_for (
+        notification_type="Creation",
+        wmi_class="Win32_NTLogEvent",
+        Type="warning"
+      )
+
+      while 1:
+        try:
+          error_log = watcher1 (500)
+        except wmi.x_wmi_timed_out:
+          pythoncom.PumpWaitingMessages ()
+        else:
+          print error_log
+
+        try:
+          warning_log = watcher2 (500)
+        except wmi.x_wmi_timed_out:
+          pythoncom.PumpWaitingMessages ()
+        else:
+          print warning_log
+
+    A `where` condition, made from :class:`Field` objects, is added to
+    the event query; for an intrinsic event its properties are taken to
+    be those of the `TargetInstance`::
+
+      from wmi import Field
+      watcher = c.watch_for (
+        notification_type="Creation",
+        wmi_class="Win32_Process",
+        where=Field ("Name").like ("%.tmp.exe")
+      )
+
+    To have events pushed to you as they happen, rather than waiting
+    for each in turn, see :meth:`watch_for_async`; to watch for many
+    kinds of event at once, see :class:`WatcherMultiplexer`.
+    """
+    wql, is_extrinsic, fields = self._watch_wql (raw_wql, notification_type, wmi_class, delay_secs, fields, where_clause, where)
+    try:
+      return _wmi_watcher (
+        self._namespace.ExecNotificationQuery (wql),
+        is_extrinsic=is_extrinsic,
+        fields=fields,
+        schemas=self._schemas
+      )
+    except pywintypes.com_error:
+      handle_com_error ()
+
+  def watch_for_async (
+    self,
+    raw_wql=None,
+    notification_type="operation",
+    wmi_class=None,
+    delay_secs=1,
+    fields=[],
+    callback=None,
+    max_queued=0,
+    where=None,
+    **where_clause
+  ):
+    """Set up an event tracker as :meth:`watch_for` does, but have WMI
+    push events to it as they happen rather than waiting for each in
+    turn. The events are received on a thread of the watcher's own and
+    are either passed to `callback` there or queued -- up to `max_queued`
+    if given -- to be picked up by calling the watcher, which raises
+    :exc:`x_wmi` if there's a callback::
+
+      c = wmi.WMI ()
+      watcher = c.watch_for_async (notification_type="creation", wmi_class="Win32_Process")
+      while True:
+        process_created = watcher ()
+        print process_created.Name, process_created.timestamp
+
+      # or
+
+      def created (process):
+        print process.Name
+      watcher = c.Win32_Process.watch_for_async ("creation", callback=created)
+      ...
+      watcher.stop ()
+
+    Since they arrive on another thread, events are data-only copies,
+    with the `event_type`, `timestamp` and `previous` of a :class:`_wmi_event`.
+    """
+    wql, is_extrinsic, fields = self._watch_wql (raw_wql, notification_type, wmi_class, delay_secs, fields, where_clause, where)
+    return _wmi_sink_watcher (self._namespace, wql, is_extrinsic, callback, max_queued, self._xml_rows)
+
+  def query_async (self, wql, max_queued=1000, where=None):
+    """Run a WQL query asynchronously: WMI pushes each result as it's ready
+    and the calling thread isn't held up while it does. The returned object
+    can be iterated over, or used as an asyncio asynchronous iterator; in
+    either case the results are data-only copies, as from :meth:`fetch_as_classes`::
+
+      c = wmi.WMI ("remote")
+      for process in c.query_async ("SELECT Name FROM Win32_Process"):
+        print process.Name
+
+    At most `max_queued` results are held waiting to be picked up; WMI is
+    made to wait beyond that. Calling the result's :meth:`~_wmi_async_query.cancel`
+    or :meth:`~_wmi_async_query.aclose`, leaving an `async with` block
+    around it, or breaking out of a plain `for` loop over it cancels the
+    query at once. Breaking out of an `async for` loop doesn't: the query
+    is cancelled only once the result is dropped and collected.
+    """
+    return _wmi_async_query (self._namespace, _escaped_wql (wql, where), max_queued, self._xml_rows)
+
+  def _watch_wql (self, raw_wql, notification_type, wmi_class, delay_secs, fields, where_clause, where=None):
+    """Return the WQL for an event query, whether it's for an extrinsic
+    event, and the fields to be returned.
+    """
+    condition, prefix = where, ""
+    if raw_wql:
+      wql = raw_wql
+      is_extrinsic = False
+    else:
+      if isinstance (wmi_class, _wmi_class):
+        class_name = wmi_class._class_name
+      else:
+        class_name = wmi_class
+        wmi_class = getattr (self, class_name)
+      is_extrinsic = "__ExtrinsicEvent" in wmi_class.derivation ()
+      fields = set (['TargetInstance'] + (fields or ["*"]))
+      field_list = ", ".join (fields)
+      if is_extrinsic:
+        if where_clause:
+          where = " WHERE " + " AND ".join (["%s = '%s'" % (k, v) for k, v in where_clause.items ()])
+        else:
+          where = ""
+        wql = "SELECT " + field_list + " FROM " + class_name + where
+      else:
+        if where_clause:
+          where = " AND " + " AND ".join (["TargetInstance.%s = '%s'" % (k, v) for k, v in where_clause.items ()])
+        else:
+          where = ""
+        wql = \
+          "SELECT %s FROM __Instance%sEvent WITHIN %d WHERE TargetInstance ISA '%s' %s" % \
+          (field_list, notification_type, delay_secs, class_name, where)
+        prefix = "TargetInstance."
+    if condition is not None:
+      wql = _add_where (wql, _where_wql (condition, prefix))
+    return wql, is_extrinsic, fields
+
+  def __getattr__ (self, attribute):
+    """Offer WMI classes as simple attributes. Pass through any untrapped
+    unattribute to the underlying OLE object. This means that new or
+    unmapped functionality is still available to the module user.
+    """
+    #
+    # Don't try to match against known classes as was previously
+    # done since the list may not have been requested
+    # (find_classes=False).
+    #
+    try:
+      return self._cached_classes (attribute)
+    except pywintypes.com_error:
+      return getattr (self._namespace, attribute)
+
+  def _cached_classes (self, class_name):
+    """Standard caching helper which keeps track of classes
+    already retrieved by name and returns the existing object
+    if found. If this is the first retrieval, store it and
+    pass it back
+    """
+    if class_name not in self._classes_map:
+      schema = None
+      if self._schema_cache is not None:
+        schema = self._schema_cache.load (self._location, class_name, self._schemas)
+      if schema is None:
+        wmi_class = _wmi_class (self, self._namespace.Get (class_name))
+        self._save_schema (wmi_class._schema, wmi_class.ole_object)
+      else:
+        wmi_class = _wmi_class (self, None, schema)
+      self._classes_map[class_name] = wmi_class
+    return self._classes_map[class_name]
+
+  def _save_schema (self, schema, ole_object):
+    if self._schema_cache is not None:
+      path = ole_object.Path_
+      self._schema_cache.save (self._location, schema, (path.Server, path.Namespace))
+
+  def _getAttributeNames (self):
+    """Return list of classes for IPython completion engine"""
+    return [x for x in self.classes if not x.startswith ('__')]
+
+#
+# class _wmi_watcher
+#
+class _wmi_watcher:
+  """Helper class for WMI.watch_for below (qv)"""
+
+  _event_property_map = {
+    "TargetInstance" : _wmi_object,
+    "PreviousInstance" : _wmi_object
+  }
+  def __init__ (self, wmi_event, is_extrinsic, fields=[], schemas=None):
+    self.wmi_event = wmi_event
+    self.is_extrinsic = is_extrinsic
+    self.fields = fields
+    #
+    # The event objects themselves are shaped by the watcher's
+    # query so must not share their schemas with other queries.
+    #
+    self._schemas = _schema_overlay (schemas)
+    self._event_types = {}
+
+  def __call__ (self, timeout_ms=-1):
+    """When called, return the instance which caused the event. Supports
+     timeout in milliseconds (defaulting to infinite). If the watcher
+     times out, :exc:`x_wmi_timed_out` is raised. This makes it easy to support
+     watching for multiple objects.
+    """
+    try:
+      event = self.wmi_event.NextEvent (timeout_ms)
+      if self.is_extrinsic:
+        return _wmi_event (event, None, self.fields, schemas=self._schemas)
+      else:
+        return _wmi_event (
+          event.Properties_ ("TargetInstance").Value,
+          _wmi_object (event, property_map=self._event_property_map, schemas=self._schemas),
+          self.fields
+        )
     except pywintypes.com_error:
       handle_com_error ()
 
-  def new (self, **kwargs):
-    """This is the equivalent to the raw-WMI SpawnInstance\_
-    method. Note that there are relatively few uses for
-    this, certainly fewer than you might imagine. Most
-    classes which need to create a new *real* instance
-    of themselves, eg Win32_Process, offer a .Create
-    method. SpawnInstance\_ is generally reserved for
-    instances which are passed as parameters to such
-    `.Create` methods, a common example being the
-    `Win32_SecurityDescriptor`, passed to `Win32_Share.Create`
-    and other instances which need security.
-
-    The example here is `Win32_ProcessStartup`, which
-    controls the shown/hidden state etc. of a new
-    `Win32_Process` instance::
+  def next_batch (self, max_events=100, max_wait_ms=1000):
+    """Return a list of up to `max_events` events, returning as soon as
+    there are that many or `max_wait_ms` milliseconds have passed. If no
+    events arrive in that time, the list is empty. Each event is the
+    :class:`_wmi_event` which calling the watcher would return, but
+    without the extra object built to read the event's own details, so
+    this is much quicker when events are arriving thick and fast::
 
-      import win32con
-      import wmi
       c = wmi.WMI ()
-      startup = c.Win32_ProcessStartup.new (ShowWindow=win32con.SW_SHOWMINIMIZED)
-      pid, retval = c.Win32_Process.Create (
-        CommandLine="notepad.exe",
-        ProcessStartupInformation=startup
-      )
-
-    ..  warning::
-        previous versions of this docstring illustrated using this function
-        to create a new process. This is *not* a good example of its use;
-        it is better handled with something like the example above.
+      watcher = c.Win32_Process.watch_for ("creation")
+      while True:
+        for process in watcher.next_batch (500, 1000):
+          print process.Name, process.timestamp
     """
+    events = []
+    deadline = time.time () + max_wait_ms / 1000.0
+    timeout_ms = max_wait_ms
     try:
-      obj = _wmi_object (self.SpawnInstance_ (), self)
-      obj.set (**kwargs)
-      return obj
+      while len (events) < max_events:
+        try:
+          event = self.wmi_event.NextEvent (timeout_ms)
+        except pywintypes.com_error:
+          if _is_timeout (sys.exc_info ()[1]):
+            break
+          raise
+        events.append (self._batch_event (event))
+        timeout_ms = max (0, int ((deadline - time.time ()) * 1000))
     except pywintypes.com_error:
       handle_com_error ()
+    return events
 
-#
-# class _wmi_result
-#
-class _wmi_result:
-  """Simple, data only result for targeted WMI queries which request
-  data only result classes via fetch_as_classes.
-  """
-  def __init__(self, obj, attributes):
-    if attributes:
-      for attr in attributes:
-        self.__dict__[attr] = obj.Properties_ (attr).Value
-    else:
-      for p in obj.Properties_:
-        attr = p.Name
-        self.__dict__[attr] = obj.Properties_(attr).Value
+  def _batch_event (self, event):
+    if self.is_extrinsic:
+      return _wmi_event (event, None, self.fields, schemas=self._schemas)
+    #
+    # Read the event's own properties in one pass rather than
+    # wrapping the event in an object of its own.
+    #
+    properties = dict ((p.Name, p.Value) for p in event.Properties_)
+    result = _wmi_event (properties["TargetInstance"], None, self.fields)
+    event_class = event.Path_.Class
+    try:
+      event_type = self._event_types[event_class]
+    except KeyError:
+      match = _wmi_event.event_type_re.match (event_class)
+      event_type = self._event_types[event_class] = match and match.group (1).lower ()
+    _set (result, "event_type", event_type)
+    if properties.get ("TIME_CREATED") is not None:
+      _set (result, "timestamp", from_1601 (properties["TIME_CREATED"]))
+    if properties.get ("PreviousInstance") is not None:
+      _set (result, "previous", _wmi_object (properties["PreviousInstance"]))
+    return result
 
 #
-# class WMI
+# Events pushed by WMI
 #
-class _wmi_namespace:
-  """A WMI root of a computer system. The classes attribute holds a list
-  of the classes on offer. This means you can explore a bit with
-  things like this::
-
-    c = wmi.WMI ()
-    for i in c.classes:
-      if "user" in i.lower ():
-        print i
+def _marshal (ole_object):
+  """Package a COM object so that it can be used from another thread"""
+  return pythoncom.CoMarshalInterThreadInterfaceInStream (
+    pythoncom.IID_IDispatch, getattr (ole_object, "_oleobj_", ole_object)
+  )
+
+def _unmarshal (stream):
+  """Unpack, in the thread which will use it, a COM object packaged by :func:`_marshal`"""
+  return Dispatch (pythoncom.CoGetInterfaceAndReleaseStream (stream, pythoncom.IID_IDispatch))
+
+def _within_deadline (execute, timeout_ms, max_queued=100):
+  """Call `execute` on a worker thread and yield each of the COM objects
+  it returns, passed back to the calling thread. If the caller has
+  spent more than `timeout_ms` in all waiting on WMI for them, raise
+  :exc:`x_wmi_timed_out`; the worker is told to stop and drops the
+  enumerator as soon as WMI lets it go. The time the caller spends
+  dealing with each object before asking for the next doesn't count.
   """
-  def __init__ (self, namespace, find_classes):
-    _set (self, "_namespace", namespace)
-    #
-    # wmi attribute preserved for backwards compatibility
-    #
-    _set (self, "wmi", namespace)
+  results = queue.Queue ()
+  cancelled = threading.Event ()
+  room = threading.Semaphore (max_queued)
+  remaining_secs = timeout_ms / 1000.0
 
-    self._classes = None
-    self._classes_map = {}
+  def worker ():
+    pythoncom.CoInitializeEx (pythoncom.COINIT_MULTITHREADED)
+    try:
+      try:
+        for obj in execute ():
+          while not room.acquire (False):
+            if cancelled.wait (0.05):
+              return
+          if cancelled.is_set ():
+            return
+          results.put (("object", _marshal (obj)))
+        results.put (("done", None))
+      except Exception:
+        results.put (("error", sys.exc_info ()[1]))
+    finally:
+      obj = None
+      pythoncom.CoUninitialize ()
+
+  thread = threading.Thread (target=worker)
+  thread.daemon = True
+  thread.start ()
+  try:
+    while True:
+      started = time.time ()
+      try:
+        kind, value = results.get (timeout=max (0, remaining_secs))
+      except queue.Empty:
+        raise x_wmi_timed_out ("No results after %s ms" % timeout_ms)
+      remaining_secs -= time.time () - started
+      if kind == "done":
+        break
+      elif kind == "error":
+        raise value
+      room.release ()
+      yield _unmarshal (value)
+      value = None
+  finally:
+    cancelled.set ()
     #
-    # Pick up the list of classes under this namespace
-    #  so that they can be queried, and used as though
-    #  properties of the namespace by means of the __getattr__
-    #  hook below.
-    # If the namespace does not support SubclassesOf, carry on
-    #  regardless
+    # Release any objects passed back but not picked up
     #
-    if find_classes:
-      _ = self.classes
+    while True:
+      try:
+        kind, value = results.get_nowait ()
+      except queue.Empty:
+        break
+      if kind == "object":
+        _unmarshal (value)
+    value = None
+
+class _wmi_sink_events:
+  """Event handlers for an `SWbemSink`, passing each object WMI delivers,
+  and the completion of the call, on to the functions it was made with.
+  """
+  def OnObjectReady (self, objWbemObject, objWbemAsyncContext):
+    self._on_object_ready (objWbemObject)
 
-  def __repr__ (self):
-    return "<_wmi_namespace: %s>" % self.wmi
+  def OnCompleted (self, iHResult, objWbemErrorObject, objWbemAsyncContext):
+    self._on_completed (iHResult)
 
-  def __str__ (self):
-    return repr (self)
+def _make_sink (on_object_ready, on_completed):
+  """Return an `SWbemSink` which calls `on_object_ready` with each object
+  delivered to it and `on_completed` with the HRESULT of the call.
+  """
+  from win32com.client import DispatchWithEvents
+  sink = DispatchWithEvents ("WbemScripting.SWbemSink", _wmi_sink_events)
+  sink._on_object_ready = on_object_ready
+  sink._on_completed = on_completed
+  return sink
+
+def _event_data (event, is_extrinsic, xml_rows=False):
+  """Return a data-only copy of the instance behind an event, with
+  the type of event, its timestamp and any previous instance.
+  """
+  if is_extrinsic:
+    result = _wmi_result (event, None, xml_rows)
+    result.event_type = None
+  else:
+    result = _wmi_result (event.Properties_ ("TargetInstance").Value, None, xml_rows)
+    result.event_type = _wmi_event.event_type_re.match (event.Path_.Class).group (1).lower ()
+  result.timestamp = result.previous = None
+  for p in event.Properties_:
+    if p.Name == "TIME_CREATED" and p.Value is not None:
+      result.timestamp = from_1601 (p.Value)
+    elif p.Name == "PreviousInstance" and p.Value is not None:
+      result.previous = _wmi_result (p.Value, None, xml_rows)
+  return result
+
+class _sink_dispatcher (object):
+  """A thread, with COM initialised as a single-threaded apartment, on
+  which any number of asynchronous event queries are run. Everything to do
+  with their sinks happens on this thread; other threads ask for it to be
+  done by way of :meth:`call`. WMI's calls into the sinks arrive as window
+  messages which the thread pumps between commands, so the sinks' callbacks
+  run one at a time, on this thread, and one which blocks holds up the rest.
+  """
 
-  def _get_classes (self):
-    if self._classes is None:
-      self._classes = self.subclasses_of ()
-    return SelfDeprecatingDict (dict.fromkeys (self._classes))
-  classes = property (_get_classes)
+  def __init__ (self):
+    self._commands = queue.Queue ()
+    self._subscriptions = {}
+    self._thread = threading.Thread (target=self._run)
+    self._thread.daemon = True
+    self._thread.start ()
 
-  def get (self, moniker):
+  def _run (self):
+    pythoncom.CoInitializeEx (pythoncom.COINIT_APARTMENTTHREADED)
+    try:
+      while True:
+        pythoncom.PumpWaitingMessages ()
+        try:
+          command = self._commands.get (timeout=0.01)
+        except queue.Empty:
+          continue
+        if command is None:
+          break
+        function, args, done, outcome = command
+        try:
+          outcome.append (function (*args))
+        except Exception:
+          outcome.append (sys.exc_info ()[1])
+          outcome.append (True)
+        function = args = None
+        done.set ()
+    finally:
+      #
+      # Cancel whatever is still subscribed so that WMI stops
+      # sending to sinks which are about to go away
+      #
+      for namespace, sink in list (self._subscriptions.values ()):
+        try:
+          sink.Cancel ()
+        except pywintypes.com_error:
+          pass
+      self._subscriptions.clear ()
+      pythoncom.CoUninitialize ()
+
+  def call (self, function, *args):
+    """Run `function` on the dispatcher's thread, returning its result
+    or raising its exception.
+    """
+    done = threading.Event ()
+    outcome = []
+    self._commands.put ((function, args, done, outcome))
+    done.wait ()
+    if len (outcome) > 1:
+      raise outcome[0]
+    return outcome[0]
+
+  def subscribe (self, namespace, wql, on_object_ready, on_completed, method="ExecNotificationQueryAsync"):
+    """Start the event query `wql` -- or, with `method` ExecQueryAsync,
+    the ordinary query -- against `namespace`, returning a token by which
+    it can be cancelled.
+    """
+    return self.call (self._subscribe, _marshal (namespace), wql, on_object_ready, on_completed, method)
+
+  def _subscribe (self, stream, wql, on_object_ready, on_completed, method):
+    namespace = _unmarshal (stream)
+    sink = _make_sink (on_object_ready, on_completed)
     try:
-      return _wmi_object (self.wmi.Get (moniker))
+      getattr (namespace, method) (sink, wql)
     except pywintypes.com_error:
       handle_com_error ()
+    token = id (sink)
+    self._subscriptions[token] = (namespace, sink)
+    return token
+
+  def cancel (self, token, wait=True):
+    """Cancel the event query started by :meth:`subscribe`. Unless
+    `wait` is set, only ask for it to be cancelled: that's all which can
+    be done from the dispatcher's own thread.
+    """
+    if wait:
+      self.call (self._cancel, token)
+    else:
+      self._commands.put ((self._cancel, (token,), threading.Event (), []))
 
-  def handle (self):
-    """The raw OLE object representing the WMI namespace"""
-    return self._namespace
+  def _cancel (self, token):
+    namespace, sink = self._subscriptions.pop (token, (None, None))
+    if sink is not None:
+      sink.Cancel ()
 
-  def subclasses_of (self, root="", regex=r".*"):
+  def stop (self, wait=True):
+    """Cancel every event query and finish the thread, waiting for it
+    to finish unless `wait` is unset.
+    """
+    self._commands.put (None)
+    if wait:
+      self._thread.join ()
+
+class _wmi_sink_watcher (object):
+  """Helper class for WMI.watch_for_async (qv). The event query is run
+  asynchronously on a dispatcher thread -- its own unless one is shared
+  with it -- with an `SWbemSink` to receive the events, so no thread is
+  tied up waiting for them.
+  """
+
+  def __init__ (self, namespace, wql, is_extrinsic, callback=None, max_queued=0, xml_rows=False, dispatcher=None):
+    self.wql = wql
+    self.is_extrinsic = is_extrinsic
+    self.callback = callback
+    self.xml_rows = xml_rows
+    self.received = self.dropped = 0
+    self.error = None
+    self._events = queue.Queue (max_queued)
+    self._stopped = threading.Event ()
+    self._own_dispatcher = dispatcher is None
+    self._dispatcher = dispatcher or _sink_dispatcher ()
     try:
-      SubclassesOf = self._namespace.SubclassesOf
-    except AttributeError:
-      return set ()
-    else:
-      return set (
-        c.Path_.Class
-          for c in SubclassesOf (root)
-          if re.match (regex, c.Path_.Class)
-      )
+      self._subscription = self._dispatcher.subscribe (namespace, wql, self._on_object_ready, self._on_completed)
+    except:
+      if self._own_dispatcher:
+        self._dispatcher.stop ()
+      raise
 
-  def instances (self, class_name):
-    """Return a list of instances of the WMI class. This is
-    (probably) equivalent to querying with no qualifiers::
+  def __repr__ (self):
+    return "<_wmi_sink_watcher: %s>" % self.wql
 
-      wmi.WMI ().instances ("Win32_LogicalDisk")
-      # should be the same as
-      wmi.WMI ().Win32_LogicalDisk ()
-    """
+  def _on_object_ready (self, event):
+    self.received += 1
     try:
-      return [_wmi_object (obj) for obj in self._namespace.InstancesOf (class_name)]
+      data = _event_data (event, self.is_extrinsic, self.xml_rows)
     except pywintypes.com_error:
-      handle_com_error ()
+      self.dropped += 1
+      return
+    if self.callback is not None:
+      self.callback (data)
+    else:
+      try:
+        self._events.put_nowait (data)
+      except queue.Full:
+        self.dropped += 1
 
-  def new (self, wmi_class, **kwargs):
-    """This is now implemented by a call to :meth:`_wmi_class.new`"""
-    return getattr (self, wmi_class).new (**kwargs)
+  def _on_completed (self, hresult):
+    if hresult and not self._stopped.isSet ():
+      self.error = x_wmi ("Event query failed with %s" % hex (signed_to_unsigned (hresult)))
+    self._stopped.set ()
 
-  new_instance_of = new
+  def _check_queued (self):
+    if self.callback is not None:
+      raise x_wmi ("The watcher's events go to its callback, not to a queue")
 
-  def _raw_query (self, wql):
-    """Execute a WQL query and return its raw results.  Use the flags
-    recommended by Microsoft to achieve a read-only, semi-synchronous
-    query where the time is taken while looping through.
-    NB Backslashes need to be doubled up.
+  def __call__ (self, timeout_ms=-1):
+    """Return the next event, waiting up to `timeout_ms` milliseconds
+    -- indefinitely by default -- for it. If none arrives in that time,
+    :exc:`x_wmi_timed_out` is raised. A watcher with a callback queues
+    nothing, so this raises :exc:`x_wmi` straight away.
     """
-    flags = wbemFlagReturnImmediately | wbemFlagForwardOnly
-    wql = wql.replace ("\\", "\\\\")
-    try:
-      return self._namespace.ExecQuery (strQuery=wql, iFlags=flags)
-    except pywintypes.com_error:
-      handle_com_error ()
+    self._check_queued ()
+    if timeout_ms < 0:
+      deadline = None
+    else:
+      deadline = time.time () + timeout_ms / 1000.0
+    while True:
+      if deadline is None:
+        wait_secs = 0.5
+      else:
+        wait_secs = max (0, min (0.5, deadline - time.time ()))
+      try:
+        return self._events.get (timeout=wait_secs)
+      except queue.Empty:
+        if self.error is not None:
+          raise self.error
+        if self._stopped.isSet ():
+          raise x_wmi ("The watcher has been stopped")
+        if deadline is not None and time.time () >= deadline:
+          raise x_wmi_timed_out ()
+
+  def next_batch (self, max_events=100, max_wait_ms=1000):
+    """Return a list of up to `max_events` events, returning as soon as
+    there are that many or `max_wait_ms` milliseconds have passed. See
+    :meth:`_wmi_watcher.next_batch`.
+    """
+    self._check_queued ()
+    events = []
+    deadline = time.time () + max_wait_ms / 1000.0
+    while len (events) < max_events:
+      try:
+        events.append (self._events.get (timeout=max (0, deadline - time.time ())))
+      except queue.Empty:
+        if not events and self.error is not None:
+          raise self.error
+        break
+    return events
 
-  def query (self, wql, instance_of=None, fields=[]):
-    """Perform an arbitrary query against a WMI object, and return
-    a list of _wmi_object representations of the results.
+  def __iter__ (self):
+    while True:
+      yield self ()
+
+  def stop (self):
+    """Cancel the event query and, unless it's shared, finish the
+    watcher's dispatcher thread.
     """
-    return [ _wmi_object (obj, instance_of, fields) for obj in self._raw_query(wql) ]
+    self._stopped.set ()
+    #
+    # Cancel even a query which has failed, so the dispatcher lets go
+    # of its sink, but only once
+    #
+    subscription, self._subscription = self._subscription, None
+    if subscription is not None:
+      self._dispatcher.cancel (subscription)
+    if self._own_dispatcher:
+      self._dispatcher.stop ()
+
+class _wmi_async_query (object):
+  """Helper class for WMI.query_async (qv). The query is run with
+  `ExecQueryAsync` on a dispatcher thread of its own and its results are
+  passed through a bounded queue to whoever is iterating over this object,
+  either directly or as an asyncio asynchronous iterator.
+
+  The sink's callbacks hold this object only weakly, so that one which is
+  dropped before its results are exhausted -- by breaking out of an
+  `async for` loop, say -- is cancelled when it's collected, even if WMI
+  is being held up with the queue full.
+  """
 
-  def fetch_as_classes (self, wmi_classname, fields=(), **where_clause):
-    """Build and execute a wql query to fetch the specified list of fields from
-    the specified wmi_classname + where_clause, then return the results as
-    a list of simple class instances with attributes matching field_list.
+  _COMPLETED = object ()
+
+  def __init__ (self, namespace, wql, max_queued=1000, xml_rows=False):
+    self.wql = wql
+    self.xml_rows = xml_rows
+    self.received = 0
+    self.error = None
+    self._results = queue.Queue (max_queued)
+    self._finished = False
+    self._cancelled = threading.Event ()
+    self._dispatcher = _sink_dispatcher ()
+    try:
+      on_object_ready, on_completed = self._callbacks ()
+      self._subscription = self._dispatcher.subscribe (
+        namespace, wql, on_object_ready, on_completed, "ExecQueryAsync"
+      )
+    except:
+      self._dispatcher.stop ()
+      raise
 
-    If fields is left empty, select * and pre-load all class attributes for
-    each class returned.
+  def __repr__ (self):
+    return "<_wmi_async_query: %s>" % self.wql
+
+  def __del__ (self):
+    #
+    # Dropped before the results ran out. This can happen on the
+    # dispatcher's own thread, so only ask for the query to be
+    # cancelled and the thread to finish.
+    #
+    if not getattr (self, "_finished", True):
+      self._finished = True
+      self._cancelled.set ()
+      self._dispatcher.cancel (self._subscription, wait=False)
+      self._dispatcher.stop (wait=False)
+
+  def _callbacks (self):
+    """Return the sink's callbacks, which hold this object only while
+    they're using it, and never while waiting for room in the queue.
     """
-    wql = "SELECT %s FROM %s" % (fields and ", ".join (fields) or "*", wmi_classname)
-    if where_clause:
-      wql += " WHERE " + " AND ".join (["%s = '%s'" % (k, v) for k, v in where_clause.items()])
-    return [_wmi_result (obj, fields) for obj in self._raw_query(wql)]
+    ref = weakref.ref (self)
+    results, cancelled, completed = self._results, self._cancelled, self._COMPLETED
+
+    def put (item):
+      #
+      # Hold WMI up while the queue is full, unless the query is
+      # cancelled or whoever was iterating over it has gone
+      #
+      while not cancelled.isSet () and ref () is not None:
+        try:
+          results.put (item, timeout=0.1)
+        except queue.Full:
+          continue
+        else:
+          break
+
+    def on_object_ready (obj):
+      query = ref ()
+      if query is None:
+        return
+      query.received += 1
+      result = _wmi_result (obj, None, query.xml_rows)
+      query = None
+      put (result)
+
+    def on_completed (hresult):
+      query = ref ()
+      if query is None:
+        return
+      if hresult and not cancelled.isSet ():
+        query.error = x_wmi ("Query failed with %s" % hex (signed_to_unsigned (hresult)))
+      query = None
+      put (completed)
+
+    return on_object_ready, on_completed
+
+  def _next (self, timeout_secs=None):
+    """Return the next result, waiting up to `timeout_secs` for it, or
+    raise StopIteration once there are no more.
+    """
+    if self._finished:
+      raise StopIteration
+    while True:
+      try:
+        result = self._results.get (timeout=0.5 if timeout_secs is None else timeout_secs)
+      except queue.Empty:
+        if self._cancelled.isSet ():
+          result = self._COMPLETED
+        elif timeout_secs is not None:
+          raise x_wmi_timed_out ()
+        else:
+          continue
+      return self._result (result)
 
-  def fetch_as_lists (self, wmi_classname, fields, **where_clause):
-    """Build and execute a wql query to fetch the specified list of fields from
-    the specified wmi_classname + where_clause, then return the results as
-    a list of lists whose values correspond to field_list.
+  def _result (self, result):
+    if result is self._COMPLETED:
+      self._finish ()
+      if self.error is not None:
+        raise self.error
+      raise StopIteration
+    return result
+
+  def __iter__ (self):
+    try:
+      while True:
+        try:
+          result = self._next ()
+        except StopIteration:
+          return
+        yield result
+    finally:
+      self.cancel ()
+
+  def __aiter__ (self):
+    return self
+
+  def __anext__ (self):
+    import asyncio
+    loop = asyncio.get_event_loop ()
+    if not self._finished:
+      try:
+        result = self._results.get_nowait ()
+      except queue.Empty:
+        #
+        # Nothing's ready, so wait for it on another thread
+        #
+        return loop.run_in_executor (None, self._anext)
+    else:
+      result = self._COMPLETED
+    future = loop.create_future ()
+    try:
+      future.set_result (self._result (result))
+    except StopIteration:
+      future.set_exception (StopAsyncIteration ())
+    except x_wmi:
+      future.set_exception (sys.exc_info ()[1])
+    return future
+
+  def _anext (self):
+    try:
+      return self._next ()
+    except StopIteration:
+      raise StopAsyncIteration
+
+  def _done (self, result=None):
+    import asyncio
+    future = asyncio.get_event_loop ().create_future ()
+    future.set_result (result)
+    return future
+
+  def aclose (self):
+    """Cancel the query, as :meth:`cancel`; for use from asyncio, which
+    doesn't close an asynchronous iterator on leaving an `async for` loop
+    early. Using the query as an asynchronous context manager does::
+
+      async with c.query_async ("SELECT * FROM Win32_Process") as processes:
+        async for process in processes:
+          if process.Name == "python.exe":
+            break
     """
-    wql = "SELECT %s FROM %s" % (", ".join (fields), wmi_classname)
-    if where_clause:
-      wql += " WHERE " + " AND ".join (["%s = '%s'" % (k, v) for k, v in where_clause.items()])
-    results = []
-    for obj in self._raw_query(wql):
-        results.append ([obj.Properties_ (field).Value for field in fields])
-    return results
+    self.cancel ()
+    return self._done ()
+
+  def __aenter__ (self):
+    return self._done (self)
+
+  def __aexit__ (self, *exc_info):
+    return self.aclose ()
+
+  def _finish (self):
+    if not self._finished:
+      self._finished = True
+      #
+      # Stopping the dispatcher cancels the sink, which mustn't
+      # be taken for the query failing
+      #
+      self._cancelled.set ()
+      self._dispatcher.stop ()
+
+  def cancel (self):
+    """Cancel the query, if it's still running; any results not yet
+    picked up are discarded.
+    """
+    if self._finished:
+      return
+    if not self._cancelled.isSet ():
+      self._cancelled.set ()
+      self._dispatcher.cancel (self._subscription)
+    self._finish ()
 
-  def watch_for (
+#
+# class WatcherMultiplexer
+#
+class WatcherMultiplexer (object):
+  """Watches for any number of events at once -- across classes,
+  namespaces and machines -- on a single thread, yielding each as a
+  (key, event) pair in the order they arrive::
+
+    c = wmi.WMI ()
+    watchers = wmi.WatcherMultiplexer ()
+    watchers.add ("started", c.Win32_Process, "creation")
+    watchers.add ("stopped", c.Win32_Service, "modification", State="Stopped")
+    watchers.add ("errors", c, wmi_class="Win32_NTLogEvent", notification_type="creation", Type="error")
+    for key, event in watchers:
+      print key, event.timestamp
+
+  The events are pushed by WMI, as with :meth:`_wmi_namespace.watch_for_async`,
+  and are data-only copies. Each watcher's events are queued separately and
+  the watchers take turns, so a busy watcher can't crowd out the others:
+  each watcher with events waiting gets one picked up in every round.
+
+  If `max_queued_per_watcher` is given, a watcher with that many events
+  waiting holds up the delivery of any more -- its own and, as they share
+  a thread, the other watchers' -- until the caller has caught up. No
+  events are dropped; WMI holds them back in the meantime.
+  """
+
+  def __init__ (self, max_queued_per_watcher=0):
+    self.max_queued_per_watcher = max_queued_per_watcher
+    self._dispatcher = _sink_dispatcher ()
+    self._watchers = {}
+    self._queues = {}
+    self._turns = collections.deque ()
+    self._n_queued = 0
+    self._condition = threading.Condition ()
+
+  def __repr__ (self):
+    return "<WatcherMultiplexer: %s>" % ", ".join (str (key) for key in self._watchers)
+
+  def __len__ (self):
+    return len (self._watchers)
+
+  def add (
     self,
-    raw_wql=None,
+    key,
+    connection,
     notification_type="operation",
+    raw_wql=None,
     wmi_class=None,
     delay_secs=1,
     fields=[],
+    where=None,
     **where_clause
   ):
-    """Set up an event tracker on a WMI event. This function
-    returns an wmi_watcher which can be called to get the
-    next event::
-
-      c = wmi.WMI ()
-
-      raw_wql = "SELECT * FROM __InstanceCreationEvent WITHIN 2 WHERE TargetInstance ISA 'Win32_Process'"
-      watcher = c.watch_for (raw_wql=raw_wql)
-      while 1:
-        process_created = watcher ()
-        print process_created.Name
-
-      # or
-
-      watcher = c.watch_for (
-        notification_type="Creation",
-        wmi_class="Win32_Process",
-        delay_secs=2,
-        Name='calc.exe'
-      )
-      calc_created = watcher ()
-
-    Now supports timeout on the call to watcher::
-
-      import pythoncom
-      import wmi
-      c = wmi.WMI (privileges=["Security"])
-      watcher1 = c.watch_for (
-        notification_type="Creation",
-        wmi_class="Win32_NTLogEvent",
-        Type="error"
-      )
-      watcher2 = c.watch_for (
-        notification_type="Creation",
-        wmi_class="Win32_NTLogEvent",
-        Type="warning"
+    """Start watching for the events which `connection` -- a namespace or
+    one of its classes -- would watch for with :meth:`_wmi_namespace.watch_for`
+    and the same parameters, and yield them from the multiplexer under `key`.
+    """
+    if key in self._watchers:
+      raise x_wmi ("Already watching for %s" % key)
+    if isinstance (connection, _wmi_class):
+      wmi_class = connection
+      connection = connection._namespace
+    wql, is_extrinsic, fields = connection._watch_wql (raw_wql, notification_type, wmi_class, delay_secs, fields, where_clause, where)
+    self._condition.acquire ()
+    try:
+      self._queues[key] = collections.deque ()
+      self._turns.append (key)
+    finally:
+      self._condition.release ()
+    try:
+      watcher = _wmi_sink_watcher (
+        connection._namespace, wql, is_extrinsic,
+        callback=lambda event: self._arrived (key, event),
+        xml_rows=connection._xml_rows,
+        dispatcher=self._dispatcher
       )
+    except:
+      self._discard (key)
+      raise
+    self._watchers[key] = watcher
+
+  def remove (self, key):
+    """Stop watching for the events under `key`, discarding any not yet picked up"""
+    watcher = self._watchers.pop (key)
+    #
+    # Discarded first so that a delivery held up waiting for room in
+    # the queue gives up, leaving the dispatcher free to cancel the sink
+    #
+    self._discard (key)
+    watcher.stop ()
 
-      while 1:
-        try:
-          error_log = watcher1 (500)
-        except wmi.x_wmi_timed_out:
-          pythoncom.PumpWaitingMessages ()
-        else:
-          print error_log
+  def _discard (self, key):
+    self._condition.acquire ()
+    try:
+      events = self._queues.pop (key, None)
+      if events is not None:
+        self._n_queued -= len (events)
+        self._turns.remove (key)
+      self._condition.notify_all ()
+    finally:
+      self._condition.release ()
+
+  def watcher (self, key):
+    """Return the watcher for `key`, eg to see how many events it has received"""
+    return self._watchers[key]
+
+  def _arrived (self, key, event):
+    self._condition.acquire ()
+    try:
+      while True:
+        events = self._queues.get (key)
+        if events is None:
+          return
+        if not self.max_queued_per_watcher or len (events) < self.max_queued_per_watcher:
+          break
+        self._condition.wait ()
+      events.append (event)
+      self._n_queued += 1
+      self._condition.notify_all ()
+    finally:
+      self._condition.release ()
+
+  def _next_event (self):
+    #
+    # The watcher whose turn it is goes to the back of the line
+    # whether or not it had an event waiting
+    #
+    for i in range (len (self._turns)):
+      key = self._turns[0]
+      self._turns.rotate (-1)
+      events = self._queues[key]
+      if events:
+        self._n_queued -= 1
+        event = events.popleft ()
+        self._condition.notify_all ()
+        return key, event
 
-        try:
-          warning_log = watcher2 (500)
-        except wmi.x_wmi_timed_out:
-          pythoncom.PumpWaitingMessages ()
-        else:
-          print warning_log
+  def __call__ (self, timeout_ms=-1):
+    """Return the next (key, event) pair, waiting up to `timeout_ms`
+    milliseconds -- indefinitely by default -- for one. If none arrives in
+    that time, :exc:`x_wmi_timed_out` is raised. If a watcher has failed,
+    it's stopped and removed and its exception raised, with the watcher's
+    key as its `key` attribute.
     """
-    if raw_wql:
-      wql = raw_wql
-      is_extrinsic = False
+    if timeout_ms < 0:
+      deadline = None
     else:
-      if isinstance (wmi_class, _wmi_class):
-        class_name = wmi_class._class_name
-      else:
-        class_name = wmi_class
-        wmi_class = getattr (self, class_name)
-      is_extrinsic = "__ExtrinsicEvent" in wmi_class.derivation ()
-      fields = set (['TargetInstance'] + (fields or ["*"]))
-      field_list = ", ".join (fields)
-      if is_extrinsic:
-        if where_clause:
-          where = " WHERE " + " AND ".join (["%s = '%s'" % (k, v) for k, v in where_clause.items ()])
+      deadline = time.time () + timeout_ms / 1000.0
+    failed = None
+    self._condition.acquire ()
+    try:
+      while not self._n_queued:
+        for key, watcher in list (self._watchers.items ()):
+          if watcher.error is not None:
+            del self._watchers[key]
+            failed = key, watcher
+            break
+        if failed is not None:
+          break
+        if deadline is None:
+          wait_secs = 0.5
         else:
-          where = ""
-        wql = "SELECT " + field_list + " FROM " + class_name + where
+          wait_secs = deadline - time.time ()
+          if wait_secs <= 0:
+            raise x_wmi_timed_out ()
+        self._condition.wait (min (wait_secs, 0.5))
       else:
-        if where_clause:
-          where = " AND " + " AND ".join (["TargetInstance.%s = '%s'" % (k, v) for k, v in where_clause.items ()])
-        else:
-          where = ""
-        wql = \
-          "SELECT %s FROM __Instance%sEvent WITHIN %d WHERE TargetInstance ISA '%s' %s" % \
-          (field_list, notification_type, delay_secs, class_name, where)
+        return self._next_event ()
+    finally:
+      self._condition.release ()
+    #
+    # Stopped outside the lock: the dispatcher may be waiting for it
+    # to hand over an event
+    #
+    key, watcher = failed
+    self._discard (key)
+    watcher.stop ()
+    watcher.error.key = key
+    raise watcher.error
+
+  def __iter__ (self):
+    while True:
+      yield self ()
+
+  def stop (self):
+    """Stop every watcher and finish the dispatch thread"""
+    for key in list (self._watchers):
+      self.remove (key)
+    self._dispatcher.stop ()
+
+#
+# class ConnectionPool
+#
+class ConnectionPool (object):
+  """Keeps the namespaces returned by :func:`WMI` so that connecting
+  again with the same parameters -- computer, namespace, credentials,
+  security levels and privileges -- returns the existing connection
+  rather than making a new one::
+
+    wmi.default_pool = wmi.ConnectionPool (max_idle_secs=600)
+    for i in range (10):
+      c = wmi.WMI ("remote")    # connects only the first time
+
+  Pass a pool as the `pool` parameter to :func:`WMI`, or set
+  `wmi.default_pool` to pool every connection which doesn't say otherwise.
+
+  COM objects belong to the thread -- strictly, the apartment -- which
+  made them, so each thread gets its own connections. Connections unused
+  for `max_idle_secs` are dropped, as are the least recently used once one
+  thread has more than `max_per_host` to a host; one thread's connections
+  never push out another's. A connection which has been
+  idle for `check_after_secs` is checked with a cheap call before being
+  handed out and replaced if it has failed. A connection being dropped is
+  only released by the thread which made it, the next time that thread
+  uses the pool.
+  """
 
+  def __init__ (self, max_idle_secs=300, max_per_host=8, check_after_secs=30, clock=time.time):
+    self.max_idle_secs = max_idle_secs
+    self.max_per_host = max_per_host
+    self.check_after_secs = check_after_secs
+    self.clock = clock
+    self.hits = self.misses = self.evictions = self.failed_checks = 0
+    self._entries = {}
+    self._doomed = {}
+    self._lock = threading.Lock ()
+
+  def __repr__ (self):
+    return "<ConnectionPool: %d connections>" % len (self)
+
+  def __len__ (self):
+    return len (self._entries)
+
+  def get (self, key, host, connector):
+    """Return the pooled connection for `key` in this thread, calling
+    `connector` to make one if there is none or it has failed.
+    """
+    thread = threading.current_thread ()
+    key = key + (thread.ident,)
+    now = self.clock ()
+    self._lock.acquire ()
     try:
-      return _wmi_watcher (
-        self._namespace.ExecNotificationQuery (wql),
-        is_extrinsic=is_extrinsic,
-        fields=fields
-      )
-    except pywintypes.com_error:
-      handle_com_error ()
+      self._evict_idle (now)
+      doomed = self._doomed.pop (thread.ident, [])
+      entry = self._entries.get (key)
+      if entry is not None and entry["thread"] is not thread:
+        #
+        # The thread which made this connection has gone and its
+        # identity has been reused.
+        #
+        self._entries.pop (key)
+        entry = None
+    finally:
+      self._lock.release ()
+    del doomed[:]
+
+    if entry is not None and now - entry["last_used"] >= self.check_after_secs:
+      if not self._is_healthy (entry["connection"]):
+        self._lock.acquire ()
+        try:
+          self.failed_checks += 1
+          self._entries.pop (key, None)
+        finally:
+          self._lock.release ()
+        entry = None
 
-  def __getattr__ (self, attribute):
-    """Offer WMI classes as simple attributes. Pass through any untrapped
-    unattribute to the underlying OLE object. This means that new or
-    unmapped functionality is still available to the module user.
+    self._lock.acquire ()
+    try:
+      if entry is not None:
+        self.hits += 1
+        entry["last_used"] = now
+        return entry["connection"]
+      self.misses += 1
+    finally:
+      self._lock.release ()
+
+    connection = connector ()
+    if isinstance (connection, _wmi_namespace):
+      self._lock.acquire ()
+      try:
+        self._entries[key] = dict (connection=connection, host=host.lower (), thread=thread, last_used=now)
+        self._limit_host (host.lower (), thread)
+      finally:
+        self._lock.release ()
+    return connection
+
+  def clear (self):
+    """Drop every connection in the pool"""
+    self._lock.acquire ()
+    try:
+      for key in list (self._entries):
+        self._drop (key)
+    finally:
+      self._lock.release ()
+
+  def release (self):
+    """Drop and release every connection the calling thread made,
+    including any left for it to release, eg before the thread
+    uninitialises COM.
     """
-    #
-    # Don't try to match against known classes as was previously
-    # done since the list may not have been requested
-    # (find_classes=False).
-    #
+    thread = threading.current_thread ()
+    self._lock.acquire ()
     try:
-      return self._cached_classes (attribute)
+      for key, entry in list (self._entries.items ()):
+        if entry["thread"] is thread:
+          self._drop (key)
+      doomed = self._doomed.pop (thread.ident, [])
+    finally:
+      self._lock.release ()
+    del doomed[:]
+
+  def _is_healthy (self, connection):
+    try:
+      connection._namespace.Get ("__NAMESPACE")
     except pywintypes.com_error:
-      return getattr (self._namespace, attribute)
-
-  def _cached_classes (self, class_name):
-    """Standard caching helper which keeps track of classes
-    already retrieved by name and returns the existing object
-    if found. If this is the first retrieval, store it and
-    pass it back
+      return False
+    else:
+      return True
+
+  def _evict_idle (self, now):
+    for key, entry in list (self._entries.items ()):
+      if now - entry["last_used"] > self.max_idle_secs:
+        self._drop (key)
+
+  def _limit_host (self, host, thread):
+    keys = [
+      key for (key, entry) in self._entries.items ()
+        if entry["host"] == host and entry["thread"] is thread
+    ]
+    keys.sort (key=lambda k: self._entries[k]["last_used"])
+    for key in keys[:max (0, len (keys) - self.max_per_host)]:
+      self._drop (key)
+
+  def _drop (self, key):
+    """Remove a connection from the pool. If another thread made it,
+    leave it for that thread to release unless the thread has gone.
     """
-    if class_name not in self._classes_map:
-      self._classes_map[class_name] = _wmi_class (self, self._namespace.Get (class_name))
-    return self._classes_map[class_name]
+    entry = self._entries.pop (key)
+    self.evictions += 1
+    thread = entry["thread"]
+    if thread is not threading.current_thread () and thread.is_alive ():
+      self._doomed.setdefault (thread.ident, []).append (entry["connection"])
+
+def _pool_key (
+  computer, impersonation_level, authentication_level, authority, privileges,
+  moniker, namespace, suffix, user, password, find_classes, options
+):
+  """The parameters of a connection which make it distinct from any
+  other, for use as a key into a :class:`ConnectionPool`.
+  """
+  if password:
+    password = hashlib.sha1 (password.encode ("utf8")).hexdigest ()
+  return (
+    (computer or ".").lower (),
+    (namespace or "").lower ().replace ("\\", "/"),
+    (user or "").lower (),
+    password or "",
+    (authority or "").lower (),
+    str (impersonation_level or "").lower (),
+    str (authentication_level or "").lower (),
+    tuple (sorted ((p.lower () for p in (privileges or [])))),
+    (moniker or "").lower (),
+    (suffix or "").lower (),
+    bool (find_classes),
+    options
+  )
 
-  def _getAttributeNames (self):
-    """Return list of classes for IPython completion engine"""
-    return [x for x in self.classes if not x.startswith ('__')]
+#
+# Connections are only pooled if asked for, either by passing a
+# ConnectionPool to connect or by setting this one.
+#
+default_pool = None
 
 #
-# class _wmi_watcher
+# class ConcurrencyLimiter
 #
-class _wmi_watcher:
-  """Helper class for WMI.watch_for below (qv)"""
+# HRESULTs with which an overloaded host turns calls away, besides
+# WMI's own timeout: RPC_E_SERVERCALL_RETRYLATER and RPC_S_SERVER_TOO_BUSY.
+#
+_OVERLOADED_CODES = set ([
+  signed_to_unsigned (wbemErrTimedout),
+  signed_to_unsigned (constants.wbemErrServerTooBusy),
+  signed_to_unsigned (constants.wbemErrQuotaViolation),
+  0x8001010A,
+  0x800706BB,
+])
+
+def _is_overloaded (error):
+  """Whether an exception -- a COM error, or the :exc:`x_wmi` made
+  from one -- means the host is too busy to answer.
+  """
+  if isinstance (error, x_wmi_timed_out):
+    return True
+  if isinstance (error, x_wmi):
+    error = error.com_error
+  if not isinstance (error, pywintypes.com_error):
+    return False
+  return bool (_OVERLOADED_CODES.intersection (_error_codes (error)))
+
+class ConcurrencyLimiter (object):
+  """Limits how many calls run at once against each host, adjusting the
+  limit to suit the host: while calls come back within `target_latency_secs`
+  the limit creeps up, by about one for each round of calls which fill it, to
+  no more than `max_limit`; when a host times out or reports that it's
+  too busy or out of quota, its limit is cut by `backoff`, to no less
+  than `min_limit`. Calls beyond a host's limit wait for a slot::
+
+    limiter = wmi.ConcurrencyLimiter (target_latency_secs=5)
+    for host, results in wmi.fan_out (hosts, "SELECT * FROM Win32_Service", limiter=limiter):
+      ...
+    print limiter.metrics ()
+
+  Pass a limiter as the `limiter` parameter to :func:`WMI` and every
+  query against the namespace is run within it, as is making the
+  connection itself. A query holds its slot only until the first of its
+  results arrives, which is also what its latency measures: the caller
+  may take as long as it likes over the rest, and may query the same
+  host again while it does, without holding up other queries. An error
+  while the rest are read still counts against the host.
+  """
 
-  _event_property_map = {
-    "TargetInstance" : _wmi_object,
-    "PreviousInstance" : _wmi_object
-  }
-  def __init__ (self, wmi_event, is_extrinsic, fields=[]):
-    self.wmi_event = wmi_event
-    self.is_extrinsic = is_extrinsic
-    self.fields = fields
+  def __init__ (self, initial_limit=2, min_limit=1, max_limit=32, target_latency_secs=2.0, backoff=0.5, clock=time.time):
+    self.initial_limit = initial_limit
+    self.min_limit = min_limit
+    self.max_limit = max_limit
+    self.target_latency_secs = target_latency_secs
+    self.backoff = backoff
+    self.clock = clock
+    self._hosts = {}
+    self._condition = threading.Condition ()
 
-  def __call__ (self, timeout_ms=-1):
-    """When called, return the instance which caused the event. Supports
-     timeout in milliseconds (defaulting to infinite). If the watcher
-     times out, :exc:`x_wmi_timed_out` is raised. This makes it easy to support
-     watching for multiple objects.
+  def __repr__ (self):
+    return "<ConcurrencyLimiter: %d hosts>" % len (self._hosts)
+
+  def _host (self, host):
+    host = (host or ".").lower ()
+    state = self._hosts.get (host)
+    if state is None:
+      state = self._hosts[host] = dict (
+        limit=float (self.initial_limit), in_flight=0, peak=0,
+        calls=0, errors=0, overloaded=0, backoffs=0,
+        latency_secs=None, backed_off_at=None
+      )
+    return state
+
+  def acquire (self, host):
+    """Wait for a slot on `host` and return the time it was taken, to be
+    passed back to :meth:`release`.
     """
+    self._condition.acquire ()
     try:
-      event = self.wmi_event.NextEvent (timeout_ms)
-      if self.is_extrinsic:
-        return _wmi_event (event, None, self.fields)
+      state = self._host (host)
+      while state["in_flight"] >= int (state["limit"]):
+        self._condition.wait ()
+      state["in_flight"] += 1
+      state["peak"] = max (state["peak"], state["in_flight"])
+      return self.clock ()
+    finally:
+      self._condition.release ()
+
+  def release (self, host, started, error=None, latency_secs=None):
+    """Give back a slot on `host` taken at `started`, adjusting the host's
+    limit according to how long the call took and whether it failed.
+    """
+    self._finish (host, started, error, latency_secs, True)
+
+  def _free (self, host):
+    """Give back a slot on `host` before the outcome of its call is known"""
+    self._condition.acquire ()
+    try:
+      self._host (host)["in_flight"] -= 1
+      self._condition.notify_all ()
+    finally:
+      self._condition.release ()
+
+  def _finish (self, host, started, error, latency_secs, holding):
+    now = self.clock ()
+    if latency_secs is None:
+      latency_secs = now - started
+    self._condition.acquire ()
+    try:
+      state = self._host (host)
+      if holding:
+        state["in_flight"] -= 1
+      state["calls"] += 1
+      if error is not None and _is_overloaded (error):
+        state["overloaded"] += 1
+        #
+        # Calls which were already running when the limit was last
+        # cut were caught by the same overload, so don't cut again.
+        #
+        if state["backed_off_at"] is None or started >= state["backed_off_at"]:
+          state["limit"] = max (self.min_limit, state["limit"] * self.backoff)
+          state["backed_off_at"] = now
+          state["backoffs"] += 1
+      elif error is not None:
+        state["errors"] += 1
       else:
-        return _wmi_event (
-          event.Properties_ ("TargetInstance").Value,
-          _wmi_object (event, property_map=self._event_property_map),
-          self.fields
-        )
-    except pywintypes.com_error:
-      handle_com_error ()
+        if state["latency_secs"] is None:
+          state["latency_secs"] = latency_secs
+        else:
+          state["latency_secs"] = 0.8 * state["latency_secs"] + 0.2 * latency_secs
+        if latency_secs <= self.target_latency_secs:
+          state["limit"] = min (self.max_limit, state["limit"] + 1.0 / state["limit"])
+      self._condition.notify_all ()
+    finally:
+      self._condition.release ()
+
+  def call (self, host, function, *args, **kwargs):
+    """Call `function` within a slot on `host` and return its result"""
+    started = self.acquire (host)
+    error = None
+    try:
+      try:
+        return function (*args, **kwargs)
+      except Exception:
+        error = sys.exc_info ()[1]
+        raise
+    finally:
+      self.release (host, started, error)
+
+  def iterate (self, host, function, *args, **kwargs):
+    """Call `function` within a slot on `host` and return an iterator over
+    the iterable it returns which holds the slot until the first item
+    arrives, or there turn out to be none.
+    """
+    started = self.acquire (host)
+    try:
+      results = function (*args, **kwargs)
+    except Exception:
+      self.release (host, started, sys.exc_info ()[1])
+      raise
+    return self._iterate (host, started, results)
+
+  def _iterate (self, host, started, results):
+    error = latency_secs = None
+    holding = True
+    try:
+      try:
+        for item in results:
+          if holding:
+            latency_secs = self.clock () - started
+            self._free (host)
+            holding = False
+          yield item
+      except Exception:
+        error = sys.exc_info ()[1]
+        raise
+    finally:
+      self._finish (host, started, error, latency_secs, holding)
+
+  def metrics (self):
+    """Return a dictionary mapping each host to a dictionary of its current
+    `limit` and `in_flight` calls, the `peak` number in flight, counts of
+    `calls`, `errors`, `overloaded` errors and `backoffs`, and a moving
+    average of `latency_secs`.
+    """
+    self._condition.acquire ()
+    try:
+      metrics = {}
+      for host, state in self._hosts.items ():
+        metrics[host] = dict ((k, v) for (k, v) in state.items () if k != "backed_off_at")
+        metrics[host]["limit"] = int (state["limit"])
+      return metrics
+    finally:
+      self._condition.release ()
+
+def _limited (limiter, host, function, *args, **kwargs):
+  """Call `function` within a slot on `host` if there's a limiter"""
+  if limiter is None:
+    return function (*args, **kwargs)
+  else:
+    return limiter.call (host, function, *args, **kwargs)
+
+_moniker_server = re.compile (r"^(?:winmgmts:)?(?:\{[^}]*\})?!?(?://|\\\\)([^/\\]+)", re.I)
+def _moniker_host (moniker):
+  """Return the host a moniker connects to, lower-cased, or "." for
+  the local machine.
+  """
+  match = _moniker_server.match (moniker)
+  if match is None:
+    return "."
+  return match.group (1).lower ()
 
 PROTOCOL = "winmgmts:"
 def connect (
@@ -1226,7 +5217,13 @@ def connect (
   user="",
   password="",
   find_classes=False,
-  debug=False
+  debug=False,
+  schema_cache=None,
+  xml_rows=False,
+  query_cache=None,
+  pool=None,
+  limiter=None,
+  projection=None
 ):
   """The WMI constructor can either take a ready-made moniker or as many
   parts of one as are necessary. Eg::
@@ -1250,10 +5247,80 @@ def connect (
   name.
 
   If the `wmi` parameter is supplied, all other parameters are ignored.
+
+  If a `schema_cache` -- a :class:`SchemaCache` or the name of a directory --
+  is supplied, the definitions of classes picked up from the namespace are
+  kept on disk so that later processes needn't fetch them from WMI.
+
+  If `xml_rows` is true, objects returned by queries against the
+  namespace read all their values in a single call -- fetching the
+  object as CIM-XML -- rather than one call per property. This is much
+  quicker for wide rows, especially from remote machines. Values come
+  back typed from the CIM type of each property, so 64-bit integers are
+  ints rather than strings and arrays are tuples.
+
+  If a `query_cache` -- a :class:`QueryCache` -- is supplied, the results
+  of queries against the namespace are held there and reused by the
+  same query until they expire.
+
+  If a `pool` -- a :class:`ConnectionPool` -- is supplied, or
+  `wmi.default_pool` has been set, connecting again from the same thread
+  with the same parameters returns the same namespace. Pass `pool=False`
+  to connect afresh regardless.
+
+  If a `limiter` -- a :class:`ConcurrencyLimiter` -- is supplied, queries
+  against the namespace wait for a slot on its host and the host's limit
+  is adjusted according to how quickly, and whether, each is answered.
+
+  If a `projection` -- an :class:`AdaptiveProjection` -- is supplied,
+  class queries which don't give their own fields select only the
+  properties which their results have been seen to use.
   """
   global _DEBUG
   _DEBUG = debug
 
+  if pool is None:
+    pool = default_pool
+  if pool is not None and pool is not False and not wmi:
+    def _connect ():
+      return connect (
+        computer=computer,
+        impersonation_level=impersonation_level,
+        authentication_level=authentication_level,
+        authority=authority,
+        privileges=privileges,
+        moniker=moniker,
+        namespace=namespace,
+        suffix=suffix,
+        user=user,
+        password=password,
+        find_classes=find_classes,
+        debug=debug,
+        schema_cache=schema_cache,
+        xml_rows=xml_rows,
+        query_cache=query_cache,
+        pool=False,
+        limiter=limiter,
+        projection=projection
+      )
+    key = _pool_key (
+      computer, impersonation_level, authentication_level, authority, privileges,
+      moniker, namespace, suffix, user, password, find_classes,
+      (getattr (schema_cache, "directory", schema_cache), bool (xml_rows), id (query_cache), id (limiter), id (projection))
+    )
+    if moniker:
+      host = _moniker_host (moniker)
+    else:
+      host = computer or "."
+    return pool.get (key, host, _connect)
+
+  if wmi:
+    location = None
+  elif moniker:
+    location = (moniker, "")
+  else:
+    location = (computer or ".", namespace or "")
+
   try:
     try:
       if wmi:
@@ -1262,7 +5329,7 @@ def connect (
       elif moniker:
         if not moniker.startswith (PROTOCOL):
           moniker = PROTOCOL + moniker
-        obj = GetObject (moniker)
+        obj = _limited (limiter, _moniker_host (moniker), GetObject, moniker)
 
       else:
         if user:
@@ -1271,7 +5338,9 @@ def connect (
           elif computer in (None, '', '.'):
             raise x_wmi_authentication ("You can only specify user/password for a remote connection")
           else:
-            obj = connect_server (
+            obj = _limited (
+              limiter, computer,
+              connect_server,
               server=computer,
               namespace=namespace,
               user=user,
@@ -1291,12 +5360,15 @@ def connect (
             namespace=namespace,
             suffix=suffix
           )
-          obj = GetObject (moniker)
+          obj = _limited (limiter, computer or ".", GetObject, moniker)
 
       wmi_type = get_wmi_type (obj)
 
       if wmi_type == "namespace":
-        return _wmi_namespace (obj, find_classes)
+        return _wmi_namespace (
+          obj, find_classes, schema_cache, location, xml_rows, query_cache, limiter, projection,
+          principal=((user or "").lower (), (authority or "").lower ())
+        )
       elif wmi_type == "class":
         return _wmi_class (None, obj)
       elif wmi_type == "instance":
@@ -1389,7 +5461,7 @@ def connect_server (
   #
   if impersonation_level:
     try:
-      impersonation = getattr (obj._constants, "wbemImpersonationLevel%s" % impersonation_level.title ())
+      impersonation = getattr (constants, "wbemImpersonationLevel%s" % impersonation_level.title ())
     except AttributeError:
       raise x_wmi_authentication ("No such impersonation level: %s" % impersonation_level)
   else:
@@ -1397,7 +5469,7 @@ def connect_server (
 
   if authentication_level:
     try:
-      authentication = getattr (obj._constants, "wbemAuthenticationLevel%s" % authentication_level.title ())
+      authentication = getattr (constants, "wbemAuthenticationLevel%s" % authentication_level.title ())
     except AttributeError:
       raise x_wmi_authentication ("No such impersonation level: %s" % impersonation_level)
   else:
@@ -1447,6 +5519,575 @@ def Registry (
   except pywintypes.com_error:
     handle_com_error ()
 
+#
+# Running calls on many threads at once
+#
+def _run_threaded (tasks, max_workers=16, timeout_secs=None, group=None, max_per_group=None):
+  """Run each of `tasks` -- a (key, function) pair -- on a thread of its
+  own with COM initialised for the multithreaded apartment, no more than
+  `max_workers` at a time. Yield (key, result) as each finishes, where the
+  result is whatever the function returned or the exception it raised.
+
+  If `group` is given, it is called with each key and no more than
+  `max_per_group` tasks of the same group -- typically the same host --
+  run at once; tasks whose group is busy wait their turn while others
+  go ahead of them. Tasks are taken from `tasks` only as they're needed,
+  with at most `max_workers` of them waiting on busy groups.
+
+  A task still running `timeout_secs` after it started yields
+  :exc:`x_wmi_timed_out`. Its thread can't be stopped, so it is left to
+  finish in the background, and it goes on counting against
+  `max_workers` and its group until it does: no more than `max_workers`
+  threads are ever alive at once. If hung threads leave nothing able to
+  start, the run waits up to `timeout_secs` for one of them to finish;
+  failing that, every task not yet started yields :exc:`x_wmi_timed_out`
+  too, so that the run as a whole is bounded.
+  """
+  results = queue.Queue ()
+  tasks = iter (tasks)
+  running = {}
+  abandoned = {}
+  exhausted = False
+  n_tasks = 0
+  waiting = collections.deque ()
+  n_running = collections.defaultdict (int)
+  stalled_since = None
+
+  def has_room (key):
+    return group is None or n_running[group (key)] < max_per_group
+
+  def next_task ():
+    """Return the next task whose group has room, or None"""
+    for n, (key, function) in enumerate (waiting):
+      if has_room (key):
+        del waiting[n]
+        return key, function
+    while not exhausted and len (waiting) < max_workers:
+      key, function = next (tasks)
+      if has_room (key):
+        return key, function
+      waiting.append ((key, function))
+    return None
+
+  def finished (token):
+    if token in running:
+      key, deadline = running.pop (token)
+    else:
+      key = abandoned.pop (token)
+    if group is not None:
+      n_running[group (key)] -= 1
+    return key
+
+  def worker (token, function):
+    pythoncom.CoInitializeEx (pythoncom.COINIT_MULTITHREADED)
+    try:
+      try:
+        result = function ()
+      except Exception:
+        result = sys.exc_info ()[1]
+      results.put ((token, result))
+    finally:
+      function = result = None
+      pythoncom.CoUninitialize ()
+
+  while True:
+    while len (running) + len (abandoned) < max_workers:
+      try:
+        task = next_task ()
+      except StopIteration:
+        exhausted = True
+        task = next_task ()
+      if task is None:
+        break
+      key, function = task
+      if group is not None:
+        n_running[group (key)] += 1
+      n_tasks += 1
+      if timeout_secs is None:
+        deadline = None
+      else:
+        deadline = time.time () + timeout_secs
+      running[n_tasks] = (key, deadline)
+      thread = threading.Thread (target=worker, args=(n_tasks, function))
+      thread.daemon = True
+      thread.start ()
+    if not running and exhausted and not waiting:
+      break
+
+    #
+    # With nothing running but tasks still to start, only a hung thread
+    # finishing can free a slot for them
+    #
+    if running or timeout_secs is None:
+      stalled_since = None
+    elif stalled_since is None:
+      stalled_since = time.time ()
+
+    deadlines = [deadline for (key, deadline) in running.values () if deadline is not None]
+    if stalled_since is not None:
+      deadlines.append (stalled_since + timeout_secs)
+    if deadlines:
+      wait_secs = max (0, min (deadlines) - time.time ())
+    else:
+      wait_secs = None
+    try:
+      token, result = results.get (timeout=wait_secs)
+    except queue.Empty:
+      now = time.time ()
+      for token, (key, deadline) in list (running.items ()):
+        if deadline is not None and deadline <= now:
+          del running[token]
+          abandoned[token] = key
+          yield key, x_wmi_timed_out ("No result after %s secs" % timeout_secs)
+      if stalled_since is not None and stalled_since + timeout_secs <= now:
+        stalled_since = None
+        while waiting:
+          key, function = waiting.popleft ()
+          yield key, x_wmi_timed_out ("Not started after %s secs: hung calls hold every slot it could use" % timeout_secs)
+        for key, function in tasks:
+          yield key, x_wmi_timed_out ("Not started after %s secs: hung calls hold every slot it could use" % timeout_secs)
+        exhausted = True
+    else:
+      stalled_since = None
+      #
+      # A task which has already timed out may still finish, freeing
+      # its group for the tasks waiting on it
+      #
+      if token in running:
+        yield finished (token), result
+      else:
+        finished (token)
+
+def _query_as_results (wql):
+  """Return a function which runs `wql` against a connection and
+  returns data-only copies of the results, fit to be handed to
+  another thread.
+  """
+  def query (connection):
+    return [_wmi_result (obj, None, connection._xml_rows) for obj in connection._raw_query (wql)]
+  return query
+
+def fan_out (hosts, query, max_workers=16, timeout_secs=None, connector=None, **connect_args):
+  """Connect to each of `hosts` and run the same query against it, many
+  hosts at once, yielding (host, results) for each as it finishes::
+
+    import wmi
+    hosts = ["server%03d" % i for i in range (800)]
+    for host, results in wmi.fan_out (hosts, "SELECT Caption, FreeSpace FROM Win32_LogicalDisk", timeout_secs=60):
+      if isinstance (results, Exception):
+        print host, "failed:", results
+      else:
+        for disk in results:
+          print host, disk.Caption, disk.FreeSpace
+
+  `query` is either a WQL string, whose results come back as simple
+  data-only objects like those from :meth:`_wmi_namespace.fetch_as_classes`,
+  or a function which is passed the connection and whose return value is
+  passed back. Either way, the work is done on the worker's own thread, so
+  anything returned should be plain data rather than WMI objects.
+
+  No more than `max_workers` hosts are worked on at once. A host which
+  fails yields the exception raised; a host which hasn't finished within
+  `timeout_secs` yields :exc:`x_wmi_timed_out` and is abandoned, though
+  its thread counts against `max_workers` until it finishes. Any other
+  keyword arguments are passed to `connector` -- by default :func:`WMI` --
+  along with each host as `computer`.
+  """
+  if connector is None:
+    connector = connect
+  if not callable (query):
+    query = _query_as_results (query)
+
+  def task (host):
+    return lambda: query (connector (computer=host, **connect_args))
+  return _run_threaded (((host, task (host)) for host in hosts), max_workers, timeout_secs)
+
+def _map_chunk (function, snapshots):
+  return [function (snapshot) for snapshot in snapshots]
+
+def map_snapshots (function, objects, chunksize=100, processes=None):
+  """Apply `function` to each of `objects` in a pool of worker processes,
+  yielding the results in the same order as the objects::
+
+    import wmi
+
+    def summarise (process):
+      return process.Name, len (process.CommandLine or "")
+
+    if __name__ == "__main__":
+      c = wmi.WMI ()
+      for name, length in wmi.map_snapshots (summarise, c.Win32_Process ()):
+        print name, length
+
+  Live WMI objects can't leave the process they were fetched in, so each
+  is frozen (see :meth:`_wmi_object.freeze`) in the calling thread and the
+  snapshots are sent to the workers `chunksize` at a time; snapshots
+  already frozen are sent as they are. `function` must be picklable, ie
+  defined at the top level of a module, and so must whatever it returns.
+  `processes` defaults to the number of CPUs. Only a few chunks per
+  worker are frozen ahead of the results being consumed, so a long
+  query result is never held in full.
+  """
+  import multiprocessing
+  if processes is None:
+    processes = multiprocessing.cpu_count ()
+  pool = multiprocessing.Pool (processes)
+  try:
+    pending = collections.deque ()
+    chunk = []
+    for obj in objects:
+      if not isinstance (obj, _wmi_snapshot):
+        obj = obj.freeze ()
+      chunk.append (obj)
+      if len (chunk) >= chunksize:
+        pending.append (pool.apply_async (_map_chunk, (function, chunk)))
+        chunk = []
+        while len (pending) > 2 * processes:
+          for result in pending.popleft ().get ():
+            yield result
+    if chunk:
+      pending.append (pool.apply_async (_map_chunk, (function, chunk)))
+    while pending:
+      for result in pending.popleft ().get ():
+        yield result
+    pool.close ()
+  finally:
+    pool.terminate ()
+    pool.join ()
+
+#
+# asyncio front end
+#
+def _event_as_result (event):
+  """Return a data-only copy of a :class:`_wmi_event`, including the
+  type of event, its timestamp and any previous instance.
+  """
+  result = _wmi_result (event.ole_object, None)
+  result.event_type = event.event_type
+  result.timestamp = event.timestamp
+  if event.previous is None:
+    result.previous = None
+  else:
+    result.previous = _wmi_result (event.previous.ole_object, None)
+  return result
+
+def _then (source, function, future=None):
+  """Return a future -- `future` if given -- for the result of
+  `function` applied to the result of the future `source`. (The module
+  avoids coroutine syntax so as to remain importable by Python 2).
+  """
+  if future is None:
+    future = source.get_loop ().create_future ()
+  def done (source):
+    if future.done ():
+      return
+    if source.cancelled ():
+      future.cancel ()
+      return
+    exception = source.exception ()
+    if exception is not None:
+      future.set_exception (exception)
+      return
+    try:
+      function (source.result (), future)
+    except Exception:
+      future.set_exception (sys.exc_info ()[1])
+  source.add_done_callback (done)
+  return future
+
+class _async_results (object):
+  """Asynchronous iterator over the results of a query, fetching them in
+  batches of `batch_size` on the :class:`AsyncWMI` thread pool.
+  """
+
+  def __init__ (self, async_wmi, wql, fields=[], batch_size=100):
+    self._async_wmi = async_wmi
+    self._wql = wql
+    self._fields = fields
+    self._batch_size = batch_size
+    self._results = None
+    self._batch = []
+    self._finished = False
+
+  def __aiter__ (self):
+    return self
+
+  def __anext__ (self):
+    future = self._async_wmi._loop ().create_future ()
+    if self._batch:
+      future.set_result (self._batch.pop (0))
+    elif self._finished:
+      future.set_exception (StopAsyncIteration ())
+    else:
+      _then (self._async_wmi._run (self._fetch), self._fetched, future)
+    return future
+
+  def _fetch (self):
+    if self._results is None:
+      connection = self._async_wmi._connect ()
+      self._results = iter (connection._raw_query (self._wql))
+    batch = []
+    for obj in self._results:
+      batch.append (_wmi_result (obj, self._fields))
+      if len (batch) >= self._batch_size:
+        break
+    else:
+      self._results = None
+      self._finished = True
+    return batch
+
+  def _fetched (self, batch, future):
+    if batch:
+      self._batch = batch
+      future.set_result (self._batch.pop (0))
+    else:
+      future.set_exception (StopAsyncIteration ())
+
+class _async_watcher (object):
+  """Asynchronous iterator over the events of a :meth:`_wmi_namespace.watch_for`,
+  each waited for on the :class:`AsyncWMI` thread pool.
+  """
+
+  def __init__ (self, async_wmi, watch_args, poll_ms=1000):
+    self._async_wmi = async_wmi
+    self._watch_args = watch_args
+    self._poll_ms = poll_ms
+    self._watcher = None
+
+  def __aiter__ (self):
+    return self
+
+  def __anext__ (self):
+    return self.next_event ()
+
+  def _next_event (self):
+    if self._watcher is None:
+      connection = self._async_wmi._connect ()
+      self._watcher = connection.watch_for (**self._watch_args)
+    try:
+      return _event_as_result (self._watcher (self._poll_ms))
+    except x_wmi_timed_out:
+      return None
+
+  def next_event (self):
+    """Return a future for the next event. The wait is broken into
+    `poll_ms` slices so that a pool thread is never tied up for long.
+    """
+    future = self._async_wmi._loop ().create_future ()
+    def waited (event, future):
+      if event is None:
+        _then (self._async_wmi._run (self._next_event), waited, future)
+      else:
+        future.set_result (event)
+    return _then (self._async_wmi._run (self._next_event), waited, future)
+
+class _async_class (object):
+  """Asynchronous counterpart of :class:`_wmi_class`: its query returns a
+  future and its methods return futures for their results.
+  """
+
+  def __init__ (self, async_wmi, class_name):
+    self._async_wmi = async_wmi
+    self._class_name = class_name
+
+  def __repr__ (self):
+    return "<_async_class: %s>" % self._class_name
+
+  def _query_wql (self, fields, where_clause):
+    #
+    # Built from the class name alone so that nothing need be
+    # fetched from WMI on the event loop's thread.
+    #
+    return _class_query_wql (self._class_name, fields, where_clause)
+
+  def query (self, fields=[], **where_clause):
+    return self._async_wmi._run (
+      lambda: self._async_wmi._query (self._query_wql (fields, where_clause), fields)
+    )
+
+  __call__ = query
+
+  def iquery (self, fields=[], batch_size=100, **where_clause):
+    return _async_results (self._async_wmi, self._query_wql (fields, where_clause), fields, batch_size)
+
+  def watch_for (self, notification_type="operation", delay_secs=1, fields=[], **where_clause):
+    watch_args = dict (where_clause)
+    watch_args.update (
+      notification_type=notification_type,
+      wmi_class=self._class_name,
+      delay_secs=delay_secs,
+      fields=fields
+    )
+    return _async_watcher (self._async_wmi, watch_args)
+
+  def __getattr__ (self, attribute):
+    if attribute.startswith ("_"):
+      raise AttributeError (attribute)
+    def method (*args, **kwargs):
+      return self._async_wmi._run (
+        lambda: getattr (self._async_wmi._class (self._class_name), attribute) (*args, **kwargs)
+      )
+    method.__name__ = attribute
+    return method
+
+class AsyncWMI (object):
+  """An asyncio front end to a WMI namespace. Queries, method calls and
+  watchers run on a pool of threads with COM initialised, each keeping
+  its own connection, and hand back futures which can be awaited
+  without blocking the event loop::
+
+    async def main ():
+      c = wmi.AsyncWMI ("remote")
+      for process in await c.Win32_Process (["Name", "ProcessId"]):
+        print (process.Name)
+      async for service in c.Win32_Service.iquery (State="Running"):
+        print (service.Name)
+      print (await c.Win32_Process.Create (CommandLine="notepad.exe"))
+      async for event in c.Win32_Process.watch_for ("creation"):
+        print (event.Name, event.timestamp)
+
+  Results are data-only copies -- see :meth:`_wmi_namespace.fetch_as_classes`
+  -- since the underlying WMI objects belong to the pool's threads.
+  Parameters other than `max_workers`, `pool` and `connector` are passed
+  to :func:`WMI`. Each thread keeps its connection in `pool`, by default
+  a :class:`ConnectionPool` with room for one per thread. Call
+  :meth:`close` when finished with.
+  """
+
+  def __init__ (self, computer="", max_workers=16, pool=None, connector=None, **connect_args):
+    from concurrent.futures import ThreadPoolExecutor
+    self._connect_args = dict (connect_args, computer=computer)
+    self._connector = connector or connect
+    if pool is None:
+      pool = ConnectionPool (max_per_host=max_workers)
+    self._pool = pool
+    self._threads = set ()
+    self._threads_lock = threading.Lock ()
+    self._executor = ThreadPoolExecutor (
+      max_workers=max_workers,
+      thread_name_prefix="wmi",
+      initializer=self._start_thread
+    )
+
+  def _start_thread (self):
+    pythoncom.CoInitializeEx (pythoncom.COINIT_MULTITHREADED)
+    self._threads_lock.acquire ()
+    try:
+      self._threads.add (threading.current_thread ())
+    finally:
+      self._threads_lock.release ()
+
+  def _finish_thread (self, finished, done):
+    """Release this thread's connections and COM, if it hasn't already,
+    and hold on to the thread until every thread has been finished, so
+    that the executor hands the others' turns to them.
+    """
+    thread = threading.current_thread ()
+    self._threads_lock.acquire ()
+    try:
+      mine = thread in self._threads
+      self._threads.discard (thread)
+    finally:
+      self._threads_lock.release ()
+    try:
+      if mine:
+        self._pool.release ()
+        pythoncom.CoUninitialize ()
+    finally:
+      done.put (thread)
+    finished.wait ()
+
+  def __repr__ (self):
+    return "<AsyncWMI: %s>" % (self._connect_args.get ("computer") or ".")
+
+  def __getattr__ (self, attribute):
+    if attribute.startswith ("_"):
+      raise AttributeError (attribute)
+    return _async_class (self, attribute)
+
+  def _loop (self):
+    import asyncio
+    try:
+      return asyncio.get_running_loop ()
+    except (AttributeError, RuntimeError):
+      return asyncio.get_event_loop ()
+
+  def _run (self, function):
+    return self._loop ().run_in_executor (self._executor, function)
+
+  def _connect (self):
+    if self._connector is connect:
+      return connect (pool=self._pool, **self._connect_args)
+    else:
+      return self._connector (**self._connect_args)
+
+  def _class (self, class_name):
+    return getattr (self._connect (), class_name)
+
+  def _query (self, wql, fields=[]):
+    return [_wmi_result (obj, fields) for obj in self._connect ()._raw_query (wql)]
+
+  def query (self, wql, fields=[]):
+    """Return a future for the data-only results of `wql`"""
+    return self._run (lambda: self._query (wql, fields))
+
+  def iquery (self, wql, fields=[], batch_size=100):
+    """Return an asynchronous iterator over the data-only results of
+    `wql`, fetched from WMI `batch_size` at a time.
+    """
+    return _async_results (self, wql, fields, batch_size)
+
+  def call (self, moniker, method_name, *args, **kwargs):
+    """Return a future for the result of calling `method_name` on the
+    object at `moniker`, eg `Win32_Service.Name="Spooler"`.
+    """
+    return self._run (
+      lambda: getattr (self._connect ().get (moniker), method_name) (*args, **kwargs)
+    )
+
+  def watch_for (self, raw_wql=None, notification_type="operation", wmi_class=None, delay_secs=1, fields=[], **where_clause):
+    """Return an asynchronous iterator over the events which
+    :meth:`_wmi_namespace.watch_for` would return.
+    """
+    watch_args = dict (where_clause)
+    watch_args.update (
+      raw_wql=raw_wql,
+      notification_type=notification_type,
+      wmi_class=wmi_class,
+      delay_secs=delay_secs,
+      fields=fields
+    )
+    return _async_watcher (self, watch_args)
+
+  def close (self):
+    """Wait for outstanding calls and shut down the thread pool, having
+    each of its threads release its connections and uninitialise COM.
+    """
+    #
+    # COM objects must be released by the thread which made them, so
+    # each thread is handed a call to finish itself. A thread started
+    # to take one of those calls finishes itself instead, leaving one
+    # of the older threads for another round.
+    #
+    finished = threading.Event ()
+    done = queue.Queue ()
+    try:
+      while True:
+        self._threads_lock.acquire ()
+        try:
+          n_threads = len (self._threads)
+        finally:
+          self._threads_lock.release ()
+        if not n_threads:
+          break
+        for n in range (n_threads):
+          self._executor.submit (self._finish_thread, finished, done)
+        for n in range (n_threads):
+          done.get ()
+    finally:
+      finished.set ()
+      self._executor.shutdown (wait=True)
+
 #
 # Typical use test
 #
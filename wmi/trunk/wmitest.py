@@ -20,7 +20,15 @@ try:
   import ConfigParser
 except ImportError:
   import configparser as ConfigParser
+try:
+  import cPickle as pickle
+except ImportError:
+  import pickle
+import gc
+import json
 import operator
+import re
+import shutil
 try:
   import Queue
 except ImportError:
@@ -37,6 +45,7 @@ import unittest
 import warnings
 
 import pythoncom
+import pywintypes
 import win32api
 import win32con
 import win32file
@@ -62,6 +71,274 @@ if set (["domain", "machine"]) <= set (settings):
 PRIVILEGES = [None, ['security', '!shutdown']]
 NAMESPACES = [None, "root/cimv2", "default"]
 
+#
+# Fakes standing in for the WbemScripting objects so that the module's
+# own bookkeeping can be tested -- and its COM traffic counted --
+# without needing a particular WMI setup. Every access to one of the
+# COM-side collections is tallied in a shared calls dictionary.
+#
+class FakeCalls (dict):
+
+  def count (self, name):
+    self[name] = self.get (name, 0) + 1
+
+  def total (self):
+    return sum (self.values ())
+
+class FakeNamed (object):
+
+  def __init__ (self, name, value=None, **kwargs):
+    self.Name = name
+    self.Value = value
+    self.__dict__.update (kwargs)
+
+class FakeCollection (object):
+
+  def __init__ (self, items, calls, name):
+    self._items = list (items)
+    self._calls = calls
+    self._name = name
+
+  def __iter__ (self):
+    self._calls.count (self._name)
+    return iter (self._items)
+
+  def __call__ (self, name):
+    self._calls.count (self._name + "()")
+    for item in self._items:
+      if item.Name.lower () == name.lower ():
+        return item
+    raise pywintypes.com_error (-2147217406, "Not found", None, None)
+
+  def __getitem__ (self, index):
+    self._calls.count (self._name + "[]")
+    return self._items[index]
+
+  @property
+  def Count (self):
+    return len (self._items)
+
+class FakePath (object):
+
+  def __init__ (self, server, namespace, class_name, keys=None):
+    self.Server = server
+    self.Namespace = namespace
+    self.Class = class_name
+    self.IsClass = keys is None
+    if keys is None:
+      self.RelPath = class_name
+    else:
+      self.RelPath = class_name + "." + ",".join ('%s="%s"' % (k, v) for (k, v) in keys)
+    self.Path = "\\\\%s\\%s:%s" % (server, namespace, self.RelPath)
+    self.Keys = [FakeNamed (k, v) for (k, v) in (keys or [])]
+    self.DisplayName = "WINMGMTS:{authenticationLevel=pkt,impersonationLevel=impersonate}!" + self.Path
+
+class FakeSWbemObject (object):
+  """A class or instance with named, typed properties. `properties` is a
+  list of (name, cimtype, value) and the first `n_keys` of them are keys.
+  """
+
+  def __init__ (self, class_name, properties, n_keys=1, methods=(), calls=None, is_class=False, server="HOST", namespace="root\\cimv2", text=None):
+    self._calls = calls if calls is not None else FakeCalls ()
+    self._class_name = class_name
+    self._text = text
+    self._properties = []
+    for n, (name, cimtype, value) in enumerate (properties):
+      qualifiers = [FakeNamed ("CIMTYPE", cimtype)]
+      if n < n_keys:
+        qualifiers.append (FakeNamed ("key", True))
+      self._properties.append (
+        FakeNamed (name, value, CIMType=cimtype, IsArray=False, Qualifiers_=FakeCollection (qualifiers, self._calls, "Qualifiers_"))
+      )
+    self._methods = [FakeNamed (m) for m in methods]
+    if is_class:
+      keys = None
+    else:
+      keys = [(p.Name, p.Value) for p in self._properties[:n_keys]]
+    self._path = FakePath (server, namespace, class_name, keys)
+
+  @property
+  def Path_ (self):
+    self._calls.count ("Path_")
+    return self._path
+
+  @property
+  def Properties_ (self):
+    return FakeCollection (self._properties, self._calls, "Properties_")
+
+  @property
+  def Methods_ (self):
+    return FakeCollection (self._methods, self._calls, "Methods_")
+
+  @property
+  def Qualifiers_ (self):
+    return FakeCollection ([FakeNamed ("dynamic", True)], self._calls, "Qualifiers_")
+
+  def GetObjectText_ (self):
+    return "instance of %s" % self._class_name
+
+  def Put_ (self):
+    self._calls.count ("Put_")
+
+  def __getattr__ (self, attribute):
+    #
+    # SWbemObject offers its properties as attributes too
+    #
+    if attribute.startswith ("_"):
+      raise AttributeError (attribute)
+    self._calls.count ("." + attribute)
+    for p in self._properties:
+      if p.Name == attribute:
+        return p.Value
+    raise AttributeError (attribute)
+
+  def GetText_ (self, iObjectTextFormat, iFlags=0):
+    self._calls.count ("GetText_")
+    return self._text
+
+DISK_PROPERTIES = [
+  ("DeviceID", "string"),
+  ("Caption", "string"),
+  ("DriveType", "uint32"),
+  ("FreeSpace", "uint64"),
+  ("Size", "uint64"),
+  ("VolumeName", "string"),
+]
+DISK_METHODS = ["Chkdsk", "Reset", "SetPowerState"]
+
+def fake_disks (n, calls=None):
+  calls = calls if calls is not None else FakeCalls ()
+  return [
+    FakeSWbemObject (
+      "Win32_LogicalDisk",
+      [(name, cimtype, value) for ((name, cimtype), value) in zip (DISK_PROPERTIES, ["%d:" % i, "%d:" % i, 3, str (i * 1000), str (i * 2000), "Vol%d" % i])],
+      methods=DISK_METHODS,
+      calls=calls
+    ) for i in range (n)
+  ]
+
+def fake_disk_class (calls=None, extra_properties=[]):
+  return FakeSWbemObject (
+    "Win32_LogicalDisk",
+    [(name, cimtype, None) for (name, cimtype) in DISK_PROPERTIES + extra_properties],
+    methods=DISK_METHODS,
+    calls=calls,
+    is_class=True
+  )
+
+#
+# GetText_ (wbemObjectTextFormatCIMDTD20) output recorded from
+# a Windows machine, trimmed to the properties used here.
+#
+DISK_XML = (
+  '<INSTANCE CLASSNAME="Win32_LogicalDisk">'
+  '<QUALIFIER NAME="dynamic" PROPAGATED="true" TYPE="boolean" TOINSTANCE="true"><VALUE>TRUE</VALUE></QUALIFIER>'
+  '<QUALIFIER NAME="Locale" PROPAGATED="true" TYPE="sint32" TOINSTANCE="true"><VALUE>1033</VALUE></QUALIFIER>'
+  '<PROPERTY NAME="Access" CLASSORIGIN="CIM_StorageExtent" PROPAGATED="true" TYPE="uint16"><QUALIFIER NAME="CIMTYPE" PROPAGATED="true" TYPE="string" TOINSTANCE="true"><VALUE>uint16</VALUE></QUALIFIER><VALUE>0</VALUE></PROPERTY>'
+  '<PROPERTY NAME="BlockSize" CLASSORIGIN="CIM_StorageExtent" PROPAGATED="true" TYPE="uint64"><QUALIFIER NAME="CIMTYPE" PROPAGATED="true" TYPE="string" TOINSTANCE="true"><VALUE>uint64</VALUE></QUALIFIER></PROPERTY>'
+  '<PROPERTY NAME="Caption" CLASSORIGIN="CIM_ManagedSystemElement" PROPAGATED="true" TYPE="string"><QUALIFIER NAME="CIMTYPE" PROPAGATED="true" TYPE="string" TOINSTANCE="true"><VALUE>string</VALUE></QUALIFIER><VALUE>C:</VALUE></PROPERTY>'
+  '<PROPERTY NAME="Compressed" CLASSORIGIN="Win32_LogicalDisk" TYPE="boolean"><QUALIFIER NAME="CIMTYPE" PROPAGATED="true" TYPE="string" TOINSTANCE="true"><VALUE>boolean</VALUE></QUALIFIER><VALUE>FALSE</VALUE></PROPERTY>'
+  '<PROPERTY NAME="DeviceID" CLASSORIGIN="CIM_LogicalDevice" PROPAGATED="true" TYPE="string"><QUALIFIER NAME="CIMTYPE" PROPAGATED="true" TYPE="string" TOINSTANCE="true"><VALUE>string</VALUE></QUALIFIER><QUALIFIER NAME="key" PROPAGATED="true" TYPE="boolean" OVERRIDABLE="false" TOINSTANCE="true"><VALUE>TRUE</VALUE></QUALIFIER><VALUE>C:</VALUE></PROPERTY>'
+  '<PROPERTY NAME="DriveType" CLASSORIGIN="Win32_LogicalDisk" TYPE="uint32"><QUALIFIER NAME="CIMTYPE" PROPAGATED="true" TYPE="string" TOINSTANCE="true"><VALUE>uint32</VALUE></QUALIFIER><VALUE>3</VALUE></PROPERTY>'
+  '<PROPERTY NAME="FreeSpace" CLASSORIGIN="Win32_LogicalDisk" TYPE="uint64"><QUALIFIER NAME="CIMTYPE" PROPAGATED="true" TYPE="string" TOINSTANCE="true"><VALUE>uint64</VALUE></QUALIFIER><VALUE>42817421312</VALUE></PROPERTY>'
+  '<PROPERTY.ARRAY NAME="PowerManagementCapabilities" CLASSORIGIN="CIM_LogicalDevice" PROPAGATED="true" TYPE="uint16"><QUALIFIER NAME="CIMTYPE" PROPAGATED="true" TYPE="string" TOINSTANCE="true"><VALUE>uint16</VALUE></QUALIFIER><VALUE.ARRAY><VALUE>1</VALUE><VALUE>4</VALUE></VALUE.ARRAY></PROPERTY.ARRAY>'
+  '<PROPERTY NAME="Size" CLASSORIGIN="Win32_LogicalDisk" TYPE="uint64"><QUALIFIER NAME="CIMTYPE" PROPAGATED="true" TYPE="string" TOINSTANCE="true"><VALUE>uint64</VALUE></QUALIFIER><VALUE>126696288256</VALUE></PROPERTY>'
+  '<PROPERTY NAME="VolumeName" CLASSORIGIN="Win32_LogicalDisk" TYPE="string"><QUALIFIER NAME="CIMTYPE" PROPAGATED="true" TYPE="string" TOINSTANCE="true"><VALUE>string</VALUE></QUALIFIER><VALUE>Windows &amp; &lt;Data&gt;</VALUE></PROPERTY>'
+  '</INSTANCE>'
+)
+DISK_XML_VALUES = [
+  ("DeviceID", "string", "C:"),
+  ("Caption", "string", "C:"),
+  ("DriveType", "uint32", 3),
+  ("FreeSpace", "uint64", "42817421312"),
+  ("Size", "uint64", "126696288256"),
+  ("VolumeName", "string", "Windows & <Data>"),
+  ("Access", "uint16", 0),
+  ("BlockSize", "uint64", None),
+  ("Compressed", "boolean", False),
+  ("PowerManagementCapabilities", "uint16", (1, 4)),
+]
+
+PARTITION_XML = (
+  '<INSTANCE CLASSNAME="Win32_LogicalDiskToPartition">'
+  '<PROPERTY.REFERENCE NAME="Antecedent" CLASSORIGIN="Win32_LogicalDiskToPartition" REFERENCECLASS="Win32_DiskPartition"><QUALIFIER NAME="CIMTYPE" PROPAGATED="true" TYPE="string" TOINSTANCE="true"><VALUE>ref:Win32_DiskPartition</VALUE></QUALIFIER>'
+  '<VALUE.REFERENCE><INSTANCEPATH><NAMESPACEPATH><HOST>HOST</HOST><LOCALNAMESPACEPATH><NAMESPACE NAME="root"/><NAMESPACE NAME="cimv2"/></LOCALNAMESPACEPATH></NAMESPACEPATH>'
+  '<INSTANCENAME CLASSNAME="Win32_DiskPartition"><KEYBINDING NAME="DeviceID"><KEYVALUE VALUETYPE="string">Disk #0, Partition #1</KEYVALUE></KEYBINDING></INSTANCENAME></INSTANCEPATH></VALUE.REFERENCE></PROPERTY.REFERENCE>'
+  '<PROPERTY.REFERENCE NAME="Dependent" CLASSORIGIN="Win32_LogicalDiskToPartition" REFERENCECLASS="Win32_LogicalDisk"><QUALIFIER NAME="CIMTYPE" PROPAGATED="true" TYPE="string" TOINSTANCE="true"><VALUE>ref:Win32_LogicalDisk</VALUE></QUALIFIER>'
+  '<VALUE.REFERENCE><INSTANCEPATH><NAMESPACEPATH><HOST>HOST</HOST><LOCALNAMESPACEPATH><NAMESPACE NAME="root"/><NAMESPACE NAME="cimv2"/></LOCALNAMESPACEPATH></NAMESPACEPATH>'
+  '<INSTANCENAME CLASSNAME="Win32_LogicalDisk"><KEYBINDING NAME="DeviceID"><KEYVALUE VALUETYPE="string">C:</KEYVALUE></KEYBINDING></INSTANCENAME></INSTANCEPATH></VALUE.REFERENCE></PROPERTY.REFERENCE>'
+  '<PROPERTY NAME="EndingAddress" CLASSORIGIN="Win32_LogicalDiskToPartition" TYPE="uint64"><VALUE>127691702271</VALUE></PROPERTY>'
+  '</INSTANCE>'
+)
+
+def fake_xml_disks (n, calls=None):
+  calls = calls if calls is not None else FakeCalls ()
+  return [
+    FakeSWbemObject ("Win32_LogicalDisk", DISK_XML_VALUES, methods=DISK_METHODS, calls=calls, text=DISK_XML)
+    for i in range (n)
+  ]
+
+class FakeObjectSet (object):
+  """A forward-only result set which makes its objects as they're
+  asked for, counting how many of them are still alive.
+  """
+
+  def __init__ (self, n_rows, make_object):
+    self.n_rows = n_rows
+    self.make_object = make_object
+    self.produced = 0
+    self.live = 0
+    self.released = False
+
+  def __iter__ (self):
+    try:
+      for n in range (self.n_rows):
+        obj = self.make_object (n)
+        obj._object_set = self
+        self.produced += 1
+        self.live += 1
+        yield obj
+        del obj
+    finally:
+      self.released = True
+
+class FakeCountedObject (FakeSWbemObject):
+
+  def __del__ (self):
+    self._object_set.live -= 1
+
+class FakeSWbemServices (object):
+  """A namespace holding fake classes and instances of them. Queries
+  return all the instances of the class they select from.
+  """
+
+  def __init__ (self, classes=[], instances=[], calls=None):
+    self._calls = calls if calls is not None else FakeCalls ()
+    self._classes = dict ((c._class_name.lower (), c) for c in classes)
+    self._instances = {}
+    for instance in instances:
+      self._instances.setdefault (instance._class_name.lower (), []).append (instance)
+    self.queries = []
+
+  def Get (self, name):
+    self._calls.count ("Get")
+    try:
+      return self._classes[name.lower ()]
+    except KeyError:
+      raise pywintypes.com_error (-2147217406, "Not found", None, None)
+
+  def ExecQuery (self, strQuery, iFlags=0):
+    self._calls.count ("ExecQuery")
+    self.queries.append (strQuery)
+    class_name = re.search (r"FROM\s+(\w+)", strQuery, re.I).group (1)
+    instances = self._instances.get (class_name.lower (), [])
+    if callable (instances):
+      return instances ()
+    return list (instances)
+
+  def set_instances (self, class_name, instances):
+    self._instances[class_name.lower ()] = instances
+
 class TestBasicConnections (unittest.TestCase):
 
   def test_basic_connection (self):
@@ -333,6 +610,2741 @@ class TestFunctions (unittest.TestCase):
     the StdRegProv class out of the DEFAULT namespace"""
     self.assertEquals (wmi.Registry (), wmi.WMI (namespace="DEFAULT").StdRegProv)
 
+class FakeWMITestCase (unittest.TestCase):
+  """Base for the tests run against fake WMI objects. Each test starts
+  with none of the schemas read by earlier tests and has a store of its
+  own, `schemas`, for the namespaces it makes with :meth:`connect`. If
+  `pass_marshalled` is set, objects handed to worker threads are passed
+  as they are, since the fakes can't be marshalled.
+  """
+
+  pass_marshalled = False
+
+  def setUp (self):
+    wmi._schemas.clear ()
+    self.schemas = {}
+    if self.pass_marshalled:
+      self._marshal, self._unmarshal = wmi._marshal, wmi._unmarshal
+      wmi._marshal = wmi._unmarshal = lambda ole_object: ole_object
+
+  def tearDown (self):
+    if self.pass_marshalled:
+      wmi._marshal, wmi._unmarshal = self._marshal, self._unmarshal
+
+  def connect (self, services, *args, **kwargs):
+    """Return a namespace over `services` keeping its schemas in this test's store"""
+    kwargs["schemas"] = self.schemas
+    return wmi._wmi_namespace (services, False, *args, **kwargs)
+
+class TestConstants (FakeWMITestCase):
+
+  def test_import_does_not_bind (self):
+    "Check that importing the module does not touch WMI or the typelib"
+    here = os.path.dirname (os.path.abspath (__file__))
+    script = "import time; t0 = time.time (); import wmi; print ('%r %f' % (wmi.constants._typecomp is None, time.time () - t0))"
+    output = subprocess.Popen ([sys.executable, "-c", script], cwd=here, stdout=subprocess.PIPE).communicate ()[0]
+    unbound, elapsed = output.split ()
+    self.assertEquals (unbound.decode ("ascii"), "True")
+    warnings.warn ("import wmi took %.3fs" % float (elapsed))
+
+  def test_builtins_match_typelib (self):
+    "Check that every precomputed constant matches the typelib's value"
+    typelib = wmi.ProvideConstants (wmi.Dispatch ("WbemScripting.SWbemLocator"))
+    for name, value in wmi._BUILTIN_CONSTANTS.items ():
+      self.assertEquals (getattr (typelib, name), value, name)
+
+  def test_builtins_are_case_insensitive (self):
+    "Check that constants are found regardless of case, as the typelib does"
+    self.assertEquals (wmi.constants.wbemAuthenticationLevelPktintegrity, wmi.constants.wbemAuthenticationLevelPktIntegrity)
+
+  def test_lookup_on_miss (self):
+    "Check that a constant not in the builtin table is looked up and remembered"
+    constants = wmi.LazyConstants ({})
+    self.assertEquals (constants.wbemCimtypeString, 8)
+    self.assert_ ("wbemcimtypestring" in constants._table)
+
+  def test_unknown_constant (self):
+    self.assertRaises (AttributeError, getattr, wmi.constants, "wbemNoSuchThing")
+
+  def test_unsigned_to_signed (self):
+    self.assertEquals (wmi.unsigned_to_signed (0x80041017), -2147217385)
+    self.assertEquals (wmi.signed_to_unsigned (wmi.unsigned_to_signed (0x80043001)), 0x80043001)
+
+class TestSchema (FakeWMITestCase):
+
+  def setUp (self):
+    FakeWMITestCase.setUp (self)
+    self.calls = FakeCalls ()
+    self.disks = fake_disks (100, self.calls)
+
+  def test_schema_read_once_per_class (self):
+    "Check that properties, methods & qualifiers are walked once, not once per instance"
+    objects = [wmi._wmi_object (disk) for disk in self.disks]
+    self.assertEquals (self.calls["Properties_"], 1)
+    self.assertEquals (self.calls["Methods_"], 1)
+    self.assertEquals (self.calls["Qualifiers_"], 1 + len (DISK_PROPERTIES))
+    self.assert_ (all (o._schema is objects[0]._schema for o in objects))
+
+  def test_instances_served_from_schema (self):
+    "Check that keys, properties, methods & qualifiers come from the shared schema"
+    d0, d1 = [wmi._wmi_object (disk) for disk in self.disks[:2]]
+    before = self.calls.total ()
+    self.assertEquals (d0.keys, ["DeviceID"])
+    self.assertEquals (sorted (d0._properties), sorted (name for (name, _) in DISK_PROPERTIES))
+    self.assertEquals (sorted (d0._methods), sorted (DISK_METHODS))
+    self.assert_ (d0.qualifiers is d1.qualifiers)
+    self.assertEquals (self.calls.total (), before)
+
+  def test_instances_keep_their_own_values (self):
+    "Check that sharing the schema doesn't share property values"
+    d0, d1 = [wmi._wmi_object (disk) for disk in self.disks[:2]]
+    self.assertEquals (d0.DeviceID, "0:")
+    self.assertEquals (d1.DeviceID, "1:")
+    self.assertEquals (d1.wmi_property ("DriveType").type, "uint32")
+
+  def test_property_qualifiers_from_schema (self):
+    "Check that reading a property doesn't walk its qualifiers again"
+    d0 = wmi._wmi_object (self.disks[0])
+    qualifiers = self.calls["Qualifiers_"]
+    d0.VolumeName
+    self.assertEquals (self.calls["Qualifiers_"], qualifiers)
+
+  def test_projected_query_keeps_its_schema (self):
+    "Check that objects from a projected query don't become the shared schema"
+    projected = FakeSWbemObject ("Win32_LogicalDisk", [("Caption", "string", "C:")], n_keys=0)
+    schemas = wmi._schemas_for_query ("SELECT Caption FROM Win32_LogicalDisk", [])
+    wmi._wmi_object (projected, schemas=schemas)
+    self.assertFalse (wmi._schemas)
+    self.assert_ (wmi._schemas_for_query ("SELECT * FROM Win32_LogicalDisk", []) is None)
+
+  def test_namespace_store (self):
+    "Check that a namespace given a schema store of its own keeps its schemas there"
+    services = FakeSWbemServices ([fake_disk_class (self.calls)], self.disks[:2], self.calls)
+    disk, _ = self.connect (services).Win32_LogicalDisk ()
+    self.assertFalse (wmi._schemas)
+    self.assert_ (disk._schema in self.schemas.values ())
+    other, _ = wmi._wmi_namespace (services, False, schemas={}).Win32_LogicalDisk ()
+    self.assert_ (other._schema is not disk._schema)
+    self.assertFalse (wmi._schemas)
+
+class TestSchemaCache (FakeWMITestCase):
+
+  location = ("host", "root/cimv2")
+
+  def setUp (self):
+    FakeWMITestCase.setUp (self)
+    self.directory = tempfile.mkdtemp ()
+    self.calls = FakeCalls ()
+    self.connect (FakeSWbemServices ([fake_disk_class ()]), self.directory, self.location).Win32_LogicalDisk
+
+  def tearDown (self):
+    shutil.rmtree (self.directory)
+    FakeWMITestCase.tearDown (self)
+
+  def warm_connection (self, classes=None, max_age_secs=60):
+    if classes is None:
+      classes = [fake_disk_class (self.calls)]
+    services = FakeSWbemServices (classes, fake_disks (10, self.calls), self.calls)
+    cache = wmi.SchemaCache (self.directory, max_age_secs)
+    #
+    # As a new process would, with no schemas but those on disk
+    #
+    return wmi._wmi_namespace (services, False, cache, self.location, schemas={})
+
+  def test_class_from_disk (self):
+    "Check that a class is picked up from the cache without going to WMI"
+    disk = self.warm_connection ().Win32_LogicalDisk
+    self.assertEquals (disk.keys, ["DeviceID"])
+    self.assertEquals (sorted (disk._methods), sorted (DISK_METHODS))
+    self.assertEquals (self.calls.get ("Get", 0), 0)
+
+  def test_query_from_disk (self):
+    "Check that a cached class can be queried and its instances share its schema"
+    disks = self.warm_connection ().Win32_LogicalDisk ()
+    self.assertEquals (len (disks), 10)
+    self.assertEquals (self.calls.get ("Get", 0), 0)
+    self.assertEquals (self.calls.get ("Properties_", 0), 0)
+
+  def test_version_survives_json (self):
+    "Check that a schema's version is the same once read back as unicode with lists for tuples"
+    schema = wmi._wmi_schema ("Thing", ["A"], {"A" : {"CIMTYPE" : "string", "ValueMap" : ("1", "2")}}, ["Go"], {"dynamic" : True})
+    data = json.loads (json.dumps (schema._data ()))
+    copy = wmi._wmi_schema (
+      data["class_name"], data["properties"],
+      dict ((name, wmi._json_tuples (qualifiers)) for (name, qualifiers) in data["property_qualifiers"].items ()),
+      data["methods"], wmi._json_tuples (data["qualifiers"])
+    )
+    self.assertEquals (copy.version, schema.version)
+
+  def test_class_fetched_when_needed (self):
+    "Check that the class itself is only fetched from WMI when needed"
+    disk = self.warm_connection ().Win32_LogicalDisk
+    disk.id
+    self.assertEquals (self.calls["Get"], 1)
+
+  def test_changed_class_refreshes_cache (self):
+    "Check that a class which has changed replaces its cached schema"
+    changed = fake_disk_class (self.calls, [("Compressed", "boolean")])
+    disk = self.warm_connection ([changed]).Win32_LogicalDisk
+    self.assertFalse ("Compressed" in disk.properties)
+    disk.ole_object
+    self.assert_ ("Compressed" in disk.properties)
+    self.assert_ ("Compressed" in self.warm_connection ([changed]).Win32_LogicalDisk.properties)
+
+  def test_expired_entries_ignored (self):
+    "Check that entries older than max_age_secs are fetched afresh"
+    self.warm_connection (max_age_secs=-1).Win32_LogicalDisk
+    self.assertEquals (self.calls["Get"], 1)
+
+  def test_max_age_required (self):
+    "Check that a cache must have a maximum age"
+    self.assertRaises (wmi.x_wmi, wmi.SchemaCache, self.directory, None)
+
+  def test_data_only (self):
+    "Check that schemas are stored as JSON and anything else is ignored"
+    [filename] = os.listdir (self.directory)
+    filepath = os.path.join (self.directory, filename)
+    f = open (filepath, "rb")
+    try:
+      record = json.loads (f.read ().decode ("ascii"))
+    finally:
+      f.close ()
+    self.assertEquals (record["schema"]["class_name"], "Win32_LogicalDisk")
+    self.assertEquals (self.warm_connection ().Win32_LogicalDisk.keys, ["DeviceID"])
+    self.assertEquals (self.calls.get ("Get", 0), 0)
+    f = open (filepath, "wb")
+    try:
+      f.write (pickle.dumps (record))
+    finally:
+      f.close ()
+    self.warm_connection ().Win32_LogicalDisk
+    self.assertEquals (self.calls["Get"], 1)
+
+  def test_no_location_no_cache (self):
+    "Check that a namespace with no known location doesn't use the cache"
+    c = self.connect (FakeSWbemServices ([fake_disk_class ()], calls=self.calls), self.directory, None)
+    c.Win32_LogicalDisk
+    self.assertEquals (self.calls["Get"], 1)
+
+class TestStreamingQuery (FakeWMITestCase):
+
+  n_rows = 1000000
+
+  def setUp (self):
+    FakeWMITestCase.setUp (self)
+    template = fake_disks (1)[0]
+    def make_disk (n):
+      disk = FakeCountedObject.__new__ (FakeCountedObject)
+      disk.__dict__.update (template.__dict__)
+      disk._path = FakePath ("HOST", "root\\cimv2", "Win32_LogicalDisk", [("DeviceID", "%d:" % n)])
+      return disk
+    self.results = FakeObjectSet (self.n_rows, make_disk)
+    self.services = FakeSWbemServices ([fake_disk_class ()])
+    self.services.set_instances ("Win32_LogicalDisk", lambda: self.results)
+    self.connection = self.connect (self.services)
+
+  def test_bounded_memory (self):
+    "Check that only the current row is alive while streaming a large result set"
+    most_alive = 0
+    for n, disk in enumerate (self.connection.iquery ("SELECT * FROM Win32_LogicalDisk")):
+      most_alive = max (most_alive, self.results.live)
+    self.assertEquals (n + 1, self.n_rows)
+    self.assert_ (most_alive <= 2, most_alive)
+
+  def test_early_exit_releases_enumerator (self):
+    "Check that abandoning a streamed query releases the result set"
+    results = self.connection.Win32_LogicalDisk.iquery ()
+    next (results)
+    self.assertFalse (self.results.released)
+    results.close ()
+    self.assert_ (self.results.released)
+    self.assertEquals (self.results.produced, 1)
+
+  def test_errors_while_streaming (self):
+    "Check that a COM error part way through a class's results is raised as x_wmi"
+    self.services.set_instances ("Win32_LogicalDisk", lambda: FakeBusyResults (fake_disks (2), wmi.constants.wbemErrFailed))
+    results = self.connection.Win32_LogicalDisk.iquery ()
+    self.assertEquals (next (results).Caption, "0:")
+    self.assertRaises (wmi.x_wmi, next, results)
+
+  def test_query_is_list_of_iquery (self):
+    "Check that query still returns the whole result as a list"
+    self.results.n_rows = 10
+    disks = self.connection.Win32_LogicalDisk.query ()
+    self.assertEquals ([d.id for d in disks], [d.id for d in self.connection.Win32_LogicalDisk.iquery ()])
+    self.assertEquals (len (disks), 10)
+
+class TestColumns (FakeWMITestCase):
+
+  def setUp (self):
+    FakeWMITestCase.setUp (self)
+    self.disks = fake_disks (5)
+    self.disks[2]._properties[5].Value = None
+    self.connection = self.connect (FakeSWbemServices ([fake_disk_class ()], self.disks))
+
+  def test_numeric_columns_are_arrays (self):
+    "Check that numeric fields come back as typed arrays"
+    columns = self.connection.fetch_as_columns ("Win32_LogicalDisk", ["DriveType", "Size"])
+    self.assertEquals (columns["DriveType"].typecode, "I")
+    self.assertEquals (list (columns["DriveType"]), [3] * 5)
+    self.assertEquals (sum (columns["Size"]), sum (i * 2000 for i in range (5)))
+
+  def test_other_columns_are_lists (self):
+    "Check that non-numeric fields come back as lists"
+    columns = self.connection.fetch_as_columns ("Win32_LogicalDisk", ["Caption"])
+    self.assertEquals (columns["Caption"], ["%d:" % i for i in range (5)])
+
+  def test_nulls_become_lists (self):
+    "Check that a numeric column with nulls in it is still returned, as a list"
+    self.disks[1]._properties[2].Value = None
+    columns = self.connection.fetch_as_columns ("Win32_LogicalDisk", ["DriveType", "VolumeName"])
+    self.assert_ (isinstance (columns["DriveType"], list))
+    self.assertEquals (columns["DriveType"], [3, None, 3, 3, 3])
+    self.assertEquals (columns["VolumeName"][2], None)
+
+  def test_all_fields (self):
+    "Check that all the class's properties are fetched if none are specified"
+    columns = self.connection.fetch_as_columns ("Win32_LogicalDisk")
+    self.assertEquals (sorted (columns), sorted (name for (name, _) in DISK_PROPERTIES))
+
+  def test_numpy (self):
+    "Check that columns can be returned as NumPy arrays"
+    try:
+      import numpy
+    except ImportError:
+      warnings.warn ("Skipping test_numpy because NumPy is not installed")
+      return
+    columns = self.connection.fetch_as_columns ("Win32_LogicalDisk", ["FreeSpace", "Caption"], as_numpy=True)
+    self.assertEquals (columns["FreeSpace"].dtype, numpy.dtype ("Q"))
+    self.assertEquals (columns["FreeSpace"].sum (), sum (i * 1000 for i in range (5)))
+    self.assertEquals (columns["Caption"].dtype, numpy.dtype (object))
+
+class TestXmlRows (FakeWMITestCase):
+
+  def setUp (self):
+    FakeWMITestCase.setUp (self)
+    self.calls = FakeCalls ()
+    disk_class = FakeSWbemObject (
+      "Win32_LogicalDisk",
+      [(name, cimtype, None) for (name, cimtype, _) in DISK_XML_VALUES],
+      methods=DISK_METHODS,
+      is_class=True
+    )
+    self.services = FakeSWbemServices ([disk_class], fake_xml_disks (10, self.calls))
+    self.connection = self.connect (self.services, xml_rows=True)
+
+  def test_read_instance (self):
+    "Check that a recorded instance is read into typed values"
+    class_name, row = wmi._cim_xml_reader ().read (DISK_XML)
+    self.assertEquals (class_name, "Win32_LogicalDisk")
+    self.assertEquals (row["DriveType"], 3)
+    self.assertEquals (row["FreeSpace"], 42817421312)
+    self.assertEquals (row["Compressed"], False)
+    self.assertEquals (row["PowerManagementCapabilities"], (1, 4))
+    self.assertEquals (row["BlockSize"], None)
+    self.assertEquals (row["VolumeName"], "Windows & <Data>")
+    self.assertEquals (len (row), len (DISK_XML_VALUES))
+
+  def test_read_references (self):
+    "Check that reference properties are read as object paths"
+    class_name, row = wmi._cim_xml_reader ().read (PARTITION_XML)
+    self.assertEquals (row["Antecedent"], '\\\\HOST\\root\\cimv2:Win32_DiskPartition.DeviceID="Disk #0, Partition #1"')
+    self.assertEquals (row["Dependent"], '\\\\HOST\\root\\cimv2:Win32_LogicalDisk.DeviceID="C:"')
+
+  def test_one_call_per_row (self):
+    "Check that reading every property of an object takes a single call"
+    disks = self.connection.query ("SELECT * FROM Win32_LogicalDisk")
+    self.calls.clear ()
+    for disk in disks:
+      self.assertEquals (disk.FreeSpace, 42817421312)
+      self.assertEquals (disk.PowerManagementCapabilities, (1, 4))
+      self.assertEquals (disk.VolumeName, "Windows & <Data>")
+    self.assertEquals (self.calls, {"GetText_" : len (disks)})
+
+  def test_set_rereads_row (self):
+    "Check that setting a property means the row is read again"
+    disk = self.connection.query ("SELECT * FROM Win32_LogicalDisk")[0]
+    disk.VolumeName
+    disk.VolumeName = "New"
+    disk.VolumeName
+    self.assertEquals (self.calls["GetText_"], 2)
+
+  def test_fetch_as_lists (self):
+    "Check that fetch_as_lists reads each row in one call"
+    rows = self.connection.fetch_as_lists ("Win32_LogicalDisk", ["caption", "Size"])
+    self.assertEquals (rows, [["C:", 126696288256]] * 10)
+    self.assertEquals (self.calls.get ("Properties_()"), None)
+
+  def test_fetch_as_classes (self):
+    "Check that fetch_as_classes reads each row in one call"
+    rows = self.connection.fetch_as_classes ("Win32_LogicalDisk")
+    self.assertEquals (rows[0].Compressed, False)
+    self.assertEquals (self.calls.get ("Properties_()"), None)
+    self.assertEquals (self.calls["GetText_"], 10)
+
+  def test_fetch_as_columns (self):
+    "Check that fetch_as_columns reads each row in one call"
+    columns = self.connection.fetch_as_columns ("Win32_LogicalDisk", ["Size"])
+    self.assertEquals (list (columns["Size"]), [126696288256] * 10)
+    self.assertEquals (self.calls.get ("Properties_()"), None)
+
+  def test_compare_calls_and_time (self):
+    "Compare COM calls and time per row with and without xml_rows"
+    fields = [name for (name, _, _) in DISK_XML_VALUES]
+    results = {}
+    for xml_rows in (False, True):
+      self.connection._xml_rows = xml_rows
+      self.calls.clear ()
+      t0 = time.time ()
+      for n in range (20):
+        self.connection.fetch_as_lists ("Win32_LogicalDisk", fields)
+      results[xml_rows] = (float (self.calls.total ()) / 200, (time.time () - t0) / 200)
+    self.assertEquals (results[False][0], len (fields))
+    self.assertEquals (results[True][0], 1)
+    warnings.warn (
+      "Per row: %d calls, %.1fus using Properties_; %d calls, %.1fus using GetText_" % (
+        results[False][0], results[False][1] * 1e6, results[True][0], results[True][1] * 1e6
+      )
+    )
+
+class FakeClock (object):
+
+  def __init__ (self, now=1000.0):
+    self.now = now
+
+  def __call__ (self):
+    return self.now
+
+class TestQueryCache (FakeWMITestCase):
+
+  def setUp (self):
+    FakeWMITestCase.setUp (self)
+    self.clock = FakeClock ()
+    self.cache = wmi.QueryCache (ttl_secs=60, class_ttls={"Win32_Service" : 5}, clock=self.clock)
+    self.services = FakeSWbemServices ([fake_disk_class ()], fake_disks (3))
+    self.connection = self.connect (self.services, query_cache=self.cache)
+
+  def test_repeated_query_is_cached (self):
+    "Check that the same query is only sent to WMI once"
+    first = self.connection.query ("SELECT * FROM Win32_LogicalDisk")
+    second = self.connection.query ("select  *  from win32_logicaldisk")
+    self.assertEquals (first, second)
+    self.assertEquals (len (self.services.queries), 1)
+    self.assertEquals ((self.cache.hits, self.cache.misses), (1, 1))
+
+  def test_class_query_is_cached (self):
+    "Check that querying through a class uses the cache"
+    disk_class = self.connection.Win32_LogicalDisk
+    disk_class ()
+    disk_class.query ()
+    self.assertEquals (len (self.services.queries), 1)
+
+  def test_string_literals_are_distinct (self):
+    "Check that queries differing only in a string literal are cached separately"
+    self.connection.query ("SELECT * FROM Win32_LogicalDisk WHERE DeviceID = 'C:'")
+    self.connection.query ("SELECT * FROM Win32_LogicalDisk WHERE DeviceID = 'D:'")
+    self.assertEquals (len (self.services.queries), 2)
+
+  def test_fields_are_part_of_the_key (self):
+    "Check that the same query with different fields is cached separately"
+    self.connection.query ("SELECT Caption FROM Win32_LogicalDisk", fields=["Caption"])
+    self.connection.query ("SELECT Caption FROM Win32_LogicalDisk")
+    self.assertEquals (len (self.services.queries), 2)
+
+  def test_ttl (self):
+    "Check that results expire after the TTL"
+    self.connection.query ("SELECT * FROM Win32_LogicalDisk")
+    self.clock.now += 59
+    self.connection.query ("SELECT * FROM Win32_LogicalDisk")
+    self.assertEquals (len (self.services.queries), 1)
+    self.clock.now += 2
+    self.connection.query ("SELECT * FROM Win32_LogicalDisk")
+    self.assertEquals (len (self.services.queries), 2)
+
+  def test_class_ttl (self):
+    "Check that a class's own TTL overrides the default"
+    self.services.set_instances ("Win32_Service", [])
+    self.connection.query ("SELECT * FROM Win32_Service")
+    self.clock.now += 6
+    self.connection.query ("SELECT * FROM Win32_Service")
+    self.assertEquals (len (self.services.queries), 2)
+
+  def test_lru_by_entries (self):
+    "Check that the least recently used entry is evicted when the cache is full"
+    self.cache.max_entries = 2
+    for device_id in ("A:", "B:", "A:", "C:"):
+      self.connection.query ("SELECT * FROM Win32_LogicalDisk WHERE DeviceID = '%s'" % device_id)
+    self.assertEquals (len (self.cache), 2)
+    self.assertEquals (self.cache.evictions, 1)
+    self.connection.query ("SELECT * FROM Win32_LogicalDisk WHERE DeviceID = 'A:'")
+    self.assertEquals (self.cache.hits, 2)
+    self.connection.query ("SELECT * FROM Win32_LogicalDisk WHERE DeviceID = 'B:'")
+    self.assertEquals (len (self.services.queries), 4)
+
+  def test_lru_by_bytes (self):
+    "Check that entries are evicted to keep within the size limit"
+    self.connection.query ("SELECT * FROM Win32_LogicalDisk WHERE DeviceID = 'A:'")
+    self.cache.max_bytes = self.cache.n_bytes + 1
+    self.connection.query ("SELECT * FROM Win32_LogicalDisk WHERE DeviceID = 'B:'")
+    self.assertEquals (len (self.cache), 1)
+    self.assert_ (self.cache.n_bytes <= self.cache.max_bytes)
+
+  def test_invalidate (self):
+    "Check that results can be discarded by class or altogether"
+    self.services.set_instances ("Win32_Service", [])
+    self.connection.query ("SELECT * FROM Win32_LogicalDisk")
+    self.connection.query ("SELECT * FROM Win32_Service")
+    self.cache.invalidate ("win32_logicaldisk")
+    self.assertEquals (len (self.cache), 1)
+    self.cache.invalidate ()
+    self.assertEquals ((len (self.cache), self.cache.n_bytes), (0, 0))
+
+  def test_iquery_is_not_cached (self):
+    "Check that streaming queries always go to WMI"
+    list (self.connection.iquery ("SELECT * FROM Win32_LogicalDisk"))
+    list (self.connection.iquery ("SELECT * FROM Win32_LogicalDisk"))
+    self.assertEquals (len (self.services.queries), 2)
+
+  def test_per_thread (self):
+    "Check that one thread's results aren't handed to another"
+    self.connection.query ("SELECT * FROM Win32_LogicalDisk")
+    thread = threading.Thread (target=self.connection.query, args=("SELECT * FROM Win32_LogicalDisk",))
+    thread.start ()
+    thread.join ()
+    self.assertEquals (len (self.services.queries), 2)
+    self.connection.query ("SELECT * FROM Win32_LogicalDisk")
+    self.assertEquals (len (self.services.queries), 2)
+
+  def test_principal (self):
+    "Check that connections as different users are cached separately"
+    location = ("remote", "root/cimv2")
+    for user in ("alice", "bob", "ALICE"):
+      c = self.connect (self.services, location=location, query_cache=self.cache, principal=(user.lower (), ""))
+      c.query ("SELECT * FROM Win32_LogicalDisk")
+    self.assertEquals (len (self.services.queries), 2)
+
+  def test_unknown_location (self):
+    "Check that namespaces whose location isn't known never share results"
+    for n in range (3):
+      c = self.connect (self.services, query_cache=self.cache)
+      c.query ("SELECT * FROM Win32_LogicalDisk")
+      del c
+      gc.collect ()
+    self.assertEquals (len (self.services.queries), 3)
+
+class TestConnectionPool (FakeWMITestCase):
+
+  def setUp (self):
+    self.monikers = []
+    self.healthy = True
+    self.clock = FakeClock ()
+    self.pool = wmi.ConnectionPool (max_idle_secs=300, max_per_host=2, check_after_secs=30, clock=self.clock)
+    self._GetObject = wmi.GetObject
+    wmi.GetObject = self.get_object
+
+  def tearDown (self):
+    wmi.GetObject = self._GetObject
+    wmi.default_pool = None
+    FakeWMITestCase.tearDown (self)
+
+  def get_object (self, moniker):
+    self.monikers.append (moniker)
+    services = FakeSWbemServices ([FakeSWbemObject ("__NAMESPACE", [("Name", "string", None)], is_class=True)])
+    test = self
+    def Get (name):
+      if not test.healthy:
+        raise pywintypes.com_error (-2147023174, "The RPC server is unavailable", None, None)
+      return FakeSWbemServices.Get (services, name)
+    services.Get = Get
+    return services
+
+  def test_same_parameters (self):
+    "Check that connecting twice with the same parameters gives the same connection"
+    c1 = wmi.WMI ("remote", pool=self.pool)
+    c2 = wmi.WMI ("REMOTE", pool=self.pool)
+    self.assert_ (c1 is c2)
+    self.assertEquals (len (self.monikers), 1)
+    self.assertEquals ((self.pool.hits, self.pool.misses), (1, 1))
+
+  def test_different_parameters (self):
+    "Check that connections with different parameters are kept apart"
+    c1 = wmi.WMI ("remote", pool=self.pool)
+    c2 = wmi.WMI ("remote", namespace="root/default", pool=self.pool)
+    c3 = wmi.WMI ("remote", privileges=["security"], pool=self.pool)
+    self.assertEquals (len (set ([id (c1), id (c2), id (c3)])), 3)
+
+  def test_default_pool (self):
+    "Check that the default pool is used unless pool=False is passed"
+    wmi.default_pool = self.pool
+    self.assert_ (wmi.WMI ("remote") is wmi.WMI ("remote"))
+    self.assert_ (wmi.WMI ("remote", pool=False) is not wmi.WMI ("remote"))
+
+  def test_thread_affinity (self):
+    "Check that each thread gets its own connection"
+    connections = []
+    c1 = wmi.WMI ("remote", pool=self.pool)
+    thread = threading.Thread (target=lambda: connections.append (wmi.WMI ("remote", pool=self.pool)))
+    thread.start ()
+    thread.join ()
+    self.assert_ (connections[0] is not c1)
+    self.assert_ (wmi.WMI ("remote", pool=self.pool) is c1)
+
+  def test_idle_eviction (self):
+    "Check that connections idle for too long are replaced"
+    c1 = wmi.WMI ("remote", pool=self.pool)
+    self.clock.now += 301
+    self.assert_ (wmi.WMI ("remote", pool=self.pool) is not c1)
+    self.assertEquals (self.pool.evictions, 1)
+
+  def test_max_per_host (self):
+    "Check that a host keeps no more than its maximum of connections"
+    for namespace in ("root/cimv2", "root/default", "root/wmi"):
+      self.clock.now += 1
+      wmi.WMI ("remote", namespace=namespace, pool=self.pool)
+    wmi.WMI ("other", pool=self.pool)
+    self.assertEquals (len (self.pool), 3)
+    wmi.WMI ("remote", namespace="root/cimv2", pool=self.pool)
+    self.assertEquals (len (self.monikers), 5)
+
+  def test_max_per_host_per_thread (self):
+    "Check that one thread's connections don't push out another's"
+    wmi.WMI ("remote", namespace="root/cimv2", pool=self.pool)
+    wmi.WMI ("remote", namespace="root/default", pool=self.pool)
+    ready = threading.Event ()
+    carry_on = threading.Event ()
+    def worker ():
+      wmi.WMI ("remote", namespace="root/wmi", pool=self.pool)
+      ready.set ()
+      carry_on.wait ()
+    thread = threading.Thread (target=worker)
+    thread.start ()
+    ready.wait ()
+    try:
+      self.assertEquals (len (self.pool), 3)
+      self.assertEquals ((self.pool.evictions, self.pool._doomed), (0, {}))
+    finally:
+      carry_on.set ()
+      thread.join ()
+
+  def test_moniker_host (self):
+    "Check that a moniker's connections count against the host it names"
+    for namespace in ("cimv2", "default", "wmi"):
+      self.clock.now += 1
+      wmi.WMI (moniker="winmgmts:{impersonationLevel=impersonate}!//REMOTE/root/%s" % namespace, pool=self.pool)
+    self.assertEquals (len (self.pool), 2)
+    self.assertEquals ([entry["host"] for entry in self.pool._entries.values ()], ["remote", "remote"])
+
+  def test_health_check (self):
+    "Check that a failed connection is replaced after its health check"
+    c1 = wmi.WMI ("remote", pool=self.pool)
+    self.clock.now += 31
+    self.healthy = False
+    c2 = wmi.WMI ("remote", pool=self.pool)
+    self.assert_ (c2 is not c1)
+    self.assertEquals (self.pool.failed_checks, 1)
+
+  def test_release_by_owner (self):
+    "Check that a connection is released by the thread which made it"
+    ready = threading.Event ()
+    carry_on = threading.Event ()
+    def worker ():
+      wmi.WMI ("remote", pool=self.pool)
+      ready.set ()
+      carry_on.wait ()
+      wmi.WMI ("other", pool=self.pool)
+    thread = threading.Thread (target=worker)
+    thread.start ()
+    ready.wait ()
+    self.clock.now += 301
+    wmi.WMI ("remote", pool=self.pool)
+    self.assertEquals (len (self.pool._doomed), 1)
+    carry_on.set ()
+    thread.join ()
+    self.assertEquals (self.pool._doomed, {})
+
+class FakeHosts (object):
+  """A connector for many fake hosts, each taking its own time to
+  connect, and keeping track of how many are connecting at once.
+  """
+
+  def __init__ (self, latencies={}, failures=()):
+    self.latencies = latencies
+    self.failures = failures
+    self.lock = threading.Lock ()
+    self.active = self.max_active = 0
+
+  def __call__ (self, computer, **kwargs):
+    self.lock.acquire ()
+    self.active += 1
+    self.max_active = max (self.max_active, self.active)
+    self.lock.release ()
+    try:
+      time.sleep (self.latencies.get (computer, 0.01))
+      if computer in self.failures:
+        raise wmi.x_access_denied ("Access denied to %s" % computer)
+      return wmi._wmi_namespace (FakeSWbemServices ([fake_disk_class ()], fake_disks (2)), False)
+    finally:
+      self.lock.acquire ()
+      self.active -= 1
+      self.lock.release ()
+
+class TestFanOut (FakeWMITestCase):
+
+  def setUp (self):
+    FakeWMITestCase.setUp (self)
+
+  def test_all_hosts (self):
+    "Check that every host's results come back"
+    hosts = ["host%02d" % i for i in range (20)]
+    results = dict (wmi.fan_out (hosts, "SELECT * FROM Win32_LogicalDisk", connector=FakeHosts ()))
+    self.assertEquals (sorted (results), hosts)
+    self.assertEquals ([d.Caption for d in results["host07"]], ["0:", "1:"])
+
+  def test_bounded_concurrency (self):
+    "Check that no more than max_workers hosts are worked on at once"
+    connector = FakeHosts ()
+    hosts = ["host%02d" % i for i in range (20)]
+    list (wmi.fan_out (hosts, "SELECT * FROM Win32_LogicalDisk", max_workers=4, connector=connector))
+    self.assert_ (1 < connector.max_active <= 4)
+
+  def test_results_as_they_finish (self):
+    "Check that results are yielded in the order hosts finish"
+    connector = FakeHosts (latencies={"slow" : 0.5, "fast" : 0.01})
+    hosts = [host for (host, results) in wmi.fan_out (["slow", "fast"], "SELECT * FROM Win32_LogicalDisk", connector=connector)]
+    self.assertEquals (hosts, ["fast", "slow"])
+
+  def test_timeout (self):
+    "Check that a host which takes too long yields x_wmi_timed_out"
+    connector = FakeHosts (latencies={"hung" : 5})
+    t0 = time.time ()
+    results = dict (wmi.fan_out (["hung", "ok"], "SELECT * FROM Win32_LogicalDisk", timeout_secs=0.2, connector=connector))
+    self.assert_ (time.time () - t0 < 1)
+    self.assert_ (isinstance (results["hung"], wmi.x_wmi_timed_out))
+    self.assertEquals (len (results["ok"]), 2)
+
+  def test_timed_out_threads_counted (self):
+    "Check that threads abandoned after a timeout still count against max_workers"
+    hosts = ["hung%d" % i for i in range (6)]
+    connector = FakeHosts (latencies=dict ((host, 0.2) for host in hosts))
+    results = dict (wmi.fan_out (hosts, "SELECT * FROM Win32_LogicalDisk", max_workers=2, timeout_secs=0.05, connector=connector))
+    self.assertEquals (len (results), 6)
+    self.assert_ (connector.max_active <= 2, connector.max_active)
+
+  def test_every_worker_hung (self):
+    "Check that a run in which every worker hangs still finishes within its timeouts"
+    hosts = ["hung%d" % i for i in range (6)]
+    connector = FakeHosts (latencies=dict ((host, 2) for host in hosts))
+    t0 = time.time ()
+    results = dict (wmi.fan_out (hosts, "SELECT * FROM Win32_LogicalDisk", max_workers=2, timeout_secs=0.1, connector=connector))
+    self.assert_ (time.time () - t0 < 0.5, time.time () - t0)
+    self.assertEquals (sorted (results), hosts)
+    for result in results.values ():
+      self.assert_ (isinstance (result, wmi.x_wmi_timed_out))
+    self.assert_ (connector.max_active <= 2, connector.max_active)
+
+  def test_queued_behind_hung (self):
+    "Check that a task queued behind hung threads runs if one finishes in time and times out if not"
+    connector = FakeHosts (latencies={"hung1" : 2, "hung2" : 2})
+    t0 = time.time ()
+    results = dict (wmi.fan_out (["hung1", "hung2", "ok"], "SELECT * FROM Win32_LogicalDisk", max_workers=2, timeout_secs=0.1, connector=connector))
+    self.assert_ (time.time () - t0 < 0.5, time.time () - t0)
+    self.assert_ (isinstance (results["ok"], wmi.x_wmi_timed_out))
+    connector = FakeHosts (latencies={"slow1" : 0.15, "slow2" : 0.15})
+    results = dict (wmi.fan_out (["slow1", "slow2", "ok"], "SELECT * FROM Win32_LogicalDisk", max_workers=2, timeout_secs=0.1, connector=connector))
+    self.assert_ (isinstance (results["slow1"], wmi.x_wmi_timed_out))
+    self.assertEquals (len (results["ok"]), 2)
+
+  def test_errors (self):
+    "Check that a host which fails yields its exception"
+    connector = FakeHosts (failures=["bad"])
+    results = dict (wmi.fan_out (["bad", "good"], "SELECT * FROM Win32_LogicalDisk", connector=connector))
+    self.assert_ (isinstance (results["bad"], wmi.x_access_denied))
+    self.assertEquals (len (results["good"]), 2)
+
+  def test_function (self):
+    "Check that a function can be run against each connection"
+    query = lambda c: c.fetch_as_lists ("Win32_LogicalDisk", ["Caption"])
+    results = dict (wmi.fan_out (["a", "b"], query, connector=FakeHosts ()))
+    self.assertEquals (results["a"], [["0:"], ["1:"]])
+
+class FakeMethods (object):
+
+  def __init__ (self):
+    self.threads = []
+
+  def Create (self, CommandLine):
+    self.threads.append (threading.current_thread ())
+    return (1234, 0)
+
+class FakeEvent (object):
+
+  def __init__ (self, ole_object):
+    self.ole_object = ole_object
+    self.event_type = "creation"
+    self.timestamp = datetime.datetime (2010, 1, 1)
+    self.previous = None
+
+class FakeNamespace (wmi._wmi_namespace):
+  """A namespace over fake services which takes `latency` secs over each
+  query and whose watchers time out `n_timeouts` times before each event.
+  """
+
+  def __init__ (self, services, latency=0, n_timeouts=0):
+    wmi._wmi_namespace.__init__ (self, services, False)
+    self._latency = latency
+    self._n_timeouts = n_timeouts
+    self.Win32_Process = FakeMethods ()
+
+  def _raw_query (self, wql, timeout_ms=None):
+    time.sleep (self._latency)
+    return wmi._wmi_namespace._raw_query (self, wql, timeout_ms)
+
+  def watch_for (self, **kwargs):
+    events = iter (fake_disks (3))
+    timeouts = [self._n_timeouts]
+    def watcher (timeout_ms=-1):
+      if timeouts[0]:
+        timeouts[0] -= 1
+        raise wmi.x_wmi_timed_out ()
+      timeouts[0] = self._n_timeouts
+      return FakeEvent (next (events))
+    return watcher
+
+class TestAsync (FakeWMITestCase):
+
+  def setUp (self):
+    try:
+      import asyncio
+    except ImportError:
+      self.skipTest ("asyncio is not available")
+    FakeWMITestCase.setUp (self)
+    self.asyncio = asyncio
+    self.loop = asyncio.new_event_loop ()
+    asyncio.set_event_loop (self.loop)
+    self.services = FakeSWbemServices ([fake_disk_class ()], fake_disks (250))
+    self.namespace = FakeNamespace (self.services)
+    self.connection = wmi.AsyncWMI (connector=lambda computer: self.namespace, max_workers=50)
+
+  def tearDown (self):
+    self.connection.close ()
+    self.loop.close ()
+    self.asyncio.set_event_loop (None)
+    FakeWMITestCase.tearDown (self)
+
+  def drain (self, iterator):
+    results = []
+    iterator = iterator.__aiter__ ()
+    while True:
+      try:
+        results.append (self.loop.run_until_complete (iterator.__anext__ ()))
+      except StopAsyncIteration:
+        return results
+
+  def test_query (self):
+    "Check that a query returns data-only results"
+    disks = self.loop.run_until_complete (self.connection.query ("SELECT * FROM Win32_LogicalDisk"))
+    self.assertEquals (len (disks), 250)
+    self.assert_ (isinstance (disks[0], wmi._wmi_result))
+    self.assertEquals (disks[1].Caption, "1:")
+
+  def test_class_query (self):
+    "Check that a class can be queried"
+    disks = self.loop.run_until_complete (self.connection.Win32_LogicalDisk (["Caption"], DriveType=3))
+    self.assertEquals (len (disks), 250)
+    self.assertEquals (self.services.queries[-1], "SELECT Caption FROM Win32_LogicalDisk WHERE DriveType = '3'")
+
+  def test_iquery (self):
+    "Check that results can be iterated over asynchronously in batches"
+    disks = self.drain (self.connection.Win32_LogicalDisk.iquery (batch_size=100))
+    self.assertEquals ([d.Caption for d in disks], ["%d:" % i for i in range (250)])
+
+  def test_method (self):
+    "Check that a method call is run on the pool"
+    result = self.loop.run_until_complete (self.connection.Win32_Process.Create (CommandLine="notepad.exe"))
+    self.assertEquals (result, (1234, 0))
+    self.assert_ (self.namespace.Win32_Process.threads[0] is not threading.current_thread ())
+
+  def test_watcher (self):
+    "Check that events can be waited for asynchronously"
+    self.namespace._n_timeouts = 2
+    watcher = self.connection.Win32_Process.watch_for ("creation")
+    event = self.loop.run_until_complete (watcher.__anext__ ())
+    self.assertEquals ((event.Caption, event.event_type), ("0:", "creation"))
+    event = self.loop.run_until_complete (watcher.__anext__ ())
+    self.assertEquals (event.Caption, "1:")
+
+  def test_loop_not_blocked (self):
+    "Check that many slow queries run concurrently without blocking the loop"
+    self.namespace._latency = 0.05
+    ticks = []
+    def tick ():
+      ticks.append (time.time ())
+      self.loop.call_later (0.01, tick)
+    self.loop.call_soon (tick)
+    t0 = time.time ()
+    futures = [self.connection.query ("SELECT * FROM Win32_LogicalDisk WHERE DeviceID = '1:'") for i in range (200)]
+    results = self.loop.run_until_complete (self.asyncio.gather (*futures))
+    self.assertEquals (len (results), 200)
+    self.assert_ (time.time () - t0 < 200 * 0.05 / 2)
+    self.assert_ (len (ticks) > 5)
+
+  def test_default_pool (self):
+    "Check that the default connector connects on the pool's threads, once for each"
+    connected_on = []
+    def get_object (moniker):
+      connected_on.append (threading.current_thread ())
+      return self.services
+    _GetObject, wmi.GetObject = wmi.GetObject, get_object
+    connection = wmi.AsyncWMI ("remote")
+    try:
+      for n in range (5):
+        futures = [connection.Win32_LogicalDisk (["Caption"]) for i in range (40)]
+        self.loop.run_until_complete (self.asyncio.gather (*futures))
+      disks = self.drain (connection.Win32_LogicalDisk.iquery (["Caption"]))
+    finally:
+      wmi.GetObject = _GetObject
+      misses, evictions = connection._pool.misses, connection._pool.evictions
+      connection.close ()
+    self.assertEquals (len (disks), 250)
+    self.assert_ (threading.current_thread () not in connected_on)
+    self.assert_ (misses <= 16, misses)
+    self.assertEquals (evictions, 0)
+
+  def test_close_releases_on_workers (self):
+    "Check that closing releases each thread's connections and COM on that thread"
+    initialised, uninitialised, released = [], [], []
+    class Pool (wmi.ConnectionPool):
+      def release (self):
+        released.append (threading.current_thread ())
+        wmi.ConnectionPool.release (self)
+    _GetObject, wmi.GetObject = wmi.GetObject, lambda moniker: self.services
+    _CoInitializeEx, wmi.pythoncom.CoInitializeEx = wmi.pythoncom.CoInitializeEx, lambda flags: initialised.append (threading.current_thread ())
+    _CoUninitialize, wmi.pythoncom.CoUninitialize = wmi.pythoncom.CoUninitialize, lambda: uninitialised.append (threading.current_thread ())
+    pool = Pool ()
+    connection = wmi.AsyncWMI ("remote", max_workers=4, pool=pool)
+    try:
+      futures = [connection.Win32_LogicalDisk (["Caption"]) for i in range (20)]
+      self.loop.run_until_complete (self.asyncio.gather (*futures))
+      connection.close ()
+    finally:
+      wmi.GetObject = _GetObject
+      wmi.pythoncom.CoInitializeEx = _CoInitializeEx
+      wmi.pythoncom.CoUninitialize = _CoUninitialize
+    self.assert_ (initialised)
+    self.assertEquals (sorted (map (id, uninitialised)), sorted (map (id, initialised)))
+    self.assertEquals (sorted (map (id, released)), sorted (map (id, initialised)))
+    self.assert_ (threading.current_thread () not in uninitialised)
+    self.assertEquals (len (pool), 0)
+    self.assertEquals (pool._doomed, {})
+
+class FakeSink (object):
+  """Stands in for an SWbemSink, passing on whatever is fired at it"""
+
+  def __init__ (self, on_object_ready, on_completed):
+    self.on_object_ready = on_object_ready
+    self.on_completed = on_completed
+    self.cancelled = threading.Event ()
+
+  def Cancel (self):
+    self.cancelled.set ()
+    self.on_completed (wmi.constants.wbemErrCallCancelled)
+
+def fake_creation_event (instance, time_created=129000000000000000, calls=None):
+  return FakeSWbemObject (
+    "__InstanceCreationEvent",
+    [("TargetInstance", "object", instance), ("TIME_CREATED", "uint64", str (time_created))],
+    n_keys=0,
+    calls=calls
+  )
+
+class FakeEventServices (FakeSWbemServices):
+  """Services whose asynchronous event queries fire `n_events` events at
+  their sink from a thread of their own, `rate` per second if given.
+  """
+
+  def __init__ (self, n_events, rate=None, fail_with=None):
+    FakeSWbemServices.__init__ (self)
+    self.n_events = n_events
+    self.rate = rate
+    self.fail_with = fail_with
+    self.sinks = []
+
+  def ExecNotificationQueryAsync (self, sink, wql):
+    self.queries.append (wql)
+    self.sinks.append (sink)
+    threading.Thread (target=self.fire, args=(sink,)).start ()
+
+  def fire (self, sink):
+    instances = fake_disks (10)
+    t0 = time.time ()
+    for n in range (self.n_events):
+      if sink.cancelled.isSet ():
+        return
+      sink.on_object_ready (fake_creation_event (instances[n % 10]))
+      if self.rate:
+        delay = t0 + float (n + 1) / self.rate - time.time ()
+        if delay > 0:
+          time.sleep (delay)
+    if self.fail_with is not None:
+      sink.on_completed (self.fail_with)
+
+class TestSinkWatcher (FakeWMITestCase):
+
+  def setUp (self):
+    FakeWMITestCase.setUp (self)
+    self._make_sink = wmi._make_sink
+    wmi._make_sink = FakeSink
+    self.watchers = []
+
+  def tearDown (self):
+    for watcher in self.watchers:
+      watcher.stop ()
+    wmi._make_sink = self._make_sink
+    FakeWMITestCase.tearDown (self)
+
+  def watch (self, services, **kwargs):
+    connection = self.connect (services)
+    watcher = connection.watch_for_async (raw_wql="SELECT * FROM __InstanceCreationEvent WITHIN 1 WHERE TargetInstance ISA 'Win32_LogicalDisk'", **kwargs)
+    self.watchers.append (watcher)
+    return watcher
+
+  def test_queued_events (self):
+    "Check that events pushed to the sink can be picked up in order"
+    watcher = self.watch (FakeEventServices (20))
+    events = [watcher (1000) for i in range (20)]
+    self.assertEquals ([e.Caption for e in events], ["%d:" % (i % 10) for i in range (20)])
+    self.assertEquals (events[0].event_type, "creation")
+    self.assertEquals (events[0].timestamp.year, 2009)
+
+  def test_callback (self):
+    "Check that events can be passed to a callback instead"
+    received = []
+    done = threading.Event ()
+    def callback (event):
+      received.append (event)
+      if len (received) == 5:
+        done.set ()
+    watcher = self.watch (FakeEventServices (5), callback=callback)
+    done.wait (5)
+    self.assertEquals (len (received), 5)
+    self.assertRaises (wmi.x_wmi, watcher)
+    self.assertRaises (wmi.x_wmi, watcher.next_batch)
+
+  def test_timeout (self):
+    "Check that waiting for an event which doesn't come times out"
+    watcher = self.watch (FakeEventServices (0))
+    self.assertRaises (wmi.x_wmi_timed_out, watcher, 100)
+
+  def test_bounded_queue (self):
+    "Check that events beyond max_queued are dropped and counted"
+    watcher = self.watch (FakeEventServices (20), max_queued=5)
+    while watcher.received < 20:
+      time.sleep (0.01)
+    self.assertEquals (watcher.dropped, 15)
+
+  def test_stop (self):
+    "Check that stopping a watcher cancels the sink"
+    services = FakeEventServices (0)
+    watcher = self.watch (services)
+    watcher.stop ()
+    self.assert_ (services.sinks[0].cancelled.isSet ())
+    self.assertRaises (wmi.x_wmi, watcher, 100)
+
+  def test_failure (self):
+    "Check that a failed event query raises when the watcher is next called"
+    watcher = self.watch (FakeEventServices (1, fail_with=wmi.constants.wbemErrFailed))
+    watcher (1000)
+    self.assertRaises (wmi.x_wmi, watcher, 1000)
+
+  def test_class_watcher (self):
+    "Check that a class can be watched asynchronously"
+    services = FakeEventServices (1)
+    services._classes["win32_logicaldisk"] = fake_disk_class ()
+    services._classes["win32_logicaldisk"].Derivation_ = ("CIM_LogicalDisk", "CIM_StorageExtent")
+    connection = self.connect (services)
+    watcher = connection.Win32_LogicalDisk.watch_for_async ("creation", DriveType=3)
+    self.watchers.append (watcher)
+    self.assertEquals (watcher (1000).Caption, "0:")
+    self.assert_ ("TargetInstance.DriveType = '3'" in services.queries[0])
+
+  def test_throughput (self):
+    "Check that events arriving at 10,000 a second are all delivered"
+    watcher = self.watch (FakeEventServices (10000, rate=10000))
+    t0 = time.time ()
+    for n in range (10000):
+      watcher (5000)
+    elapsed = time.time () - t0
+    self.assertEquals (watcher.dropped, 0)
+    self.assert_ (elapsed < 2, "10000 events took %.2f secs" % elapsed)
+    warnings.warn ("10000 events delivered in %.2f secs" % elapsed)
+
+class FakeManualEventServices (FakeSWbemServices):
+  """Services whose event sinks are fired by hand from the test"""
+
+  def __init__ (self):
+    FakeSWbemServices.__init__ (self, [fake_disk_class ()])
+    self._classes["win32_logicaldisk"].Derivation_ = ("CIM_LogicalDisk",)
+    self.sinks = []
+    self.threads = []
+    self.fail = False
+
+  def ExecNotificationQueryAsync (self, sink, wql):
+    if self.fail:
+      raise pywintypes.com_error (-2147217385, "Invalid query", None, None)
+    self.queries.append (wql)
+    self.sinks.append (sink)
+    self.threads.append (threading.current_thread ())
+
+  def fire (self, n_sink, instance):
+    self.sinks[n_sink].on_object_ready (fake_creation_event (instance))
+
+class TestWatcherMultiplexer (FakeWMITestCase):
+
+  def setUp (self):
+    FakeWMITestCase.setUp (self)
+    self._make_sink = wmi._make_sink
+    wmi._make_sink = FakeSink
+    self.services = FakeManualEventServices ()
+    self.connection = self.connect (self.services)
+    self.multiplexer = wmi.WatcherMultiplexer ()
+    for key in ("a", "b", "c"):
+      self.multiplexer.add (key, self.connection.Win32_LogicalDisk, "creation")
+
+  def tearDown (self):
+    self.multiplexer.stop ()
+    wmi._make_sink = self._make_sink
+    FakeWMITestCase.tearDown (self)
+
+  def test_single_thread (self):
+    "Check that all the watchers share one dispatch thread"
+    self.assertEquals (len (self.services.sinks), 3)
+    self.assertEquals (len (set (self.services.threads)), 1)
+    self.assert_ (self.services.threads[0] is not threading.current_thread ())
+
+  def test_arrival_order (self):
+    "Check that each watcher's events are yielded in the order they arrive, with their keys, the watchers taking turns"
+    disks = fake_disks (6)
+    for n_sink, n_disk in [(1, 0), (0, 1), (2, 2), (1, 3), (1, 4), (0, 5)]:
+      self.services.fire (n_sink, disks[n_disk])
+    results = [self.multiplexer (1000) for i in range (6)]
+    self.assertEquals ([(key, event.Caption) for (key, event) in results], [
+      ("a", "1:"), ("b", "0:"), ("c", "2:"), ("a", "5:"), ("b", "3:"), ("b", "4:")
+    ])
+
+  def test_fairness (self):
+    "Check that a busy watcher can't crowd out the others and that none of its events are lost"
+    disks = fake_disks (2)
+    for i in range (1000):
+      self.services.fire (0, disks[0])
+    self.services.fire (2, disks[1])
+    results = [self.multiplexer (1000) for i in range (1001)]
+    self.assertEquals ([key for (key, event) in results[:2]], ["a", "c"])
+    self.assertEquals ([key for (key, event) in results[2:]], ["a"] * 999)
+    self.assertEquals (self.multiplexer.watcher ("a").dropped, 0)
+    self.assertRaises (wmi.x_wmi_timed_out, self.multiplexer, 50)
+
+  def test_backpressure (self):
+    "Check that a watcher with max_queued_per_watcher events waiting holds up delivery until they're picked up"
+    self.multiplexer.max_queued_per_watcher = 2
+    disks = fake_disks (5)
+    def fire ():
+      for disk in disks:
+        self.services.fire (0, disk)
+    thread = threading.Thread (target=fire)
+    thread.daemon = True
+    thread.start ()
+    thread.join (0.2)
+    self.assert_ (thread.is_alive ())
+    self.assertEquals (len (self.multiplexer._queues["a"]), 2)
+    results = [self.multiplexer (1000) for i in range (5)]
+    thread.join (5)
+    self.assertFalse (thread.is_alive ())
+    self.assertEquals ([event.Caption for (key, event) in results], ["%d:" % i for i in range (5)])
+
+  def test_remove_releases_delivery (self):
+    "Check that removing a watcher whose delivery is held up lets it go"
+    self.multiplexer.max_queued_per_watcher = 1
+    disks = fake_disks (2)
+    self.services.fire (0, disks[0])
+    thread = threading.Thread (target=self.services.fire, args=(0, disks[1]))
+    thread.daemon = True
+    thread.start ()
+    thread.join (0.1)
+    self.assert_ (thread.is_alive ())
+    self.multiplexer.remove ("a")
+    thread.join (5)
+    self.assertFalse (thread.is_alive ())
+
+  def test_remove (self):
+    "Check that a removed watcher is cancelled and its events discarded"
+    self.services.fire (0, fake_disks (1)[0])
+    sink = self.services.sinks[0]
+    self.multiplexer.remove ("a")
+    self.assert_ (sink.cancelled.isSet ())
+    self.assertEquals (len (self.multiplexer), 2)
+    self.assertRaises (wmi.x_wmi_timed_out, self.multiplexer, 50)
+
+  def test_failure (self):
+    "Check that a failed watcher raises with its key and is removed"
+    self.services.sinks[1].on_completed (wmi.constants.wbemErrFailed)
+    try:
+      self.multiplexer (1000)
+    except wmi.x_wmi:
+      self.assertEquals (sys.exc_info ()[1].key, "b")
+    else:
+      self.fail ("No exception raised")
+    self.assertEquals (len (self.multiplexer), 2)
+    self.assert_ (self.services.sinks[1].cancelled.isSet ())
+
+  def test_failed_add (self):
+    "Check that a watcher which can't be created leaves nothing behind"
+    self.services.fail = True
+    self.assertRaises (wmi.x_wmi, self.multiplexer.add, "d", self.connection.Win32_LogicalDisk, "creation")
+    self.assertFalse ("d" in self.multiplexer._queues)
+    self.assertFalse ("d" in self.multiplexer._turns)
+    self.assertEquals (len (self.multiplexer), 3)
+    self.services.fail = False
+    self.multiplexer.add ("d", self.connection.Win32_LogicalDisk, "creation")
+    self.assertEquals (len (self.multiplexer), 4)
+
+  def test_dispatcher_stop_cancels (self):
+    "Check that stopping the dispatcher cancels the queries still subscribed"
+    dispatcher = wmi._sink_dispatcher ()
+    dispatcher.subscribe (self.services, "SELECT * FROM __InstanceCreationEvent", lambda event: None, lambda hresult: None)
+    dispatcher.stop ()
+    self.assert_ (self.services.sinks[-1].cancelled.isSet ())
+
+  def test_dispatcher_apartment (self):
+    "Check that the dispatcher is a single-threaded apartment, so that sink callbacks are serialised on it"
+    flags = []
+    _CoInitializeEx, wmi.pythoncom.CoInitializeEx = wmi.pythoncom.CoInitializeEx, lambda flag: flags.append (flag)
+    try:
+      dispatcher = wmi._sink_dispatcher ()
+      dispatcher.stop ()
+    finally:
+      wmi.pythoncom.CoInitializeEx = _CoInitializeEx
+    self.assertEquals (flags, [wmi.pythoncom.COINIT_APARTMENTTHREADED])
+
+class FakeEventSource (object):
+  """Stands in for an SWbemEventSource holding a number of events"""
+
+  def __init__ (self, events, calls):
+    self.events = list (events)
+    self.calls = calls
+
+  def NextEvent (self, timeout_ms):
+    self.calls.count ("NextEvent")
+    if not self.events:
+      raise pywintypes.com_error (wmi.wbemErrTimedout, "Timed out", None, None)
+    return self.events.pop (0)
+
+class TestEventBatches (FakeWMITestCase):
+
+  def setUp (self):
+    FakeWMITestCase.setUp (self)
+    self.calls = FakeCalls ()
+
+  def watcher (self, n_events):
+    disks = fake_disks (10, self.calls)
+    events = [fake_creation_event (disks[n % 10], calls=self.calls) for n in range (n_events)]
+    return wmi._wmi_watcher (FakeEventSource (events, self.calls), False, ["TargetInstance", "*"])
+
+  def test_batch (self):
+    "Check that a batch holds up to max_events events, in order"
+    watcher = self.watcher (25)
+    batch = watcher.next_batch (10, 1000)
+    self.assertEquals ([e.Caption for e in batch], ["%d:" % (n % 10) for n in range (10)])
+    self.assertEquals (batch[0].event_type, "creation")
+    self.assertEquals (batch[0].timestamp.year, 2009)
+    self.assertEquals (len (watcher.next_batch (10, 1000)), 10)
+    self.assertEquals (len (watcher.next_batch (10, 1000)), 5)
+
+  def test_empty_batch (self):
+    "Check that a batch is empty if no events arrive"
+    self.assertEquals (self.watcher (0).next_batch (10, 100), [])
+
+  def test_same_events (self):
+    "Check that batched events match those returned one at a time"
+    single = self.watcher (5)
+    events = [single (1000) for n in range (5)]
+    batch = self.watcher (5).next_batch (5, 1000)
+    for event, batched in zip (events, batch):
+      self.assertEquals (
+        (event.Caption, event.event_type, event.timestamp, event.previous),
+        (batched.Caption, batched.event_type, batched.timestamp, batched.previous)
+      )
+
+  def test_compare_calls_and_time (self):
+    "Compare COM calls and time per event singly and in batches"
+    n_events = 2000
+    results = {}
+    for batched in (False, True):
+      watcher = self.watcher (n_events)
+      self.calls.clear ()
+      t0 = time.time ()
+      if batched:
+        for n in range (n_events // 100):
+          for event in watcher.next_batch (100, 1000):
+            event.Caption
+      else:
+        for n in range (n_events):
+          watcher (1000).Caption
+      results[batched] = (float (self.calls.total ()) / n_events, (time.time () - t0) / n_events)
+    self.assert_ (results[True][0] < results[False][0])
+    warnings.warn (
+      "Per event: %.1f calls, %.1fus singly; %.1f calls, %.1fus in batches" % (
+        results[False][0], results[False][1] * 1e6, results[True][0], results[True][1] * 1e6
+      )
+    )
+
+  def test_sink_watcher_batch (self):
+    "Check that a push-based watcher can return events in batches"
+    _make_sink = wmi._make_sink
+    wmi._make_sink = FakeSink
+    try:
+      watcher = self.connect (FakeEventServices (30)).watch_for_async (raw_wql="SELECT * FROM __InstanceCreationEvent")
+      try:
+        self.assertEquals (len (watcher.next_batch (20, 1000)), 20)
+        self.assertEquals (len (watcher.next_batch (20, 200)), 10)
+      finally:
+        watcher.stop ()
+    finally:
+      wmi._make_sink = _make_sink
+
+class FakeQueryServices (FakeSWbemServices):
+  """Services whose asynchronous queries emit their results to the
+  sink on a timer, every `interval_secs`.
+  """
+
+  def __init__ (self, instances, interval_secs=0, fail_with=None):
+    FakeSWbemServices.__init__ (self, [fake_disk_class ()], instances)
+    self.interval_secs = interval_secs
+    self.fail_with = fail_with
+    self.sinks = []
+    self.emitted = 0
+
+  def ExecQueryAsync (self, sink, strQuery):
+    self.queries.append (strQuery)
+    self.sinks.append (sink)
+    threading.Thread (target=self.emit, args=(sink, self.ExecQuery (strQuery))).start ()
+
+  def emit (self, sink, results):
+    for obj in results:
+      if sink.cancelled.isSet ():
+        return
+      time.sleep (self.interval_secs)
+      sink.on_object_ready (obj)
+      self.emitted += 1
+    if not sink.cancelled.isSet ():
+      sink.on_completed (self.fail_with or 0)
+
+class TestAsyncQuery (FakeWMITestCase):
+
+  def setUp (self):
+    FakeWMITestCase.setUp (self)
+    self._make_sink = wmi._make_sink
+    wmi._make_sink = FakeSink
+
+  def tearDown (self):
+    wmi._make_sink = self._make_sink
+    FakeWMITestCase.tearDown (self)
+
+  def test_results (self):
+    "Check that all the results of an asynchronous query come back in order"
+    connection = self.connect (FakeQueryServices (fake_disks (50)))
+    results = list (connection.query_async ("SELECT * FROM Win32_LogicalDisk"))
+    self.assertEquals ([r.Caption for r in results], ["%d:" % i for i in range (50)])
+
+  def test_class_query (self):
+    "Check that a class can be queried asynchronously"
+    services = FakeQueryServices (fake_disks (3))
+    connection = self.connect (services)
+    self.assertEquals (len (list (connection.Win32_LogicalDisk.query_async (DriveType=3))), 3)
+    self.assertEquals (services.queries[0], "SELECT * FROM Win32_LogicalDisk WHERE DriveType = '3'")
+
+  def test_bounded_queue (self):
+    "Check that WMI is held up while the queue is full"
+    services = FakeQueryServices (fake_disks (20))
+    query = self.connect (services).query_async ("SELECT * FROM Win32_LogicalDisk", max_queued=5)
+    time.sleep (0.2)
+    self.assert_ (services.emitted <= 6)
+    self.assertEquals (len (list (query)), 20)
+
+  def test_cancel (self):
+    "Check that stopping early cancels the query"
+    services = FakeQueryServices (fake_disks (1000), interval_secs=0.001)
+    query = self.connect (services).query_async ("SELECT * FROM Win32_LogicalDisk")
+    for n, result in enumerate (query):
+      if n == 5:
+        break
+    del result
+    query.cancel ()
+    self.assert_ (services.sinks[0].cancelled.isSet ())
+    time.sleep (0.05)
+    self.assert_ (services.emitted < 1000)
+    self.assertEquals (list (query), [])
+
+  def test_failure (self):
+    "Check that a failed query raises once its results are exhausted"
+    services = FakeQueryServices (fake_disks (2), fail_with=wmi.constants.wbemErrFailed)
+    query = self.connect (services).query_async ("SELECT * FROM Win32_LogicalDisk")
+    iterator = iter (query)
+    next (iterator)
+    next (iterator)
+    self.assertRaises (wmi.x_wmi, next, iterator)
+
+  def test_async_iterator (self):
+    "Check that results can be picked up by an asyncio loop as they arrive"
+    try:
+      import asyncio
+    except ImportError:
+      warnings.warn ("Skipping test_async_iterator because asyncio is not available")
+      return
+    loop = asyncio.new_event_loop ()
+    asyncio.set_event_loop (loop)
+    try:
+      services = FakeQueryServices (fake_disks (10), interval_secs=0.01)
+      query = self.connect (services).query_async ("SELECT * FROM Win32_LogicalDisk").__aiter__ ()
+      results = []
+      while True:
+        try:
+          results.append (loop.run_until_complete (query.__anext__ ()))
+        except StopAsyncIteration:
+          break
+      self.assertEquals ([r.Caption for r in results], ["%d:" % i for i in range (10)])
+    finally:
+      asyncio.set_event_loop (None)
+      loop.close ()
+
+  def test_async_break (self):
+    "Check that an asynchronous query dropped early is cancelled, even with its queue full"
+    try:
+      import asyncio
+    except ImportError:
+      warnings.warn ("Skipping test_async_break because asyncio is not available")
+      return
+    loop = asyncio.new_event_loop ()
+    asyncio.set_event_loop (loop)
+    try:
+      services = FakeQueryServices (fake_disks (100))
+      query = self.connect (services).query_async ("SELECT * FROM Win32_LogicalDisk", max_queued=2).__aiter__ ()
+      result = loop.run_until_complete (query.__anext__ ())
+      time.sleep (0.2)
+      del query, result
+      gc.collect ()
+      time.sleep (0.3)
+      self.assert_ (services.sinks[0].cancelled.isSet ())
+      self.assert_ (services.emitted < 10)
+    finally:
+      asyncio.set_event_loop (None)
+      loop.close ()
+
+  def test_aclose (self):
+    "Check that an asynchronous query can be closed from asyncio"
+    try:
+      import asyncio
+    except ImportError:
+      warnings.warn ("Skipping test_aclose because asyncio is not available")
+      return
+    loop = asyncio.new_event_loop ()
+    asyncio.set_event_loop (loop)
+    try:
+      services = FakeQueryServices (fake_disks (100), interval_secs=0.001)
+      query = self.connect (services).query_async ("SELECT * FROM Win32_LogicalDisk")
+      self.assert_ (loop.run_until_complete (query.__aenter__ ()) is query)
+      loop.run_until_complete (query.__anext__ ())
+      loop.run_until_complete (query.__aexit__ (None, None, None))
+      self.assert_ (services.sinks[0].cancelled.isSet ())
+      self.assertRaises (StopAsyncIteration, loop.run_until_complete, query.__anext__ ())
+    finally:
+      asyncio.set_event_loop (None)
+      loop.close ()
+
+def snapshot_summary (disk):
+  #
+  # Run in a worker process by TestSnapshots; must be at module level
+  #
+  return os.getpid (), disk.DeviceID, int (disk.Size) - int (disk.FreeSpace)
+
+class TestSnapshots (FakeWMITestCase):
+
+  def setUp (self):
+    FakeWMITestCase.setUp (self)
+    self.calls = FakeCalls ()
+    self.services = FakeSWbemServices ([fake_disk_class ()], fake_disks (10, self.calls))
+    self.connection = self.connect (self.services)
+
+  def test_freeze (self):
+    "Check that a snapshot carries the object's path, class, keys and values"
+    disk = self.connection.query ("SELECT * FROM Win32_LogicalDisk")[3]
+    snapshot = disk.freeze ()
+    self.assertEquals (snapshot.id, disk.id)
+    self.assertEquals (snapshot.path, disk.Path_.Path)
+    self.assertEquals (snapshot.class_name, "Win32_LogicalDisk")
+    self.assertEquals (snapshot.keys, ["DeviceID"])
+    self.assertEquals (snapshot.DeviceID, "3:")
+    self.assertEquals (snapshot.FreeSpace, "3000")
+    self.assertEquals (snapshot.cimtypes["DriveType"], "uint32")
+    self.assertEquals (snapshot.properties, dict ((p, getattr (disk, p)) for p in disk.properties))
+    self.assertRaises (AttributeError, getattr, snapshot, "Chkdsk")
+    self.assertRaises (AttributeError, setattr, snapshot, "VolumeName", "New")
+
+  def test_one_walk_per_object (self):
+    "Check that freezing an object reads its properties in a single pass"
+    disk = self.connection.query ("SELECT * FROM Win32_LogicalDisk")[0]
+    self.calls.clear ()
+    disk.freeze ()
+    self.assertEquals (self.calls.get ("Properties_"), 1)
+
+  def test_projected (self):
+    "Check that a snapshot of a projected object holds only its fields"
+    disk = self.connection.query ("SELECT DeviceID, Size FROM Win32_LogicalDisk", fields=["DeviceID", "Size"])[1]
+    snapshot = disk.freeze ()
+    self.assertEquals (sorted (snapshot.properties), ["DeviceID", "Size"])
+    self.assertRaises (AttributeError, getattr, snapshot, "FreeSpace")
+
+  def test_pickle (self):
+    "Check that snapshots survive pickling and share their layout"
+    snapshots = [disk.freeze () for disk in self.connection.query ("SELECT * FROM Win32_LogicalDisk")]
+    for protocol in range (pickle.HIGHEST_PROTOCOL + 1):
+      copies = pickle.loads (pickle.dumps (snapshots, protocol))
+      self.assertEquals ([c.properties for c in copies], [s.properties for s in snapshots])
+      self.assertEquals ([c.path for c in copies], [s.path for s in snapshots])
+      self.assert_ (copies[0]._layout is copies[-1]._layout)
+    self.assert_ (len (pickle.dumps (snapshots, pickle.HIGHEST_PROTOCOL)) < 10 * len (pickle.dumps (snapshots[0], pickle.HIGHEST_PROTOCOL)))
+
+  def test_hash_matches_object (self):
+    "Check that a snapshot is equal to, and hashes like, its object"
+    disks = self.connection.query ("SELECT * FROM Win32_LogicalDisk")
+    snapshots = [disk.freeze () for disk in disks]
+    self.assertEquals (snapshots, disks)
+    self.assertEquals (set (snapshots), set (disks))
+    by_disk = dict ((disk, disk.VolumeName) for disk in disks)
+    self.assertEquals (by_disk[snapshots[5]], "Vol5")
+    self.assert_ (snapshots[0] != snapshots[1])
+
+  def test_embedded_objects (self):
+    "Check that embedded objects are frozen along with their container"
+    event = wmi._wmi_object (fake_creation_event (fake_disks (1)[0]))
+    snapshot = event.freeze ()
+    self.assert_ (isinstance (snapshot.TargetInstance, wmi._wmi_snapshot))
+    self.assertEquals (snapshot.TargetInstance.DeviceID, "0:")
+    pickle.dumps (snapshot)
+
+  def test_map_snapshots (self):
+    "Check that map_snapshots runs a function over objects in other processes"
+    disks = self.connection.query ("SELECT * FROM Win32_LogicalDisk")
+    results = list (wmi.map_snapshots (snapshot_summary, disks, chunksize=3, processes=2))
+    self.assertEquals ([r[1:] for r in results], [("%d:" % i, i * 1000) for i in range (10)])
+    self.assert_ (os.getpid () not in set (r[0] for r in results))
+
+class FakeParameters (object):
+  """The in- or out-parameters of a method: named, settable properties"""
+
+  def __init__ (self, names_values, calls=None):
+    self._calls = calls if calls is not None else FakeCalls ()
+    self._properties = [FakeNamed (name, value, IsArray=False) for (name, value) in names_values]
+
+  @property
+  def Properties_ (self):
+    return FakeCollection (self._properties, self._calls, "Parameters")
+
+  def SpawnInstance_ (self):
+    self._calls.count ("SpawnInstance_")
+    return FakeParameters ([(p.Name, p.Value) for p in self._properties], self._calls)
+
+class FakeConcurrency (object):
+  """Keeps track of how many calls are running against each host"""
+
+  def __init__ (self):
+    self.lock = threading.Lock ()
+    self.running = {}
+    self.peak = {}
+
+  def enter (self, host):
+    self.lock.acquire ()
+    try:
+      self.running[host] = self.running.get (host, 0) + 1
+      self.peak[host] = max (self.peak.get (host, 0), self.running[host])
+    finally:
+      self.lock.release ()
+
+  def leave (self, host):
+    self.lock.acquire ()
+    try:
+      self.running[host] -= 1
+    finally:
+      self.lock.release ()
+
+class FakeProcess (FakeSWbemObject):
+  """A Win32_Process whose Terminate method takes `delay` secs and
+  returns the process's handle as its return value. A handle of 13
+  fails the call.
+  """
+
+  def __init__ (self, handle, server="HOST", delay=0, concurrency=None, calls=None, is_class=False):
+    FakeSWbemObject.__init__ (
+      self, "Win32_Process", [("Handle", "string", handle)],
+      calls=calls, is_class=is_class, server=server
+    )
+    self._delay = delay
+    self._concurrency = concurrency if concurrency is not None else FakeConcurrency ()
+    self._methods = [
+      FakeNamed (
+        "Terminate",
+        InParameters=FakeParameters ([("Reason", None)], self._calls),
+        OutParameters=FakeParameters ([("ReturnValue", None)], self._calls),
+        Qualifiers_=[]
+      )
+    ]
+    self.reasons = []
+
+  def ExecMethod_ (self, strMethodName, objWbemInParams=None):
+    self._calls.count ("ExecMethod_")
+    self._concurrency.enter (self._path.Server)
+    try:
+      time.sleep (self._delay)
+    finally:
+      self._concurrency.leave (self._path.Server)
+    self.reasons.append (objWbemInParams.Properties_ ("Reason").Value)
+    handle = self._properties[0].Value
+    if handle == "13":
+      raise pywintypes.com_error (-2147217407, "Generic failure", None, None)
+    return FakeParameters ([("ReturnValue", int (handle))])
+
+class FakeMethodServices (FakeSWbemServices):
+  """Services which can also execute a method on an instance by path"""
+
+  def ExecMethod (self, strObjectPath, strMethodName, objWbemInParams=None):
+    self._calls.count ("ExecMethod")
+    for instance in self._instances["win32_process"]:
+      if instance.Path_.Path == strObjectPath:
+        return instance.ExecMethod_ (strMethodName, objWbemInParams)
+    raise pywintypes.com_error (-2147217406, "Not found", None, None)
+
+class TestInvokeMany (FakeWMITestCase):
+
+  pass_marshalled = True
+
+  def setUp (self):
+    FakeWMITestCase.setUp (self)
+    self.calls = FakeCalls ()
+    self.concurrency = FakeConcurrency ()
+    self.processes = [
+      FakeProcess (str (i), server="HOST%d" % (i % 3), delay=0.05, concurrency=self.concurrency, calls=self.calls)
+        for i in range (12)
+    ]
+    self.services = FakeMethodServices ([FakeProcess ("", calls=self.calls, is_class=True)], self.processes, self.calls)
+    self.connection = self.connect (self.services)
+
+  def test_results (self):
+    "Check that each instance gets back its own out parameters"
+    processes = self.connection.query ("SELECT * FROM Win32_Process")
+    results = dict (self.connection.invoke_many (processes, "Terminate", kwargs=dict (Reason=1)))
+    self.assertEquals (len (results), 12)
+    for process in processes:
+      self.assertEquals (results[process], (int (process.Handle),))
+    self.assertEquals ([p.reasons for p in self.processes], [[1]] * 12)
+
+  def test_positional_args (self):
+    "Check that positional arguments fill in the parameters in order"
+    processes = self.connection.query ("SELECT * FROM Win32_Process")
+    list (self.connection.invoke_many (processes, "Terminate", (7,)))
+    self.assertEquals ([p.reasons for p in self.processes], [[7]] * 12)
+
+  def test_method_read_once (self):
+    "Check that the method's parameters are read and filled in only once"
+    processes = self.connection.query ("SELECT * FROM Win32_Process")
+    self.calls.clear ()
+    list (self.connection.invoke_many (processes, "Terminate", kwargs=dict (Reason=1)))
+    self.assertEquals (self.calls["Methods_()"], 1)
+    self.assertEquals (self.calls["SpawnInstance_"], 1)
+    self.assertEquals (self.calls["ExecMethod_"], 12)
+
+  def test_bounded_per_host (self):
+    "Check that calls run concurrently but no more than max_per_host at a time on each host"
+    processes = self.connection.query ("SELECT * FROM Win32_Process")
+    started = time.time ()
+    list (self.connection.invoke_many (processes, "Terminate", kwargs=dict (Reason=1), max_per_host=2))
+    elapsed = time.time () - started
+    self.assertEquals (self.concurrency.peak, {"HOST0" : 2, "HOST1" : 2, "HOST2" : 2})
+    self.assert_ (elapsed < 12 * 0.05 / 2, elapsed)
+
+  def test_max_workers (self):
+    "Check that no more than max_workers calls run at once across hosts"
+    processes = self.connection.query ("SELECT * FROM Win32_Process")
+    list (self.connection.invoke_many (processes, "Terminate", kwargs=dict (Reason=1), max_workers=1))
+    self.assertEquals (self.concurrency.peak, {"HOST0" : 1, "HOST1" : 1, "HOST2" : 1})
+
+  def test_paths (self):
+    "Check that instances can be given by path"
+    paths = [p.Path_.Path for p in self.processes[:4]]
+    results = dict (self.connection.invoke_many (paths, "Terminate", kwargs=dict (Reason=2)))
+    self.assertEquals (results, dict ((path, (n,)) for (n, path) in enumerate (paths)))
+    self.assertEquals (self.calls["ExecMethod"], 4)
+
+  def test_errors (self):
+    "Check that a failed call yields its exception without stopping the others"
+    processes = self.processes + [FakeProcess ("13", calls=self.calls)]
+    self.services.set_instances ("Win32_Process", processes)
+    results = dict (self.connection.invoke_many (self.connection.query ("SELECT * FROM Win32_Process"), "Terminate", (1,)))
+    errors = [r for r in results.values () if isinstance (r, Exception)]
+    self.assertEquals (len (errors), 1)
+    self.assert_ (isinstance (errors[0], wmi.x_wmi))
+    self.assertEquals (len (results), 13)
+
+  def test_unknown_method (self):
+    "Check that an unknown method name is each target's result"
+    processes = self.connection.query ("SELECT * FROM Win32_Process")
+    results = dict (self.connection.invoke_many (processes, "Explode"))
+    self.assertEquals (len (results), 12)
+    for result in results.values ():
+      self.assert_ (isinstance (result, AttributeError), result)
+
+  def test_unknown_class (self):
+    "Check that a class which can't be fetched fails only its own targets"
+    paths = [p.Path_.Path for p in self.processes[:2]] + ["Win32_Nothing.Handle=\"1\""]
+    results = dict (self.connection.invoke_many (paths, "Terminate", (1,)))
+    self.assertEquals ([results[path] for path in paths[:2]], [(0,), (1,)])
+    self.assert_ (isinstance (results[paths[2]], (wmi.x_wmi, AttributeError)), results[paths[2]])
+
+  def test_targets_drawn_lazily (self):
+    "Check that targets for a busy host aren't all taken up front"
+    processes = [FakeProcess (str (i), delay=0.02, concurrency=self.concurrency, calls=self.calls) for i in range (40)]
+    self.services.set_instances ("Win32_Process", processes)
+    drawn = []
+    def targets ():
+      for process in self.connection.query ("SELECT * FROM Win32_Process"):
+        drawn.append (process)
+        yield process
+    results = self.connection.invoke_many (targets (), "Terminate", (1,), max_per_host=1, max_workers=4)
+    next (results)
+    self.assert_ (len (drawn) <= 1 + 4 + 1, len (drawn))
+    self.assertEquals (len (list (results)), 39)
+
+  def test_timed_out_call_holds_host (self):
+    "Check that a call which timed out counts against its host until it finishes"
+    processes = [FakeProcess (str (i), delay=0.2, concurrency=self.concurrency, calls=self.calls) for i in range (3)]
+    self.services.set_instances ("Win32_Process", processes)
+    results = list (self.connection.invoke_many (
+      self.connection.query ("SELECT * FROM Win32_Process"), "Terminate", (1,), max_per_host=1, timeout_secs=0.05
+    ))
+    self.assertEquals (len (results), 3)
+    self.assertEquals (self.concurrency.peak, {"HOST" : 1})
+
+  def test_hung_host (self):
+    "Check that calls waiting on a host held by a hung call time out rather than wait for it"
+    processes = [FakeProcess (str (i), delay=2, concurrency=self.concurrency, calls=self.calls) for i in range (3)]
+    self.services.set_instances ("Win32_Process", processes)
+    t0 = time.time ()
+    results = list (self.connection.invoke_many (
+      self.connection.query ("SELECT * FROM Win32_Process"), "Terminate", (1,), max_per_host=1, timeout_secs=0.05
+    ))
+    self.assert_ (time.time () - t0 < 0.5, time.time () - t0)
+    self.assertEquals (len (results), 3)
+    for target, result in results:
+      self.assert_ (isinstance (result, wmi.x_wmi_timed_out))
+    self.assertEquals (self.concurrency.peak, {"HOST" : 1})
+
+class FakeBusyResults (object):
+  """A result set which fails with `hresult` after its first object"""
+
+  def __init__ (self, objects, hresult):
+    self._objects = objects
+    self._hresult = hresult
+
+  def __iter__ (self):
+    yield self._objects[0]
+    raise pywintypes.com_error (self._hresult, "Exception occurred", None, None)
+
+class TestConcurrencyLimiter (FakeWMITestCase):
+
+  def setUp (self):
+    FakeWMITestCase.setUp (self)
+    self.clock = FakeClock ()
+    self.limiter = wmi.ConcurrencyLimiter (initial_limit=2, max_limit=5, target_latency_secs=1.0, clock=self.clock)
+    self._GetObject = wmi.GetObject
+
+  def tearDown (self):
+    wmi.GetObject = self._GetObject
+    FakeWMITestCase.tearDown (self)
+
+  def run_calls (self, n_calls, latency_secs, error=None):
+    for i in range (n_calls):
+      started = self.limiter.acquire ("HOST")
+      self.clock.now += latency_secs
+      self.limiter.release ("HOST", started, error)
+
+  def test_additive_increase (self):
+    "Check that the limit grows by about one for each full round of quick calls"
+    self.run_calls (3, 0.1)
+    self.assertEquals (self.limiter.metrics ()["host"]["limit"], 3)
+    self.run_calls (4, 0.1)
+    self.assertEquals (self.limiter.metrics ()["host"]["limit"], 4)
+    self.run_calls (100, 0.1)
+    self.assertEquals (self.limiter.metrics ()["host"]["limit"], 5)
+
+  def test_slow_calls_hold (self):
+    "Check that the limit doesn't grow while calls are slow"
+    self.run_calls (10, 2.0)
+    metrics = self.limiter.metrics ()["host"]
+    self.assertEquals (metrics["limit"], 2)
+    self.assertEquals (metrics["calls"], 10)
+    self.assertEquals (metrics["latency_secs"], 2.0)
+
+  def test_backoff_on_timeout (self):
+    "Check that a timeout halves the limit"
+    self.run_calls (20, 0.1)
+    self.run_calls (1, 0.1, wmi.x_wmi_timed_out ())
+    metrics = self.limiter.metrics ()["host"]
+    self.assertEquals (metrics["limit"], 2)
+    self.assertEquals (metrics["overloaded"], 1)
+    self.assertEquals (metrics["backoffs"], 1)
+    self.run_calls (5, 0.1, wmi.x_wmi_timed_out ())
+    self.assertEquals (self.limiter.metrics ()["host"]["limit"], 1)
+
+  def test_backoff_once_per_overload (self):
+    "Check that calls caught by the same overload cut the limit only once"
+    self.run_calls (20, 0.1)
+    started = [self.limiter.acquire ("HOST") for i in range (4)]
+    self.clock.now += 1
+    quota = pywintypes.com_error (wmi.constants.wbemErrQuotaViolation, "Quota violation", None, None)
+    for s in started:
+      self.limiter.release ("HOST", s, quota)
+    metrics = self.limiter.metrics ()["host"]
+    self.assertEquals (metrics["limit"], 2)
+    self.assertEquals (metrics["overloaded"], 4)
+    self.assertEquals (metrics["backoffs"], 1)
+
+  def test_other_errors (self):
+    "Check that errors which aren't overload neither raise nor cut the limit"
+    self.run_calls (1, 0.1, wmi.x_wmi_invalid_query ())
+    metrics = self.limiter.metrics ()["host"]
+    self.assertEquals ((metrics["limit"], metrics["errors"], metrics["backoffs"]), (2, 1, 0))
+
+  def test_waits_for_slot (self):
+    "Check that no more calls run at once than the host's limit"
+    limiter = wmi.ConcurrencyLimiter (initial_limit=2, max_limit=2)
+    def call ():
+      limiter.call ("HOST", time.sleep, 0.05)
+    threads = [threading.Thread (target=call) for i in range (6)]
+    for thread in threads:
+      thread.start ()
+    for thread in threads:
+      thread.join ()
+    metrics = limiter.metrics ()["host"]
+    self.assertEquals (metrics["peak"], 2)
+    self.assertEquals (metrics["calls"], 6)
+    self.assertEquals (metrics["in_flight"], 0)
+
+  def test_hosts_separate (self):
+    "Check that each host has its own limit"
+    self.run_calls (20, 0.1)
+    started = self.limiter.acquire ("other")
+    self.limiter.release ("other", started, wmi.x_wmi_timed_out ())
+    metrics = self.limiter.metrics ()
+    self.assertEquals ((metrics["host"]["limit"], metrics["other"]["limit"]), (5, 1))
+
+  def test_query_holds_slot (self):
+    "Check that a query against a limited namespace holds a slot until its first result arrives"
+    services = FakeSWbemServices ([fake_disk_class ()], fake_disks (3))
+    wmi.GetObject = lambda moniker: services
+    connection = wmi.WMI ("remote", limiter=self.limiter, pool=False)
+    self.assertEquals (self.limiter.metrics ()["remote"]["calls"], 1)
+    results = connection.iquery ("SELECT * FROM Win32_LogicalDisk")
+    next (results)
+    self.assertEquals (self.limiter.metrics ()["remote"]["in_flight"], 0)
+    self.clock.now += 0.5
+    list (results)
+    metrics = self.limiter.metrics ()["remote"]
+    self.assertEquals ((metrics["in_flight"], metrics["calls"]), (0, 2))
+    self.assertEquals (metrics["latency_secs"], 0)
+    self.assertEquals (len (connection.query ("SELECT * FROM Win32_LogicalDisk")), 3)
+    self.assertEquals (self.limiter.metrics ()["remote"]["calls"], 3)
+
+  def test_nested_queries (self):
+    "Check that querying a host while reading another query's results doesn't wait on a slot"
+    limiter = wmi.ConcurrencyLimiter (initial_limit=1, max_limit=1)
+    services = FakeSWbemServices ([fake_disk_class ()], fake_disks (3))
+    connection = self.connect (services, location=("HOST", ""), limiter=limiter)
+    pairs = []
+    def nested ():
+      for outer in connection.iquery ("SELECT * FROM Win32_LogicalDisk"):
+        for inner in connection.iquery ("SELECT * FROM Win32_LogicalDisk"):
+          pairs.append ((outer.DeviceID, inner.DeviceID))
+    thread = threading.Thread (target=nested)
+    thread.daemon = True
+    thread.start ()
+    thread.join (5)
+    self.assertFalse (thread.is_alive ())
+    self.assertEquals (len (pairs), 9)
+    self.assertEquals (limiter.metrics ()["host"]["in_flight"], 0)
+
+  def test_moniker_host (self):
+    "Check that the host is picked out of a moniker"
+    self.assertEquals (wmi._moniker_host ("winmgmts:{impersonationLevel=Delegate}//Remote/root/cimv2"), "remote")
+    self.assertEquals (wmi._moniker_host ("winmgmts:\\\\remote\\root\\cimv2"), "remote")
+    self.assertEquals (wmi._moniker_host ("winmgmts:root\\cimv2"), ".")
+
+  def test_query_backs_off (self):
+    "Check that a query which the host is too busy to finish cuts its limit"
+    services = FakeSWbemServices ([fake_disk_class ()])
+    services.set_instances ("Win32_LogicalDisk", lambda: FakeBusyResults (fake_disks (2), wmi.constants.wbemErrServerTooBusy))
+    connection = self.connect (services, location=("HOST", ""), limiter=self.limiter)
+    self.run_calls (20, 0.1)
+    self.assertRaises (wmi.x_wmi, connection.query, "SELECT * FROM Win32_LogicalDisk")
+    metrics = self.limiter.metrics ()["host"]
+    self.assertEquals ((metrics["limit"], metrics["backoffs"], metrics["in_flight"]), (2, 1, 0))
+
+class FakeHangingResults (object):
+  """A result set which returns `n_objects` and then hangs until
+  `release` is set, noting when it has been let go.
+  """
+
+  def __init__ (self, objects, release):
+    self._objects = objects
+    self._release = release
+    self.closed = threading.Event ()
+
+  def __iter__ (self):
+    try:
+      for obj in self._objects:
+        yield obj
+      self._release.wait ()
+    finally:
+      self.closed.set ()
+
+class TestQueryDeadlines (FakeWMITestCase):
+
+  pass_marshalled = True
+
+  def setUp (self):
+    FakeWMITestCase.setUp (self)
+    self.release = threading.Event ()
+    self.results = FakeHangingResults (fake_disks (3), self.release)
+    self.services = FakeSWbemServices ([fake_disk_class ()])
+    self.services.set_instances ("Win32_LogicalDisk", lambda: self.results)
+    self.connection = self.connect (self.services)
+
+  def tearDown (self):
+    self.release.set ()
+    FakeWMITestCase.tearDown (self)
+
+  def assertTimesOut (self, function, *args, **kwargs):
+    started = time.time ()
+    self.assertRaises (wmi.x_wmi_timed_out, function, *args, **kwargs)
+    elapsed = time.time () - started
+    self.assert_ (0.15 <= elapsed < 1.0, elapsed)
+
+  def test_query (self):
+    "Check that a query whose enumeration hangs times out"
+    self.assertTimesOut (self.connection.query, "SELECT * FROM Win32_LogicalDisk", timeout_ms=200)
+
+  def test_class_query (self):
+    "Check that a class's query takes a timeout too"
+    self.assertTimesOut (self.connection.Win32_LogicalDisk, timeout_ms=200)
+
+  def test_fetch (self):
+    "Check that the fetch methods time out"
+    self.assertTimesOut (self.connection.fetch_as_classes, "Win32_LogicalDisk", timeout_ms=200)
+    self.assertTimesOut (self.connection.fetch_as_lists, "Win32_LogicalDisk", ["DeviceID"], timeout_ms=200)
+    self.assertTimesOut (self.connection.fetch_as_columns, "Win32_LogicalDisk", ["DeviceID"], timeout_ms=200)
+
+  def test_hanging_exec_query (self):
+    "Check that a hang in the query itself, before any results, times out"
+    release = self.release
+    def ExecQuery (strQuery, iFlags=0):
+      release.wait ()
+      return []
+    self.services.ExecQuery = ExecQuery
+    self.assertTimesOut (self.connection.query, "SELECT * FROM Win32_LogicalDisk", timeout_ms=200)
+
+  def test_iquery_yields_until_deadline (self):
+    "Check that the results in before the deadline are still yielded"
+    seen = []
+    try:
+      for disk in self.connection.iquery ("SELECT * FROM Win32_LogicalDisk", timeout_ms=200):
+        seen.append (disk.DeviceID)
+    except wmi.x_wmi_timed_out:
+      pass
+    else:
+      self.fail ("Didn't time out")
+    self.assertEquals (seen, ["0:", "1:", "2:"])
+
+  def test_class_iquery (self):
+    "Check that a class's iquery takes a timeout rather than treating it as a property"
+    self.assertTimesOut (lambda: list (self.connection.Win32_LogicalDisk.iquery (timeout_ms=200)))
+    self.assertEquals (self.services.queries[-1], "SELECT * FROM Win32_LogicalDisk")
+
+  def test_slow_consumer (self):
+    "Check that time spent dealing with each result doesn't count towards the timeout"
+    self.release.set ()
+    seen = []
+    for disk in self.connection.iquery ("SELECT * FROM Win32_LogicalDisk", timeout_ms=200):
+      time.sleep (0.1)
+      seen.append (disk.DeviceID)
+    self.assertEquals (seen, ["0:", "1:", "2:"])
+
+  def test_releases_enumerator (self):
+    "Check that the enumerator is let go once WMI lets the worker go"
+    self.assertRaises (wmi.x_wmi_timed_out, self.connection.query, "SELECT * FROM Win32_LogicalDisk", timeout_ms=100)
+    self.assert_ (not self.results.closed.is_set ())
+    self.release.set ()
+    self.assert_ (self.results.closed.wait (2))
+
+  def test_within_deadline (self):
+    "Check that a query which finishes in time isn't affected"
+    self.release.set ()
+    disks = self.connection.query ("SELECT * FROM Win32_LogicalDisk", timeout_ms=1000)
+    self.assertEquals ([d.DeviceID for d in disks], ["0:", "1:", "2:"])
+
+  def test_errors_passed_back (self):
+    "Check that an error raised on the worker thread reaches the caller"
+    self.services.set_instances ("Win32_LogicalDisk", lambda: FakeBusyResults (fake_disks (2), wmi.constants.wbemErrInvalidQuery))
+    self.assertRaises (wmi.x_wmi_invalid_query, self.connection.query, "SELECT * FROM Win32_LogicalDisk", timeout_ms=1000)
+
+  def test_limiter_backs_off (self):
+    "Check that a query timing out counts against its host's limit"
+    clock = FakeClock ()
+    limiter = wmi.ConcurrencyLimiter (initial_limit=4, clock=clock)
+    connection = self.connect (self.services, location=("HOST", ""), limiter=limiter)
+    self.assertRaises (wmi.x_wmi_timed_out, connection.query, "SELECT * FROM Win32_LogicalDisk", timeout_ms=100)
+    metrics = limiter.metrics ()["host"]
+    self.assertEquals ((metrics["limit"], metrics["overloaded"], metrics["in_flight"]), (2, 1, 0))
+
+class TestWhere (FakeWMITestCase):
+
+  def setUp (self):
+    FakeWMITestCase.setUp (self)
+    disk_class = fake_disk_class ()
+    disk_class.Derivation_ = ("CIM_LogicalDisk",)
+    self.services = FakeSWbemServices ([disk_class], fake_disks (3))
+    self.connection = self.connect (self.services)
+
+  def test_comparisons (self):
+    "Check that each comparison renders as WQL"
+    F = wmi.Field
+    self.assertEquals (str (F ("Size") > 1024), "Size > 1024")
+    self.assertEquals (str (F ("Size") >= 1.5), "Size >= 1.5")
+    self.assertEquals (str (F ("Size") < 10), "Size < 10")
+    self.assertEquals (str (F ("Size") <= 10), "Size <= 10")
+    self.assertEquals (str (F ("DriveType") == 3), "DriveType = 3")
+    self.assertEquals (str (F ("DeviceID") != "C:"), "DeviceID <> 'C:'")
+    self.assertEquals (str (F ("Compressed") == True), "Compressed = TRUE")
+    self.assertEquals (str (F ("Name").like ("sql%")), "Name LIKE 'sql%'")
+    self.assertEquals (str (F ("VolumeName").is_null ()), "VolumeName IS NULL")
+    self.assertEquals (str (F ("VolumeName") == None), "VolumeName IS NULL")
+    self.assertEquals (str (F ("VolumeName") != None), "VolumeName IS NOT NULL")
+    self.assertEquals (str (F ("TargetInstance").isa ("Win32_Process")), "TargetInstance ISA 'Win32_Process'")
+
+  def test_escaping (self):
+    "Check that quotes and backslashes in strings are escaped"
+    self.assertEquals (str (wmi.Field ("Name") == "c:\\it's"), "Name = 'c:\\\\it\\'s'")
+
+  def test_datetimes (self):
+    "Check that datetimes are rendered as DMTF and other values refused"
+    F = wmi.Field
+    self.assertEquals (str (F ("InstallDate") > datetime.datetime (2010, 3, 4, 5, 6, 7)), "InstallDate > '20100304050607.000000+000'")
+    self.assertEquals (str (F ("InstallDate") < datetime.date (2010, 3, 4)), "InstallDate < '20100304000000.000000+000'")
+    self.assertRaises (wmi.x_wmi, str, F ("Name") == ["a"])
+    self.assertRaises (wmi.x_wmi, str, F ("Name") == object ())
+
+  def test_combining (self):
+    "Check that conditions combine with &, | and ~ and are grouped as needed"
+    F = wmi.Field
+    a, b, c = F ("A") == 1, F ("B") == 2, F ("C") == 3
+    self.assertEquals (str (a & b & c), "A = 1 AND B = 2 AND C = 3")
+    self.assertEquals (str ((a | b) & c), "(A = 1 OR B = 2) AND C = 3")
+    self.assertEquals (str (a | (b & c)), "A = 1 OR (B = 2 AND C = 3)")
+    self.assertEquals (str (~(a | b)), "NOT (A = 1 OR B = 2)")
+    self.assertEquals ((a & ~b).wql ("TargetInstance."), "TargetInstance.A = 1 AND NOT (TargetInstance.B = 2)")
+
+  def test_misuse (self):
+    "Check that and/or, chained comparisons and bad names are caught"
+    F = wmi.Field
+    self.assertRaises (TypeError, lambda: (F ("A") == 1) and (F ("B") == 2))
+    self.assertRaises (TypeError, lambda: 1 < F ("A") < 5)
+    self.assertRaises (TypeError, lambda: F ("A") == F ("B"))
+    self.assertRaises (wmi.x_wmi, F, "A = 1 OR 1")
+
+  def test_query (self):
+    "Check that a condition is added to a query and not escaped again"
+    where = (wmi.Field ("Size") > 1000) & (wmi.Field ("Caption") == "a\\b")
+    self.connection.query ("SELECT * FROM Win32_LogicalDisk", where=where)
+    self.assertEquals (self.services.queries[-1], "SELECT * FROM Win32_LogicalDisk WHERE Size > 1000 AND Caption = 'a\\\\b'")
+
+  def test_query_with_where_clause (self):
+    "Check that a condition is ANDed onto an existing WHERE clause"
+    self.connection.query ("SELECT * FROM Win32_LogicalDisk WHERE DriveType = 3 OR DriveType = 4", where=wmi.Field ("Size") > 1)
+    self.assertEquals (self.services.queries[-1], "SELECT * FROM Win32_LogicalDisk WHERE (DriveType = 3 OR DriveType = 4) AND (Size > 1)")
+
+  def test_where_in_literal (self):
+    "Check that 'where' inside a quoted literal isn't taken for the WHERE keyword"
+    self.assertEquals (
+      wmi._add_where ("ASSOCIATORS OF {Win32_Service.Name='no where'}", "ResultClass = Win32_Process"),
+      "ASSOCIATORS OF {Win32_Service.Name='no where'} WHERE ResultClass = Win32_Process"
+    )
+    self.assertEquals (
+      wmi._add_where ("ASSOCIATORS OF {Win32_Service.Name='a where b'} WHERE ClassDefsOnly", "ResultRole = Antecedent"),
+      "ASSOCIATORS OF {Win32_Service.Name='a where b'} WHERE (ClassDefsOnly) AND (ResultRole = Antecedent)"
+    )
+
+  def test_class_query (self):
+    "Check that a class query combines keyword arguments with a condition"
+    self.connection.Win32_LogicalDisk (["Caption"], where=wmi.Field ("Size") > 1, DriveType=3)
+    self.assertEquals (self.services.queries[-1], "SELECT Caption FROM Win32_LogicalDisk WHERE (DriveType = '3') AND (Size > 1)")
+
+  def test_fetch (self):
+    "Check that the fetch methods take a condition"
+    self.connection.fetch_as_lists ("Win32_LogicalDisk", ["Caption"], where=wmi.Field ("Caption").like ("%:"))
+    self.assertEquals (self.services.queries[-1], "SELECT Caption FROM Win32_LogicalDisk WHERE Caption LIKE '%:'")
+
+  def test_watch_for (self):
+    "Check that an intrinsic event's condition applies to its TargetInstance"
+    wql, is_extrinsic, fields = self.connection._watch_wql (
+      None, "creation", "Win32_LogicalDisk", 1, [], {}, wmi.Field ("DriveType") == 3
+    )
+    self.assert_ (wql.endswith (" FROM __InstancecreationEvent WITHIN 1 WHERE (TargetInstance ISA 'Win32_LogicalDisk' ) AND (TargetInstance.DriveType = 3)"), wql)
+
+  def test_watch_for_extrinsic (self):
+    "Check that an extrinsic event's condition applies to the event itself"
+    self.services.Get ("Win32_LogicalDisk").Derivation_ = ("__ExtrinsicEvent",)
+    wql, is_extrinsic, fields = self.connection._watch_wql (
+      None, "operation", "Win32_LogicalDisk", 1, [], {}, wmi.Field ("Caption") != "C:"
+    )
+    self.assert_ (is_extrinsic)
+    self.assert_ (wql.endswith (" FROM Win32_LogicalDisk WHERE Caption <> 'C:'"), wql)
+
+class TestFilter (FakeWMITestCase):
+
+  def setUp (self):
+    FakeWMITestCase.setUp (self)
+    self.services = FakeSWbemServices ([fake_disk_class ()], fake_disks (6))
+    self.connection = self.connect (self.services)
+
+  def test_split (self):
+    "Check that the terms of an AND are split between WMI and Python"
+    F = wmi.Field
+    is_even = F ("DeviceID").test (lambda d: int (d[0]) % 2 == 0)
+    pushed, residual = wmi._split_predicate ((F ("Size") > 1) & is_even & (F ("DriveType") == 3))
+    self.assertEquals (pushed.wql (), "Size > 1 AND DriveType = 3")
+    self.assert_ (residual is is_even)
+
+  def test_split_whole (self):
+    "Check that an OR or a NOT including a Python test stays whole"
+    F = wmi.Field
+    either = (F ("Size") > 1) | F ("DeviceID").test (bool)
+    self.assertEquals (wmi._split_predicate (either), (None, either))
+    self.assertEquals (wmi._split_predicate (~either)[0], None)
+    self.assertEquals (wmi._split_predicate (F ("Size") > 1)[1], None)
+
+  def test_filter (self):
+    "Check that the WQL part is sent to WMI and the rest applied to what comes back"
+    F = wmi.Field
+    disks = self.connection.Win32_LogicalDisk.filter ((F ("FreeSpace") > 1500) & F ("DeviceID").test (lambda d: int (d[0]) % 2 == 0))
+    self.assertEquals ([d.DeviceID for d in disks], ["0:", "2:", "4:"])
+    self.assertEquals (self.services.queries[-1], "SELECT * FROM Win32_LogicalDisk WHERE FreeSpace > 1500")
+    self.assertEquals ((disks.n_fetched, disks.n_passed), (6, 3))
+
+  def test_evaluate (self):
+    "Check that WQL conditions are evaluated here as WMI would"
+    F = wmi.Field
+    never = wmi.Predicate (lambda disk: False)
+    def matching (condition):
+      return [d.DeviceID for d in self.connection.Win32_LogicalDisk.filter (condition | never)]
+    self.assertEquals (matching (F ("FreeSpace") > 3000), ["4:", "5:"])
+    self.assertEquals (matching (F ("Caption") == "1:"), ["1:"])
+    self.assertEquals (matching (F ("VolumeName") == "VOL2"), ["2:"])
+    self.assertEquals (matching (F ("VolumeName").like ("vol[13]")), ["1:", "3:"])
+    self.assertEquals (matching (F ("VolumeName").like ("%4") | (F ("DriveType") != 3)), ["4:"])
+    self.assertEquals (matching (~F ("VolumeName").is_null () & (F ("Size") <= 2000)), ["0:", "1:"])
+    self.assertEquals (matching (F ("VolumeName").matches ("[05]$")), ["0:", "5:"])
+    self.assertEquals (matching (F ("DriveType").matches ("^3$")), ["%d:" % i for i in range (6)])
+
+  def test_wide_integers (self):
+    "Check that 64-bit values compare exactly rather than as floats"
+    condition = wmi.Field ("Size") > 2 ** 63
+    [ole_object] = fake_disks (1)
+    ole_object.Properties_ ("Size").Value = str (2 ** 63 + 1)
+    disk = wmi._wmi_object (ole_object)
+    self.assert_ (condition.evaluate (disk))
+    self.assertFalse ((wmi.Field ("Size") == 2 ** 63).evaluate (disk))
+
+  def test_fields (self):
+    "Check that properties needed by the Python tests are fetched too"
+    disks = self.connection.Win32_LogicalDisk.filter (wmi.Field ("VolumeName").test (bool), fields=["Caption"])
+    self.assertEquals (disks.wql, "SELECT Caption, VolumeName FROM Win32_LogicalDisk")
+
+  def test_explain (self):
+    "Check that explain shows what was sent to WMI and what was applied here"
+    F = wmi.Field
+    def is_even (device_id):
+      return int (device_id[0]) % 2 == 0
+    disks = self.connection.Win32_LogicalDisk.filter ((F ("FreeSpace") > 1500) & F ("DeviceID").test (is_even))
+    list (disks)
+    self.assertEquals (disks.explain ().splitlines (), [
+      "Query: SELECT * FROM Win32_LogicalDisk WHERE FreeSpace > 1500",
+      "Sent to WMI: FreeSpace > 1500",
+      "Applied here: is_even (DeviceID)",
+      "Objects: 6 fetched, 3 passed",
+    ])
+
+  def test_query_refuses_python (self):
+    "Check that a query with a condition WQL can't express says so"
+    where = wmi.Field ("DeviceID").test (bool)
+    self.assertRaises (wmi.x_wmi, self.connection.query, "SELECT * FROM Win32_LogicalDisk", where=where)
+
+class TestPrepared (FakeWMITestCase):
+
+  def setUp (self):
+    FakeWMITestCase.setUp (self)
+    self.services = FakeSWbemServices ([fake_disk_class (extra_properties=[("Compressed", "boolean"), ("Installed", "datetime")])], fake_disks (3))
+    self.connection = self.connect (self.services)
+
+  def test_bind (self):
+    "Check that parameters are slotted in as literals of the property's type"
+    F, P = wmi.Field, wmi.Param
+    prepared = self.connection.Win32_LogicalDisk.prepare (
+      ["caption"], where=(F ("Size") > P ("size")) & (F ("VolumeName") == P ("name")) & (F ("Compressed") == P ("compressed"))
+    )
+    self.assertEquals (prepared.parameters, ["compressed", "name", "size"])
+    self.assertEquals (
+      prepared.wql (size="1024", name="it's c:\\", compressed=0),
+      "SELECT Caption FROM Win32_LogicalDisk WHERE Size > 1024 AND VolumeName = 'it\\'s c:\\\\' AND Compressed = FALSE"
+    )
+    self.assertEquals (
+      prepared.wql (size=5, name=None, compressed=True),
+      "SELECT Caption FROM Win32_LogicalDisk WHERE Size > 5 AND VolumeName = NULL AND Compressed = TRUE"
+    )
+
+  def test_keywords (self):
+    "Check that keyword arguments are ANDed with the condition and may be parameters"
+    prepared = self.connection.Win32_LogicalDisk.prepare (where=wmi.Field ("Size") > 1, DriveType=wmi.Param ("type"))
+    self.assertEquals (prepared.wql (type=3), "SELECT * FROM Win32_LogicalDisk WHERE DriveType = 3 AND Size > 1")
+    self.assertEquals (str (prepared), "<_wmi_prepared_query: SELECT * FROM Win32_LogicalDisk WHERE DriveType = :type AND Size > 1>")
+
+  def test_bad_values (self):
+    "Check that a value which doesn't suit the property's type is refused"
+    prepared = self.connection.Win32_LogicalDisk.prepare (where=wmi.Field ("DriveType") == wmi.Param ("type"))
+    self.assertRaises (wmi.x_wmi, prepared.wql, type="3 OR 1=1")
+    self.assertRaises (wmi.x_wmi, prepared.wql, type=1.5)
+    self.assertRaises (wmi.x_wmi, prepared.wql, type=True)
+    self.assertRaises (wmi.x_wmi, prepared.wql, type=-1)
+    self.assertRaises (wmi.x_wmi, prepared.wql, type="-1")
+
+  def test_datetime (self):
+    "Check that a datetime is slotted in as a DMTF datetime"
+    prepared = self.connection.Win32_LogicalDisk.prepare (where=wmi.Field ("Installed") > wmi.Param ("since"))
+    self.assertEquals (
+      prepared.wql (since=datetime.datetime (2010, 3, 4, 5, 6, 7, 89)),
+      "SELECT * FROM Win32_LogicalDisk WHERE Installed > '20100304050607.000089+000'"
+    )
+    self.assertEquals (
+      prepared.wql (since=datetime.date (2010, 3, 4)),
+      "SELECT * FROM Win32_LogicalDisk WHERE Installed > '20100304000000.000000+000'"
+    )
+    self.assertEquals (
+      prepared.wql (since="20100304******.******+***"),
+      "SELECT * FROM Win32_LogicalDisk WHERE Installed > '20100304******.******+***'"
+    )
+    self.assertRaises (wmi.x_wmi, prepared.wql, since=2010)
+
+  def test_fetch_as_lists (self):
+    "Check that a prepared query can fetch its fields as lists"
+    prepared = self.connection.Win32_LogicalDisk.prepare (["DeviceID", "Caption"], where=wmi.Field ("DriveType") == wmi.Param ("type"))
+    self.assertEquals (prepared.fetch_as_lists (type=3), [["0:", "0:"], ["1:", "1:"], ["2:", "2:"]])
+    self.assertEquals (self.services.queries[-1], "SELECT DeviceID, Caption FROM Win32_LogicalDisk WHERE DriveType = 3")
+
+  def test_missing_and_unknown (self):
+    "Check that every parameter, and only those, must be given"
+    prepared = self.connection.Win32_LogicalDisk.prepare (where=wmi.Field ("DriveType") == wmi.Param ("type"))
+    self.assertRaises (wmi.x_wmi, prepared.wql)
+    self.assertRaises (wmi.x_wmi, prepared.wql, type=3, size=1)
+
+  def test_schema_checked (self):
+    "Check that fields and properties are checked against the class when prepared"
+    F, P = wmi.Field, wmi.Param
+    disks = self.connection.Win32_LogicalDisk
+    self.assertRaises (wmi.x_wmi, disks.prepare, ["Nonesuch"])
+    self.assertRaises (wmi.x_wmi, disks.prepare, where=F ("Nonesuch") == P ("x"))
+    self.assertRaises (wmi.x_wmi, disks.prepare, where=F ("Caption").test (bool))
+
+  def test_compiled_once (self):
+    "Check that the condition is rendered once however often the query is run"
+    prepared = self.connection.Win32_LogicalDisk.prepare (where=wmi.Field ("DriveType") == wmi.Param ("type"))
+    rendered = []
+    wql = prepared.where.wql
+    prepared.where.wql = lambda prefix="": rendered.append (prefix) or wql (prefix)
+    for n in range (5):
+      prepared.wql (type=n)
+    self.assertEquals (len (rendered), 0)
+    prepared._templates.clear ()
+    for n in range (5):
+      prepared.wql (type=n)
+    self.assertEquals (rendered, [""])
+
+  def test_query (self):
+    "Check that running the query sends the bound WQL without escaping it again"
+    prepared = self.connection.Win32_LogicalDisk.prepare (["DeviceID"], where=wmi.Field ("Caption") == wmi.Param ("caption"))
+    disks = prepared (caption="a\\b")
+    self.assertEquals (self.services.queries[-1], "SELECT DeviceID FROM Win32_LogicalDisk WHERE Caption = 'a\\\\b'")
+    self.assertEquals (len (disks), 3)
+
+  def test_unprepared (self):
+    "Check that a condition with parameters can't be used in an ordinary query"
+    where = wmi.Field ("DriveType") == wmi.Param ("type")
+    self.assertRaises (wmi.x_wmi, self.connection.query, "SELECT * FROM Win32_LogicalDisk", where=where)
+    self.assertRaises (wmi.x_wmi, wmi.Param, "a b")
+
+class FakeProjectingServices (FakeSWbemServices):
+  """Services whose queries return only the properties they select, as
+  WMI does, and which can fetch an instance by its path.
+  """
+
+  def ExecQuery (self, strQuery, iFlags=0):
+    instances = FakeSWbemServices.ExecQuery (self, strQuery, iFlags)
+    fields = re.match (r"SELECT\s+(.*?)\s+FROM", strQuery, re.I).group (1)
+    if fields == "*":
+      return instances
+    wanted = [f.strip () for f in fields.split (",")]
+    return [
+      FakeSWbemObject (
+        instance._class_name,
+        [(p.Name, p.CIMType, p.Value) for p in instance._properties if p.Name in wanted],
+        methods=[m.Name for m in instance._methods],
+        calls=instance._calls
+      ) for instance in instances
+    ]
+
+  def Get (self, name):
+    for instances in self._instances.values ():
+      for instance in instances:
+        if instance.Path_.Path == name:
+          self._calls.count ("Get")
+          return instance
+    return FakeSWbemServices.Get (self, name)
+
+class TestAdaptiveProjection (FakeWMITestCase):
+
+  def setUp (self):
+    FakeWMITestCase.setUp (self)
+    self.calls = FakeCalls ()
+    self.services = FakeProjectingServices ([fake_disk_class ()], fake_disks (3, self.calls), self.calls)
+    self.projection = wmi.AdaptiveProjection ()
+    self.connection = self.connect (self.services, projection=self.projection)
+
+  def sizes (self):
+    return [(d.Caption, d.Size) for d in self.connection.Win32_LogicalDisk ()]
+
+  def test_narrowed (self):
+    "Check that a call site selects only the properties its results used"
+    for n in range (3):
+      self.assertEquals (self.sizes (), [("0:", "0"), ("1:", "2000"), ("2:", "4000")])
+    self.assertEquals (self.services.queries, [
+      "SELECT * FROM Win32_LogicalDisk",
+      "SELECT DeviceID, Caption, Size FROM Win32_LogicalDisk",
+      "SELECT DeviceID, Caption, Size FROM Win32_LogicalDisk",
+    ])
+
+  def test_call_sites (self):
+    "Check that each line of code learns on its own"
+    self.sizes ()
+    self.sizes ()
+    [d.VolumeName for d in self.connection.Win32_LogicalDisk ()]
+    self.assertEquals (self.services.queries[-1], "SELECT * FROM Win32_LogicalDisk")
+    self.assertEquals (len (self.projection.stats ()), 2)
+
+  def test_fallback (self):
+    "Check that reading a property which wasn't selected runs the query once more"
+    for n in range (2):
+      disks = self.connection.Win32_LogicalDisk ()
+      [d.Size for d in disks]
+    self.assertEquals (self.services.queries[-1], "SELECT DeviceID, Size FROM Win32_LogicalDisk")
+    self.assertEquals ([d.VolumeName for d in disks], ["Vol0", "Vol1", "Vol2"])
+    self.assertEquals ([d.FreeSpace for d in disks], ["0", "1000", "2000"])
+    self.assertEquals (self.services.queries[-1], "SELECT * FROM Win32_LogicalDisk")
+    self.assertEquals (len (self.services.queries), 3)
+    self.assertEquals (self.calls["Get"], 1)
+    self.assertEquals (self.projection.stats ()[0]["refetches"], 1)
+
+  def test_fallback_missing (self):
+    "Check that a result the second run doesn't return is fetched by its path"
+    disks = [self.connection.Win32_LogicalDisk () for n in range (2)][-1]
+    first = self.services._instances["win32_logicaldisk"].pop (0)
+    self.services.set_instances ("Removed", [first])
+    self.assertEquals ([d.VolumeName for d in disks], ["Vol0", "Vol1", "Vol2"])
+    self.assertEquals (self.calls["Get"], 2)
+
+  def test_freeze (self):
+    "Check that freezing a narrowed result freezes all its properties"
+    for n in range (3):
+      disks = self.connection.Win32_LogicalDisk ()
+      snapshots = [d.freeze () for d in disks]
+      self.assertEquals ([s.VolumeName for s in snapshots], ["Vol0", "Vol1", "Vol2"])
+    self.assertEquals (self.services.queries, ["SELECT * FROM Win32_LogicalDisk"] * 3)
+    self.assert_ (self.projection.stats ()[0]["everything"])
+
+  def test_str (self):
+    "Check that printing a narrowed result prints all its properties"
+    for n in range (2):
+      disks = self.connection.Win32_LogicalDisk ()
+      [d.Size for d in disks]
+    str (disks[0])
+    self.assertEquals (len (disks[0].properties), len (disks[0]._schema.properties))
+    self.assert_ (self.projection.stats ()[0]["everything"])
+
+  def test_fallback_learnt (self):
+    "Check that a property fetched again is selected from then on"
+    for n in range (4):
+      disks = self.connection.Win32_LogicalDisk ()
+      [d.Caption for d in disks]
+      if n == 1:
+        disks[0].VolumeName
+    self.assertEquals (self.services.queries, [
+      "SELECT * FROM Win32_LogicalDisk",
+      "SELECT DeviceID, Caption FROM Win32_LogicalDisk",
+      "SELECT * FROM Win32_LogicalDisk",
+      "SELECT DeviceID, Caption, VolumeName FROM Win32_LogicalDisk",
+      "SELECT DeviceID, Caption, VolumeName FROM Win32_LogicalDisk",
+    ])
+
+  def test_own_fields (self):
+    "Check that a query giving its own fields is left alone"
+    for n in range (2):
+      [d.Size for d in self.connection.Win32_LogicalDisk (["Size", "FreeSpace"])]
+    self.assertEquals (self.services.queries[-1], "SELECT Size, FreeSpace FROM Win32_LogicalDisk")
+    self.assertEquals (self.projection.stats (), [])
+
+  def test_stats (self):
+    "Check that the stats show what's been left out and fetched again"
+    for n in range (3):
+      self.sizes ()
+    [stats] = self.projection.stats ()
+    self.assertEquals (stats["class_name"], "Win32_LogicalDisk")
+    self.assertEquals (stats["fields"], ["Caption", "Size"])
+    self.assertEquals ((stats["runs"], stats["narrowed_runs"], stats["objects"]), (3, 2, 9))
+    self.assertEquals (stats["properties_skipped"], 2 * 3 * 3)
+    self.assertEquals (stats["bytes_skipped"], 2 * 3 * (4 + 8 + 32))
+    self.assertEquals (stats["refetches"], 0)
+    self.assert_ ("wmitest.py:" in stats["code_position"], stats["code_position"])
+
+class FakeKeyedServices (FakeSWbemServices):
+  """Services whose queries return only the instances whose first
+  property is one of the values the WHERE clause compares it with.
+  """
+
+  def __init__ (self, *args, **kwargs):
+    FakeSWbemServices.__init__ (self, *args, **kwargs)
+    self.concurrency = FakeConcurrency ()
+
+  def ExecQuery (self, strQuery, iFlags=0):
+    self.concurrency.enter ("HOST")
+    try:
+      time.sleep (0.02)
+      instances = FakeSWbemServices.ExecQuery (self, strQuery, iFlags)
+      where = strQuery.split (" WHERE ", 1)[1]
+      values = [v.replace ("\\'", "'").replace ("\\\\", "\\") for v in re.findall (r"= '((?:[^'\\]|\\.)*)'", where)]
+      return [i for i in instances if i._properties[0].Value.lower () in [v.lower () for v in values]]
+    finally:
+      self.concurrency.leave ("HOST")
+
+class TestGetMany (FakeWMITestCase):
+
+  pass_marshalled = True
+
+  def setUp (self):
+    FakeWMITestCase.setUp (self)
+    self.services = FakeKeyedServices ([fake_disk_class ()], fake_disks (40))
+    self.connection = self.connect (self.services)
+
+  def test_results (self):
+    "Check that each key maps to its instance and missing keys are left out"
+    disks = self.connection.Win32_LogicalDisk.get_many (["3:", "17:", "99:", "0:"])
+    self.assertEquals (sorted (disks), ["0:", "17:", "3:"])
+    for key, disk in disks.items ():
+      self.assertEquals (disk.DeviceID, key)
+    self.assertEquals (self.services.queries, [
+      "SELECT * FROM Win32_LogicalDisk WHERE DeviceID = '3:' OR DeviceID = '17:' OR DeviceID = '99:' OR DeviceID = '0:'"
+    ])
+
+  def test_case (self):
+    "Check that keys are matched as WMI matches strings, ignoring case"
+    self.services.set_instances ("Win32_LogicalDisk", fake_disks (1) + [FakeSWbemObject ("Win32_LogicalDisk", [("DeviceID", "string", "Ab")])])
+    disks = self.connection.Win32_LogicalDisk.get_many (["aB", "AB"])
+    self.assertEquals (sorted (disks), ["AB", "aB"])
+    self.assertEquals (disks["aB"].DeviceID, "Ab")
+    self.assert_ (disks["AB"] is disks["aB"])
+    self.assertEquals (len (self.services.queries), 1)
+
+  def test_spellings (self):
+    "Check that a key given both as a number and as a string appears under each"
+    services = FakeSWbemServices (
+      [FakeSWbemObject ("Proc", [("Handle", "uint32", None)], is_class=True)],
+      [FakeSWbemObject ("Proc", [("Handle", "uint32", 4)])]
+    )
+    connection = self.connect (services)
+    processes = connection.Proc.get_many ([4, "4"])
+    self.assertEquals (services.queries[-1], "SELECT * FROM Proc WHERE Handle = 4")
+    self.assertEquals (sorted (processes.keys (), key=repr), ["4", 4])
+    self.assert_ (processes[4] is processes["4"])
+
+  def test_limited (self):
+    "Check that each query holds a slot on the namespace's limiter"
+    limiter = wmi.ConcurrencyLimiter (initial_limit=1, max_limit=1)
+    connection = self.connect (self.services, location=("HOST", ""), limiter=limiter)
+    keys = ["%d:" % i for i in range (40)]
+    self.assertEquals (len (connection.Win32_LogicalDisk.get_many (keys, max_wql_length=200)), 40)
+    self.assertEquals (self.services.concurrency.peak["HOST"], 1)
+    self.assertEquals (limiter.metrics ()["host"]["calls"], len (self.services.queries))
+
+  def test_cached (self):
+    "Check that queries go to the namespace's query cache first"
+    cache = wmi.QueryCache ()
+    connection = self.connect (self.services, query_cache=cache)
+    keys = ["%d:" % i for i in range (40)]
+    first = connection.Win32_LogicalDisk.get_many (keys, ["Size"], max_wql_length=200)
+    n_queries = len (self.services.queries)
+    second = connection.Win32_LogicalDisk.get_many (keys, ["Size"], max_wql_length=200)
+    self.assertEquals (len (self.services.queries), n_queries)
+    self.assertEquals (cache.hits, n_queries)
+    for key in keys:
+      self.assert_ (first[key] is second[key])
+
+  def test_batches (self):
+    "Check that the keys are split into queries within the length limit, run at once"
+    keys = ["%d:" % i for i in range (40)]
+    disks = self.connection.Win32_LogicalDisk.get_many (keys, ["Size"], max_wql_length=200)
+    self.assertEquals (len (disks), 40)
+    self.assert_ (len (self.services.queries) > 3, self.services.queries)
+    for wql in self.services.queries:
+      self.assert_ (len (wql) <= 200, wql)
+      self.assert_ (wql.startswith ("SELECT Size, DeviceID FROM Win32_LogicalDisk WHERE DeviceID = '"), wql)
+    self.assertEquals (self.services.concurrency.peak["HOST"], 4)
+
+  def test_typed_and_escaped (self):
+    "Check that key values are rendered as literals of the key's type"
+    self.connection.Win32_LogicalDisk.get_many (["it's", "a\\b"])
+    self.assertEquals (self.services.queries[-1], "SELECT * FROM Win32_LogicalDisk WHERE DeviceID = 'it\\'s' OR DeviceID = 'a\\\\b'")
+
+  def test_compound_keys (self):
+    "Check that a class with several keys takes tuples"
+    services = FakeSWbemServices ([FakeSWbemObject ("Pair", [("A", "string", None), ("B", "uint32", None)], n_keys=2, is_class=True)])
+    connection = self.connect (services)
+    connection.Pair.get_many ([("x", 1), ("y", "2")])
+    self.assertEquals (services.queries[-1], "SELECT * FROM Pair WHERE (A = 'x' AND B = 1) OR (A = 'y' AND B = 2)")
+    self.assertRaises (wmi.x_wmi, connection.Pair.get_many, ["x"])
+    self.assertRaises (wmi.x_wmi, connection.Pair.get_many, [("x", "one")])
+
+class FakeAssociatedObject (FakeSWbemObject):
+  """An object whose Associators_ and References_ record how they were called"""
+
+  def __init__ (self, *args, **kwargs):
+    FakeSWbemObject.__init__ (self, *args, **kwargs)
+    self.association_calls = []
+
+  def Associators_ (self, **kwargs):
+    self.association_calls.append (("Associators_", kwargs))
+    return []
+
+  def References_ (self, **kwargs):
+    self.association_calls.append (("References_", kwargs))
+    return []
+
+class FakeAssociationServices (FakeProjectingServices):
+  """Services which answer ASSOCIATORS OF and REFERENCES OF queries from
+  a dictionary mapping relative paths to the objects associated with them.
+  """
+
+  def __init__ (self, classes, instances, associations, calls=None):
+    FakeProjectingServices.__init__ (self, classes, instances, calls)
+    self.associations = associations
+
+  def ExecQuery (self, strQuery, iFlags=0):
+    match = re.match (r"(?:ASSOCIATORS|REFERENCES) OF \{(.*?)\}", strQuery)
+    if match is None:
+      return FakeProjectingServices.ExecQuery (self, strQuery, iFlags)
+    self._calls.count ("ExecQuery")
+    self.queries.append (strQuery)
+    return list (self.associations.get (match.group (1), []))
+
+class TestLazyAssociators (FakeWMITestCase):
+
+  def setUp (self):
+    FakeWMITestCase.setUp (self)
+    self.calls = FakeCalls ()
+    self.disks = [
+      FakeAssociatedObject ("Win32_LogicalDisk", [("DeviceID", "string", "C:"), ("Size", "uint64", "100")], calls=self.calls)
+    ]
+    self.partitions = [
+      FakeSWbemObject ("Win32_DiskPartition", [("DeviceID", "string", "Disk #0, Partition #%d" % i), ("Size", "uint64", str (i))], calls=self.calls)
+        for i in range (2)
+    ]
+    self.drive = FakeSWbemObject ("Win32_DiskDrive", [("DeviceID", "string", "PHYSICALDRIVE0")], calls=self.calls)
+    self.services = FakeAssociationServices (
+      [fake_disk_class (self.calls)],
+      self.disks + self.partitions + [self.drive],
+      {
+        'Win32_LogicalDisk.DeviceID="C:"' : self.partitions,
+        'Win32_DiskPartition.DeviceID="Disk #0, Partition #0"' : [self.drive],
+      },
+      self.calls
+    )
+    self.connection = self.connect (self.services)
+    self.disk, = self.connection.Win32_LogicalDisk ()
+    self.calls.clear ()
+
+  def test_keys_only (self):
+    "Check that keys_only asks WMI for keys and returns handles holding them"
+    partitions = self.disk.associators ("Win32_LogicalDiskToPartition", role="Dependent", keys_only=True)
+    self.assertEquals (
+      self.services.queries[-1],
+      'ASSOCIATORS OF {Win32_LogicalDisk.DeviceID="C:"} WHERE AssocClass = Win32_LogicalDiskToPartition Role = Dependent KeysOnly'
+    )
+    self.assertEquals ([p.DeviceID for p in partitions], ["Disk #0, Partition #0", "Disk #0, Partition #1"])
+    self.assertEquals ([p.class_name for p in partitions], ["Win32_DiskPartition"] * 2)
+    self.assertEquals (self.calls.get ("Get", 0), 0)
+
+  def test_materialised (self):
+    "Check that reading anything but a key fetches the object, once"
+    partition = self.disk.associators (keys_only=True)[1]
+    self.assertEquals (partition.Size, "1")
+    self.assertEquals (partition.Size, "1")
+    self.assertEquals (self.calls["Get"], 1)
+    self.assert_ (isinstance (partition.get (), wmi._wmi_object))
+
+  def test_identity (self):
+    "Check that a handle compares and hashes as the object it stands for"
+    partition = self.disk.associators (keys_only=True)[0]
+    live = wmi._wmi_object (self.partitions[0])
+    self.assertEquals (partition, live)
+    self.assertEquals (len (set ([partition, live])), 1)
+    self.assertEquals (self.calls.get ("Get", 0), 0)
+
+  def test_walk (self):
+    "Check that a handle's own associators go from its path without fetching it"
+    partition = self.disk.associators (keys_only=True)[0]
+    drives = partition.associators (wmi_result_class="Win32_DiskDrive", result_role="Antecedent", keys_only=True)
+    self.assertEquals (
+      self.services.queries[-1],
+      'ASSOCIATORS OF {Win32_DiskPartition.DeviceID="Disk #0, Partition #0"} WHERE ResultClass = Win32_DiskDrive ResultRole = Antecedent KeysOnly'
+    )
+    self.assertEquals ([d.DeviceID for d in drives], ["PHYSICALDRIVE0"])
+    self.assertEquals (self.calls.get ("Get", 0), 0)
+
+  def test_fetched_keeps_connection (self):
+    "Check that an object fetched from a handle follows its associators over the same connection"
+    _GetObject, wmi.GetObject = wmi.GetObject, None
+    try:
+      partition = self.disk.associators (keys_only=True)[0].get ()
+      drives = partition.associators (keys_only=True)
+    finally:
+      wmi.GetObject = _GetObject
+    self.assertEquals ([d.DeviceID for d in drives], ["PHYSICALDRIVE0"])
+    self.assert_ (drives[0]._namespace is self.connection)
+
+  def test_unknown_connection (self):
+    "Check that an object with no known connection raises rather than reconnecting"
+    partition = wmi._wmi_object (self.partitions[0])
+    self.assertRaises (wmi.x_wmi_no_namespace, partition.associators, keys_only=True)
+
+  def test_references (self):
+    "Check that references takes a role and qualifier and keys_only too"
+    self.disk.references ("Win32_LogicalDiskToPartition", role="Dependent", required_qualifier="Association", keys_only=True)
+    self.assertEquals (
+      self.services.queries[-1],
+      'REFERENCES OF {Win32_LogicalDisk.DeviceID="C:"} WHERE ResultClass = Win32_LogicalDiskToPartition Role = Dependent RequiredQualifier = Association KeysOnly'
+    )
+
+  def test_exclusive (self):
+    "Check that keys_only and class_defs_only can't be asked for together"
+    self.assertRaises (wmi.x_wmi, self.disk.associators, keys_only=True, class_defs_only=True)
+
+  def test_full_objects (self):
+    "Check that without keys_only the new parameters are passed to Associators_ and References_"
+    self.disk.associators (role="Dependent", required_assoc_qualifier="Association")
+    self.disk.references (required_qualifier="Association", class_defs_only=True)
+    (method, kwargs), (method2, kwargs2) = self.disks[0].association_calls
+    self.assertEquals ((method, kwargs["strRole"], kwargs["strRequiredAssocQualifier"], kwargs["bClassesOnly"]), ("Associators_", "Dependent", "Association", False))
+    self.assertEquals ((method2, kwargs2["strRequiredQualifier"], kwargs2["bClassesOnly"]), ("References_", "Association", True))
+
+class TestBulkAssociators (FakeWMITestCase):
+
+  def setUp (self):
+    FakeWMITestCase.setUp (self)
+    disk_class = fake_disk_class ()
+    disk_class.Derivation_ = ("CIM_LogicalDisk", "CIM_StorageExtent")
+    partition_class = FakeSWbemObject ("Win32_DiskPartition", [("DeviceID", "string", None), ("Size", "uint64", None)], is_class=True)
+    partition_class.Derivation_ = ("CIM_DiskPartition", "CIM_StorageExtent")
+    association_class = FakeSWbemObject (
+      "Win32_LogicalDiskToPartition",
+      [("Antecedent", "ref:CIM_DiskPartition", None), ("Dependent", "ref:CIM_LogicalDisk", None)],
+      n_keys=2, is_class=True
+    )
+    association_class.Derivation_ = ("CIM_LogicalDiskBasedOnPartition",)
+    self.disks = fake_disks (3)
+    self.partitions = [
+      FakeSWbemObject ("Win32_DiskPartition", [("DeviceID", "string", "P%d" % i), ("Size", "uint64", str (i))]) for i in range (3)
+    ]
+    def link (partition, disk):
+      return FakeSWbemObject ("Win32_LogicalDiskToPartition", [
+        ("Antecedent", "ref:CIM_DiskPartition", self.partitions[partition].Path_.Path),
+        ("Dependent", "ref:CIM_LogicalDisk", 'Win32_LogicalDisk.DeviceID="%d:"' % disk),
+      ], n_keys=2)
+    self.services = FakeSWbemServices (
+      [disk_class, partition_class, association_class],
+      self.disks + self.partitions + [link (0, 0), link (1, 1), link (2, 1)]
+    )
+    self.connection = self.connect (self.services)
+
+  def test_results (self):
+    "Check that each source maps to its associated objects, with two queries in all"
+    disks = self.connection.Win32_LogicalDisk ()
+    del self.services.queries[:]
+    partitions = self.connection.associators_many (disks, "Win32_LogicalDiskToPartition")
+    self.assertEquals (
+      [(d.DeviceID, [p.DeviceID for p in partitions[d]]) for d in disks],
+      [("0:", ["P0"]), ("1:", ["P1", "P2"]), ("2:", [])]
+    )
+    self.assertEquals (self.services.queries, [
+      "SELECT Dependent, Antecedent FROM Win32_LogicalDiskToPartition",
+      "SELECT * FROM Win32_DiskPartition",
+    ])
+
+  def test_reversed (self):
+    "Check that the roles are worked out from whichever end the sources are"
+    partitions = self.connection.Win32_DiskPartition ()
+    disks = self.connection.associators_many (partitions, "Win32_LogicalDiskToPartition", fields=["Caption"])
+    self.assertEquals ([[d.DeviceID for d in disks[p]] for p in partitions], [["0:"], ["1:"], ["1:"]])
+    self.assertEquals (self.services.queries[-1], "SELECT Caption, DeviceID FROM Win32_LogicalDisk")
+
+  def test_paths_and_snapshots (self):
+    "Check that sources may be paths or snapshots, matched however the path is written"
+    c_drive = self.connection.Win32_LogicalDisk ()[1].freeze ()
+    path = "\\\\host\\ROOT\\cimv2:win32_logicaldisk.deviceid=\"0:\""
+    partitions = self.connection.associators_many ([c_drive, path], "Win32_LogicalDiskToPartition")
+    self.assertEquals (len (partitions[c_drive]), 2)
+    self.assertEquals ([p.DeviceID for p in partitions[path]], ["P0"])
+
+  def test_roles (self):
+    "Check that roles can be given and that unknown ones are refused"
+    disks = self.connection.Win32_LogicalDisk ()
+    partitions = self.connection.associators_many (disks, "Win32_LogicalDiskToPartition", source_role="Dependent", result_role="Antecedent")
+    self.assertEquals (len (partitions[disks[1]]), 2)
+    self.assertRaises (wmi.x_wmi, self.connection.associators_many, disks, "Win32_LogicalDiskToPartition", source_role="Nonesuch")
+
+  def test_ambiguous (self):
+    "Check that an association between objects of the same class needs a role"
+    subdirectory = FakeSWbemObject (
+      "Win32_SubDirectory",
+      [("GroupComponent", "ref:Win32_LogicalDisk", None), ("PartComponent", "ref:Win32_LogicalDisk", None)],
+      n_keys=2, is_class=True
+    )
+    subdirectory.Derivation_ = ()
+    self.services._classes["win32_subdirectory"] = subdirectory
+    disks = self.connection.Win32_LogicalDisk ()
+    self.assertRaises (wmi.x_wmi, self.connection.associators_many, disks, "Win32_SubDirectory")
+    self.assertEquals (self.connection.associators_many (disks, "Win32_SubDirectory", source_role="GroupComponent")[disks[0]], [])
+
 class TestWMI (unittest.TestCase):
 
   def setUp (self):